@@ -7,41 +7,245 @@
 ###                                                                         ###
 ###############################################################################
 
+import threading    ## for serialising access to the shared session
+import time         ## for timing serial round trips
 import serial       ## for serial communication with laser
+from concurrent.futures import CancelledError, TimeoutError  ## waiting for replies
+import config       ## port and timeout settings
+import shadow       ## shadow registers, invalidated on reconnect
+import backend      ## real or simulated laser port
+import devices      ## one session per device
+import budget       ## deadline of the request being sent
+from scheduler import DeviceScheduler, SAFETY, WRITE, READ, phase  ## single I/O owner
 
-def laser(msg):
+##### PERSISTENT SESSION ######################################################
+
+class LaserSession:
+    '''
+    A long-lived serial session with a Coherent BioRay laser
+
+        - the serial port is opened on first use and then kept open
+        - replies are read line by line until the OK/ERR handshake is seen,
+          so a query only waits as long as the laser takes to answer
+        - on a SerialException the port is closed and reopened, and the
+          message is sent again (up to the configured number of retries)
+        - a lock makes sure that only one message is on the line at a time
+        - shadowed laser registers are invalidated whenever the connection
+          is lost, as the laser may have been power cycled meanwhile
+        - while the device node of the port is gone (see hotplug.py), every
+          message fails at once instead of trying to reconnect
+    '''
+
+    def __init__(self, port=config.LASER_PORT,
+                       baudrate=config.LASER_BAUDRATE,
+                       timeout=config.LASER_TIMEOUT,
+                       retries=config.LASER_RETRIES,
+                       registers=None,
+                       name='laser'):
+        '''
+        Init function for laser session (does not open the port yet)
+
+        Arguments:
+            port <str> - path to the TTY device of the laser
+            baudrate <int> - baud rate of the laser
+            timeout <float> - seconds to wait for each line from the laser
+            retries <int> - reconnect attempts after a SerialException
+            registers <ShadowRegisters> - shadow to invalidate on reconnect
+            name <str> - name of laser in metrics and traces
+
+        Returns:
+            none
+        '''
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.retries = retries
+        self.registers = registers
+        self.name = name
+        self.ser = None
+        self.lock = threading.Lock()
+        self.present = True             ## False while unplugged
+
+    def unplug(self):
+        '''Closes the port of a laser that was unplugged, failing messages until replug()'''
+
+        self.present = False
+        with self.lock: self.close()    ## after the message on the line, if any
+        if self.registers is not None: self.registers.invalidate('laser')
+
+    def replug(self):
+        '''Lets messages through again, opening the port afresh'''
+
+        with self.lock:
+            self.close()
+            self.present = True
+
+    def open(self):
+        '''Opens the serial port if it is not open already'''
+
+        if self.ser is not None and self.ser.is_open: return
+        start = time.perf_counter()
+        self.ser = serial.Serial(port=self.port,
+                                 baudrate=self.baudrate,
+                                 parity=serial.PARITY_NONE,
+                                 stopbits=serial.STOPBITS_ONE,
+                                 bytesize=serial.EIGHTBITS,
+                                 timeout=self.timeout,
+                                 write_timeout=self.timeout)
+        self.ser.reset_input_buffer()
+        phase(self.name, 'open', start)
+
+    def close(self):
+        '''Closes the serial port, ignoring any errors while doing so'''
+
+        if self.ser is not None:
+            try: self.ser.close()
+            except Exception: pass
+        self.ser = None
+
+    def transaction(self, msg):
+        '''
+        Writes one message and reads the reply up to the handshake line
+
+        Arguments:
+            msg <str> - message to send to laser over serial
+
+        Returns:
+            ['00', first line of reply] if handshake shows OK
+            ['33', handshake line] if handshake shows ERR
+            raises SerialTimeoutException if a line is late, each line being
+            given self.timeout or what is left of the deadline, if shorter
+        '''
+        if self.ser.in_waiting: self.ser.reset_input_buffer()   ## late replies
+        if budget.limit(self.ser, self.timeout) == 0.0:
+            raise serial.SerialTimeoutException('Deadline passed before sending: ' + repr(msg))
+        start = time.perf_counter()
+        self.ser.write((msg + '\r\n').encode(encoding='ascii'))
+        written = phase(self.name, 'write', start)
+
+        response = []
+        try:
+            while True:
+                budget.limit(self.ser, self.timeout)    ## each line, within the deadline
+                line = self.ser.readline()
+                if not line.endswith(b'\n'):    ## readline gave up waiting
+                    raise serial.SerialTimeoutException(
+                        'No handshake from laser after: ' + repr(msg))
+                line = line.decode(encoding='ascii').rstrip()
+                response.append(line)
+                if line == 'OK': return(['00', response[0]])
+                if line.startswith('ERR'): return(['33', line])
+        finally:
+            phase(self.name, 'read', written)
+
+    def query(self, msg):
+        '''
+        Sends a message to the laser over the persistent session
+
+        Arguments:
+            msg <str> - message to send to laser over serial
+
+        Returns:
+            Response from laser
+            Error codes (see local file errors.txt)
+        '''
+        error = None
+        with self.lock:
+            for attempt in range(self.retries + 1):
+                if not self.present:
+                    return(['31', 'Laser is unplugged, waiting for it to return'])
+                try:
+                    self.open()
+                    return self.transaction(msg)
+                except serial.SerialTimeoutException as e:
+                    return(['32', str(e)])
+                except serial.SerialException as e:
+                    self.close()            ## reconnect on next attempt
+                    if self.registers is not None:
+                        self.registers.invalidate('laser')
+                    error = e
+                except Exception as e:
+                    return(['30', str(e)])
+        return(['31', str(error)])
+
+##### SHARED SESSIONS #########################################################
+
+## one session per device (see devices.py), opened on first use
+session = devices.PerDevice(lambda name: LaserSession(
+    port=backend.port('laser', name), registers=shadow.registers.of(name),
+    name=name + '.laser'))
+
+## the only thread that talks to a laser, one message at a time so that a
+## safety message never waits for more than the message already on the line;
+## every device has its own, so a slow laser does not hold up the others
+scheduler = devices.PerDevice(lambda name: DeviceScheduler(
+    name + '.laser', lambda msgs, session=session.of(name): [session.query(msg) for msg in msgs],
+    supersedes=supersedes))
+
+def lane(msg):
+    '''Returns scheduler lane of a message: switching off, settings or queries'''
+
+    if msg.upper().replace(' ', '') == 'SOUR:AM:STATOFF': return SAFETY
+    if msg.endswith('?'): return READ
+    return WRITE
+
+def supersedes(off, msg):
+    '''Returns whether a message queued before switching off must not be sent'''
+
+    return msg.upper().replace(' ', '') == 'SOUR:AM:STATON'     ## on again
+
+def submit(msg, timeout=None):
+    '''
+    Queues a message for the laser without waiting for its response
+
+    Arguments:
+        msg <str> - message to send to laser over serial
+        timeout <float> - seconds the message may wait to be sent
+
+    Returns:
+        Future that receives the response from laser or error codes
+    '''
+    return scheduler.submit(msg, lane(msg), key=msg, timeout=timeout)
+
+def result(future, timeout=None):
+    '''
+    Waits for the response to a message queued with submit
+
+    Arguments:
+        future <Future> - returned by submit
+        timeout <float> - seconds until giving up (default: the remaining
+                          budget, at most config.IO_DEADLINE)
+
+    Returns:
+        Response from laser
+        Error codes (see local file errors.txt)
+    '''
+    try:
+        response = future.result(budget.remaining(config.IO_DEADLINE) if timeout is None else timeout)
+    except (TimeoutError, CancelledError):
+        future.cancel()                 ## no effect once it has started
+        response = '32'
+    return response if type(response) is list else [response, 'No response from laser before deadline']
+
+def laser(msg, timeout=None):
     '''
     A function for serial communication with a Coherent BioRay laser
-    
-        - a serial port that the laser is connected to is opened
-        - message is written to laser (with a 100ms timeout)
-        - two lines are read from laser (message, handshake)
+
+        - message is queued with the scheduler of the laser of the current
+          device (see devices.py), identical queries that are waiting at the
+          same time are sent only once
+        - lines are read from laser until the handshake (OK or ERR)
         - if handshake shows OK, response is returned
         - if handshake shows ERR or another error occurs, returns error code
-    
+
     Arguments:
         msg <str> - message to send to laser over serial
-    
+        timeout <float> - seconds until giving up (default: the remaining
+                          budget, at most config.IO_DEADLINE)
+
     Returns:
         Response from laser
         Error codes (see local file errors.txt)
     '''
-    try:
-        with serial.Serial(port='/dev/ttyUSB0',
-                           baudrate=115200,
-                           parity=serial.PARITY_NONE,
-                           stopbits=serial.STOPBITS_ONE,
-                           bytesize=serial.EIGHTBITS,
-                           timeout=0.1) as ser:
-            ser.write((msg + '\r\n').encode(encoding='ascii'))
-            response = [line.decode(encoding='ascii').rstrip() for line in ser.readlines()]
-            
-            if response[-1] == 'OK': return(['00', response[0]])
-            else: return(['33', response[-1]])
-
-    except serial.SerialException as e:
-        return(['31', str(e)])
-    except serial.SerialTimeoutException as e:
-        return(['32', str(e)])
-    except Exception as e:
-        return(['30', str(e)])
+    result = scheduler.call(msg, lane(msg), key=msg, timeout=timeout)
+    return result if type(result) is list else [result, 'No response from laser before deadline']
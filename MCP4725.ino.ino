@@ -15,6 +15,7 @@
     010: square
     011: triangle
     100: sawtooth
+    101: arbitrary (sample table uploaded by Pi, see W/N/V setpoints)
     111: pulse
  **********************************************
 
@@ -27,6 +28,7 @@
 
 #include "I2C.h"    // instead of Wire library, as it times out instead of locks up when transmission fails
 #include "math.h"   // for computing sine, rounding, etc.
+#include <util/crc16.h>  // for checking binary frames (CRC-8)
 
 /************************ Global variable declarations ************************/
 
@@ -39,6 +41,7 @@ uint32_t off_micro = 0;  // MICROseconds delay between cycles
 bool needs_calibrating = true;  // Wave needs calibrating
 bool waiting = true;            // Is wave waiting until delay is complete?
 float divisor = 1.0;            // How many steps per wave (more steps, nicer wave, lower frequency)
+float preset_divisor = 1.0;     // Divisor to start calibrating from (sent by Pi from its cache)
 float increment = 0.01;         // How much to increment the divisor (prevents calibration from taking too long)
 unsigned long timer = 0;        // Wave timer (how long did my wave take, compared to target time)
 unsigned long last_timer = 0;   // Wave timer, so we can revert to this in case we overincrement during alibration
@@ -53,6 +56,56 @@ char rgb_state = ' ';           // State of LED
 uint8_t modeOfModulation = 0;   // Mode of modulation (none/sine/square/triangle/sawtooth/pulse)
 uint8_t modeOfOperation = 3;    // Mode of operation (gated/master/independent)
 
+// SERIAL FRAME VARIABLES
+#define SERIAL_BAUDRATE 115200  // must match ARDUINO_BAUDRATE in config.py
+#define FRAME_END '\n'          // end-of-frame marker, ends every frame
+#define FRAME_SIZE 64           // longest frame that can be received
+char frame[FRAME_SIZE];         // bytes of the frame received so far
+uint8_t frame_length = 0;       // number of bytes in frame
+bool frame_overflow = false;    // frame was longer than FRAME_SIZE
+bool frame_binary = false;      // frame started with PROTOCOL_SYNC
+bool frame_resync = false;      // dropping the rest of a rejected binary frame
+unsigned long frame_timer = 0;  // micros() at which binary frame started
+bool preset_given = false;      // frame contained a C setpoint
+
+// BINARY PROTOCOL (frame: sync, version, sequence, command, length, payload, CRC-8
+// of everything after sync; acknowledged by: ACK_SYNC, sequence, status)
+#define PROTOCOL_SYNC 0xA5      // never sent in ASCII frames
+#define PROTOCOL_VERSION 1      // must match VERSION in protocol.py
+#define HEADER_SIZE 5           // sync, version, sequence, command, length
+#define FRAME_TIMEOUT 50000     // MICROseconds before a stalled binary frame is dropped
+#define ACK_SYNC 0x5A           // first byte of every binary acknowledgement
+#define CMD_SETPOINTS 0x01      // payload: (setpoint letter, float32) pairs
+#define CMD_WAVE 0x02           // payload: uint16 samples for wave table
+#define CMD_STREAM 0x03         // payload: uint16 power values for stream
+#define STATUS_OK 0x00
+#define STATUS_CHECKSUM 0x01    // CRC-8 did not match, frame ignored
+#define STATUS_VERSION 0x02     // unsupported protocol version
+#define STATUS_COMMAND 0x03     // unknown command or malformed payload
+#define STATUS_FULL 0x04        // more samples than there is room for
+
+// ARBITRARY WAVE VARIABLES
+#define WAVE_SIZE 256               // most samples a wave table can hold
+uint16_t wave_table[WAVE_SIZE];     // 12-bit samples of one period (full scale)
+uint16_t wave_length = 0;           // number of samples in wave_table
+uint32_t wave_sample_micro = 0;     // MICROseconds between samples
+uint16_t wave_index = 0;            // next sample to be played
+unsigned long wave_next = 0;        // micros() at which next sample is due
+
+// WAVE UPLOAD VARIABLES (frames: "W<micros per sample> N<samples>", then
+// as many "V<3 hex digits per sample>" frames as needed to send all samples)
+uint32_t wave_rx_micro = 0;         // micros per sample of table being received
+uint16_t wave_rx_count = 0;         // samples announced for table being received
+uint16_t wave_rx_length = 0;        // samples received so far
+
+// POWER STREAM VARIABLES (Pi queues power values, one is applied every stream_micro)
+#define STREAM_SIZE 64              // power values that can be queued
+uint16_t stream[STREAM_SIZE];       // queued 12-bit power values
+uint8_t stream_head = 0;            // index of next value to apply
+uint8_t stream_count = 0;           // number of queued values
+uint32_t stream_micro = 0;          // MICROseconds between values (0: stopped)
+unsigned long stream_next = 0;      // micros() at which next value is due
+
 // WARNING BEEP VARIALBES
 unsigned long warn_timer = 0;   // Warning timer (for measuring time between beeps)
 uint32_t warn_delay = 5e5;      // Warning delay (time to wait between beeps)
@@ -66,6 +119,7 @@ inline void square();
 inline void triangle();
 inline void sawtooth();
 inline void pulse();
+inline void arbitrary();
 
 // HELPER FUNCTIONS
 void writeToDAC(uint16_t);
@@ -73,11 +127,20 @@ void setRGB(char);
 inline void calibrate();
 inline void trigger(uint16_t);
 inline void genericOff();
+inline bool storeWaveSample(uint16_t);
+inline bool queueStreamSample(uint16_t);
+inline bool receiveSamples(char*, bool (*)(uint16_t));
 
 // PERIODIC CHECK FUNCTIONS
 void check();
 inline void checkInterlock();
 inline void checkForSerial();
+inline void checkStream();
+inline bool parseFrame(char*);
+inline void receiveBinary(uint8_t);
+inline uint8_t parseBinary(uint8_t*, uint8_t);
+inline bool applySetpoint(char, float);
+inline void finishSetpoints(bool);
 inline void checkModulationMode();
 inline void checkOperationMode();
 
@@ -142,8 +205,13 @@ inline void calibrate() {
     return;
   }
 
-  // finished calibrating
+  // finished calibrating, report result so Pi can start here next time
   needs_calibrating = !needs_calibrating;
+  Serial.print(F("CAL "));                          // kept in flash, SRAM is short
+  Serial.print(modeOfModulation); Serial.print(' ');
+  Serial.print(tot_micro); Serial.print(' ');
+  Serial.print(power); Serial.print(' ');
+  Serial.println(divisor, 4);
   
 }
 
@@ -172,6 +240,7 @@ inline void genericOff() {
 void check() {
   checkInterlock();
   checkForSerial();
+  checkStream();
   checkModulationMode();
   checkOperationMode();
 }
@@ -234,28 +303,221 @@ inline void checkInterlock() {
 /***** checkForSerial ***** checks for incoming serial data and parses it *****/
 
 inline void checkForSerial() {
-  // only do anything if data is waiting to be parsed
-  if (Serial.available() > 0) {
+  // a binary frame has no end marker, drop it if the rest never arrives
+  if ((frame_binary || frame_resync) && (micros() - frame_timer) > FRAME_TIMEOUT) {
+    frame_length = 0;
+    frame_binary = false;
+    frame_resync = false;
+  }
+
+  // collect bytes without blocking until a frame is complete
+  while (Serial.available() > 0) {
+    uint8_t c = Serial.read();
+
+    // the payload of a rejected frame must not be read as ASCII setpoints
+    if (frame_resync) {
+      if (c != PROTOCOL_SYNC) continue;
+      frame_resync = false;
+    }
+
+    // binary frames start with a byte that never occurs in ASCII frames
+    if (frame_length == 0 && c == PROTOCOL_SYNC) {
+      frame_binary = true;
+      frame_timer = micros();
+    }
+    if (frame_binary) {
+      receiveBinary(c);
+      continue;
+    }
+
+    if (c != FRAME_END) {
+      if (frame_length < FRAME_SIZE - 1) frame[frame_length++] = c;
+      else frame_overflow = true;
+      continue;
+    }
+
+    // a full frame has arrived, apply all of its setpoints at once
     setRGB('G');                                    // we are busy with serial communication
-    String str = Serial.readString();               // get one line from Serial
-    uint8_t str_index = 0;                          // start from first character
-    while (str_index != str.indexOf("\r\n")) {      // if we have not reached the end
-      while (str.indexOf(" ", str_index) != -1) {   // if we have not reached the last space
-        float val = str.substring(str_index + 1, str.indexOf(" ", str_index)).toFloat();  // extract float
-        switch (str.charAt(str_index)) {            // first character signals what float means, sort accordingly
-          case 'A': power = round(4095 * (val / 100.0)); break;
-          case 'T': threshold = val / 100.0; break;
-          case 'P': tot_micro = round(val * 1e3); increment = pow(tot_micro, 2) / (5e9) + 0.001; break;
-          case 'D': off_micro = round(val * 1e3); break;
-        }
-        str_index = str.indexOf(" ", str_index) + 1; // continue to next space
-      }
+    frame[frame_length] = '\0';
+    if (frame_overflow || !parseFrame(frame)) {
+      Serial.println("ERR");                        // frame was cut short or rejected
+    } else {
+      Serial.println("OK");                         // signal transmission successful
+    }
+    frame_length = 0;
+    frame_overflow = false;
+    setRGB('K');                                    // LED off, transmission complete
+  }
+}
+
+/******* parseFrame ****** applies every setpoint of a received frame *******/
+
+inline bool parseFrame(char *str) {
+  bool recalibrate = false;
+  bool ok = true;
+  char *token = strtok(str, " \r");                // setpoints are separated by spaces
+  while (token != NULL) {
+    switch (token[0]) {                             // samples are hex, everything else is a float
+      case 'V': ok = receiveSamples(token + 1, storeWaveSample) && ok; break;
+      case 'Q': ok = receiveSamples(token + 1, queueStreamSample) && ok; break;
+      default: recalibrate = applySetpoint(token[0], atof(token + 1)) || recalibrate;
     }
-    Serial.println("OK");       // signal transmission successful
-    needs_calibrating = true;   // set calibration flag
-    divisor = 1.0;              // reset wave divisor
-    setRGB('K');                // LED off, transmission complete
+    token = strtok(NULL, " \r");                   // continue to next setpoint
+  }
+  finishSetpoints(recalibrate);
+  return ok;
+}
+
+/**** receiveBinary **** collects one byte of a binary frame, answers when complete ****/
+
+inline void receiveBinary(uint8_t c) {
+  uint8_t *bytes = (uint8_t*)frame;
+  bytes[frame_length++] = c;
+  if (frame_length < HEADER_SIZE) return;
+
+  // whole frame is header, payload and checksum
+  uint8_t total = HEADER_SIZE + bytes[4] + 1;
+  uint8_t status = STATUS_OK;
+  if (total > FRAME_SIZE) {
+    status = STATUS_COMMAND;                        // can never fit, give up now
+    frame_resync = true;                            // and skip to the next frame
+  } else {
+    if (frame_length < total) return;
+    setRGB('G');                                    // we are busy with serial communication
+    status = parseBinary(bytes, total);
+    setRGB('K');                                    // LED off, transmission complete
+  }
+
+  Serial.write(ACK_SYNC);
+  Serial.write(bytes[2]);                           // sequence number of frame
+  Serial.write(status);
+  frame_length = 0;
+  frame_binary = false;
+}
+
+/**** parseBinary **** checks a complete binary frame and applies its payload ****/
+
+inline uint8_t parseBinary(uint8_t *bytes, uint8_t total) {
+  uint8_t crc = 0;
+  for (uint8_t i = 1; i < total - 1; i++) crc = _crc8_ccitt_update(crc, bytes[i]);
+  if (crc != bytes[total - 1]) return STATUS_CHECKSUM;
+  if (bytes[1] != PROTOCOL_VERSION) return STATUS_VERSION;
+
+  uint8_t length = bytes[4];
+  uint8_t *payload = bytes + HEADER_SIZE;
+  bool recalibrate = false;
+  switch (bytes[3]) {
+
+    // fixed size fields: one setpoint letter, then a little endian float
+    case CMD_SETPOINTS:
+      if (length % 5 != 0) return STATUS_COMMAND;
+      for (uint8_t i = 0; i < length; i += 5) {
+        float val;
+        memcpy(&val, payload + i + 1, 4);           // AVR floats are IEEE 754, little endian
+        recalibrate = applySetpoint(payload[i], val) || recalibrate;
+      }
+      finishSetpoints(recalibrate);
+      return STATUS_OK;
+
+    // little endian 12-bit samples, two bytes each
+    case CMD_WAVE:
+    case CMD_STREAM:
+      if (length % 2 != 0) return STATUS_COMMAND;
+      for (uint8_t i = 0; i < length; i += 2) {
+        uint16_t sample = (payload[i] | (payload[i + 1] << 8)) & 0x0FFF;
+        bool stored = (bytes[3] == CMD_WAVE) ? storeWaveSample(sample) : queueStreamSample(sample);
+        if (!stored) return STATUS_FULL;
+      }
+      return STATUS_OK;
+  }
+  return STATUS_COMMAND;
+}
+
+/***** applySetpoint ***** applies one setpoint, true if wave must be recalibrated *****/
+
+inline bool applySetpoint(char key, float val) {
+  switch (key) {                                    // letter signals what float means
+    case 'A': power = round(4095 * (val / 100.0)); return true;
+    case 'T': threshold = val / 100.0; return true;
+    case 'P': tot_micro = round(val * 1e3); increment = pow(tot_micro, 2) / (5e9) + 0.001; return true;
+    case 'D': off_micro = round(val * 1e3); return true;
+    case 'C': preset_divisor = (val >= 1.0) ? val : 1.0; preset_given = true; return true;
+    case 'W': wave_rx_micro = val; wave_rx_length = 0; wave_length = 0; return false;
+    case 'N': wave_rx_count = min((uint16_t)val, WAVE_SIZE); return false;
+    case 'S': stream_micro = val; stream_count = 0; stream_head = 0; return false;
+  }
+  return false;
+}
+
+/*** finishSetpoints *** restarts calibration once all setpoints of a frame are applied ***/
+
+inline void finishSetpoints(bool recalibrate) {
+  if (!recalibrate) return;
+  if (!preset_given) preset_divisor = 1.0;          // no cached divisor for new settings
+  preset_given = false;
+  needs_calibrating = true;                         // set calibration flag
+  divisor = preset_divisor;                         // reset wave divisor
+}
+
+/***** receiveSamples ***** stores samples sent as three hex digits each *****/
+
+inline bool receiveSamples(char *hex, bool (*store)(uint16_t)) {
+  while (hex[0] && hex[1] && hex[2]) {
+    char digits[4] = {hex[0], hex[1], hex[2], '\0'};
+    if (!store(strtol(digits, NULL, 16) & 0x0FFF)) return false;
+    hex += 3;
+  }
+  return true;
+}
+
+/***** storeWaveSample ***** stores next sample of a wave table being uploaded *****/
+
+inline bool storeWaveSample(uint16_t sample) {
+  if (wave_rx_length >= wave_rx_count) return false;
+  wave_table[wave_rx_length++] = sample;
+
+  // table only starts playing once every announced sample has arrived
+  if (wave_rx_length == wave_rx_count && wave_rx_count > 1 && wave_rx_micro > 0) {
+    wave_sample_micro = wave_rx_micro;
+    wave_length = wave_rx_count;
+    wave_index = 0;
+    wave_next = micros();
+  }
+  return true;
+}
+
+/***** queueStreamSample ***** queues a power value to be applied by checkStream *****/
+
+inline bool queueStreamSample(uint16_t sample) {
+  if (stream_micro == 0 || stream_count >= STREAM_SIZE) return false;
+  if (stream_count == 0) stream_next = micros();    // (re)start schedule after running dry
+  stream[(stream_head + stream_count) % STREAM_SIZE] = sample;
+  stream_count++;
+  return true;
+}
+
+/***** checkStream ***** applies the next streamed power value once it is due *****/
+
+// values are applied on a micros() schedule rather than a hardware timer, as
+// all timers are taken; when the stream runs dry the last value is held
+inline void checkStream() {
+  if (stream_count == 0) return;
+
+  // interlock cut the power, do not let the stream turn it back on
+  if (constant_warning) {
+    stream_count = 0;
+    stream_micro = 0;
+    return;
   }
+
+  if ((long)(micros() - stream_next) < 0) return;
+  stream_next += stream_micro;
+  if ((long)(micros() - stream_next) > 0) stream_next = micros();
+
+  power = stream[stream_head];
+  stream_head = (stream_head + 1) % STREAM_SIZE;
+  stream_count--;
+  if (modeOfModulation == 0) needs_calibrating = true;  // none() writes new power to DAC
 }
 
 /***** checkModulationMode ****** detects the mode of modulation of laser *****/
@@ -307,7 +569,7 @@ inline void none() {
 inline void sine() {
   delayMicroseconds(16);    // necessary for Pi to settle pins before reading
   needs_calibrating = true; // wave will need to be calibrated on first start
-  divisor = 1.0;            // reset divisor, this will be calibrated later
+  divisor = preset_divisor; // reset divisor, this will be calibrated later
   waiting = true;
   timer = micros();
 
@@ -431,7 +693,7 @@ inline void square() {
 inline void triangle() {
   delayMicroseconds(16);    // necessary for Pi to settle pins before reading
   needs_calibrating = true; // wave will need to be calibrated on first start
-  divisor = 1.0;            // reset divisor, this will be calibrated later
+  divisor = preset_divisor; // reset divisor, this will be calibrated later
   waiting = true;
   timer = micros();
 
@@ -482,7 +744,7 @@ inline void triangle() {
 inline void sawtooth() {
   delayMicroseconds(16);    // necessary for Pi to settle pins before reading
   needs_calibrating = true; // wave will need to be calibrated on first start
-  divisor = 1.0;            // reset divisor, this will be calibrated later
+  divisor = preset_divisor; // reset divisor, this will be calibrated later
   waiting = true;
   timer = micros();
 
@@ -528,6 +790,58 @@ inline void sawtooth() {
   }
 }
 
+/******************* MODE 101: Arbitrary wave modulation *********************/
+
+// plays the uploaded sample table on a fixed micros() schedule, so the wave
+// period does not depend on how long the loop takes and needs no calibration
+// (all timers are taken by millis and the RGB LED, so none is used here)
+inline void arbitrary() {
+  if (modeOfModulation != 5) return;
+  delayMicroseconds(16);    // necessary for Pi to settle pins before reading
+  needs_calibrating = true; // not a calibration, but reusing bool to save memory
+  waiting = false;
+  wave_index = 0;
+  wave_next = micros();
+
+  while (modeOfModulation == 5) {
+    check();
+
+    // if power is zero or there is no table, set DAC to 0 once, LED off
+    if (power == 0 || wave_length == 0) {
+      genericOff();
+      continue;
+    }
+
+    // do not proceede with the wave if we need to delay
+    if (waiting) {
+      if ((micros() - timer) <= off_micro) continue;
+      waiting = false;
+      wave_index = 0;
+      wave_next = micros();
+    }
+
+    // play the next sample once it is due, schedule is kept from drifting by
+    // advancing it a sample at a time, unless we have fallen a full sample behind
+    if ((long)(micros() - wave_next) < 0) continue;
+    wave_next += wave_sample_micro;
+    if ((long)(micros() - wave_next) > 0) wave_next = micros();
+    uint16_t val = ((uint32_t)wave_table[wave_index] * power) / 4095;
+    writeToDAC(val);
+    if (modeOfOperation == 1) trigger(val);
+    needs_calibrating = true;
+    setRGB('B');
+
+    // after the last sample, wait for the delay between cycles (if any)
+    if (++wave_index >= wave_length) {
+      wave_index = 0;
+      if (off_micro != 0) {
+        waiting = true;
+        timer = micros();
+      }
+    }
+  }
+}
+
 /**************************** MODE 111: Pulse mode ****************************/
 
 // basically almost the same as square wave mode, with some very subtle changes
@@ -636,7 +950,7 @@ void setup() {
   writeToDAC(0);   // Set DAC to known state ASAP
 
   // Wait until serial becomes available
-  Serial.begin(9600);
+  Serial.begin(SERIAL_BAUDRATE);
   while (!Serial) {
     ;
   }
@@ -669,6 +983,7 @@ void loop() {
     case 2: if (tot_micro != 0 || modeOfOperation == 2) square();
     case 3: if (tot_micro != 0) triangle();
     case 4: if (tot_micro != 0) sawtooth();
+    case 5: if (wave_length != 0) arbitrary();
     case 7: if (tot_micro != 0 || modeOfOperation == 2) pulse();
   }
 }
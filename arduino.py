@@ -7,56 +7,387 @@
 ###                                                                         ###
 ###############################################################################
 
-import RPi.GPIO as GPIO
-import subprocess
+from backend import GPIO
+import os
+import termios
 import serial
 import time
+import config
+import shadow
+import backend
+import devices
+import waveform
+import calibration
+import protocol
+import budget
+from scheduler import DeviceScheduler, SAFETY, WRITE, phase
 
 ## SET UP GPIOs ###############################################################
 
-GPIO.setmode(GPIO.BCM)
-GPIO.setwarnings(False)
-GPIO.setup(25, GPIO.OUT)                ## Arduino reset pin
-GPIO.setup([22, 27, 17], GPIO.OUT)      ## Modulation mode switch signals
-GPIO.setup([16, 26], GPIO.OUT)          ## Operation mode switch signals
+def setup():
+    '''Configures the GPIOs used to reset the Arduino and switch its modes'''
+
+    pins = devices.settings()           ## of the current device
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setwarnings(False)
+    GPIO.setup(pins['reset_pin'], GPIO.OUT)         ## Arduino reset pin
+    GPIO.setup(pins['mode_pins'], GPIO.OUT)         ## Modulation mode switch signals
+    GPIO.setup(pins['operation_pins'], GPIO.OUT)    ## Operation mode switch signals
 
 ## RESET ARDUINO ##############################################################
 
+def disableHangup(port):
+    '''
+    Clears HUPCL on a TTY (as "stty -hupcl" does), so that closing the port
+    does not drop DTR, which would reset the Arduino
+    '''
+    fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    try:
+        attributes = termios.tcgetattr(fd)
+        attributes[2] &= ~termios.HUPCL     ## control flags
+        termios.tcsetattr(fd, termios.TCSANOW, attributes)
+    finally:
+        os.close(fd)
+
 def reset():
     '''RESETS ARDUINO TO KNOWN STATE AND PREPARES FOR COMMUNICATION'''
 
+    setup()
     try:
-        subprocess.run("stty -F /dev/ttyACM0 -hupcl", shell=True, check=True)
-    except subprocess.CalledProcessError as e:
+        disableHangup(link.port)
+    except (OSError, termios.error) as e:
         return (['35', str(e)])
 
-    GPIO.output([22, 27, 17], GPIO.LOW)
-    GPIO.output([16, 26], GPIO.LOW)
+    pins = devices.settings()
+    GPIO.output(pins['mode_pins'], GPIO.LOW)
+    GPIO.output(pins['operation_pins'], GPIO.LOW)
 
-    GPIO.output(25, GPIO.HIGH)
+    GPIO.output(pins['reset_pin'], GPIO.HIGH)
     time.sleep(0.1)
-    GPIO.output(25, GPIO.LOW)
+    GPIO.output(pins['reset_pin'], GPIO.LOW)
 
-## PRIVATE FUNCTIONS ##########################################################
+    link.registers.reset(shadow.arduino_defaults)
+
+## PERSISTENT LINK ############################################################
+
+def supersedes(off, frame):
+    '''Returns whether a frame queued before switching off must not be sent'''
+
+    return any(word[:1] in ('A', 'S', 'Q') for word in frame.split())  ## power
+
+class ArduinoLink:
+    '''
+    Persistent serial channel to the Arduino, owned by a single I/O thread
+
+        - the port is opened once and kept open between frames
+        - callers queue frames with the link's scheduler (in the SAFETY or
+          WRITE lane, see scheduler.py) and wait for their acknowledgement
+        - all frames queued at the same time are written back to back, most
+          urgent first, then their acknowledgements are read in order
+        - a frame is a line of space separated setpoints, terminated by the
+          end-of-frame marker (newline) which the sketch parses byte by byte,
+          or the same setpoints packed into a binary frame with a sequence
+          number and checksum (see protocol.py), acknowledged in 3 bytes
+        - shadowed Arduino registers are invalidated when a frame fails, as
+          it is then unknown which setpoints the sketch has applied
+        - lines the sketch sends on its own (reports, such as "CAL ...") are
+          passed to self.listeners, whether they arrive while waiting for an
+          acknowledgement or while the link is idle
+        - while the device node of the port is gone (see hotplug.py), every
+          frame fails at once, and the I/O thread closes the port
+    '''
+
+    def __init__(self, port=config.ARDUINO_PORT,
+                       baudrate=config.ARDUINO_BAUDRATE,
+                       timeout=config.ARDUINO_TIMEOUT,
+                       registers=None,
+                       framing=config.ARDUINO_PROTOCOL,
+                       name='arduino'):
+        '''
+        Init function for Arduino link (the I/O thread starts on first use)
+
+        Arguments:
+            port <str> - path to the TTY device of the Arduino
+            baudrate <int> - baud rate, must match the sketch
+            timeout <float> - seconds to wait for each acknowledgement
+            registers <ShadowRegisters> - shadow to invalidate on failures
+                                          (None: a shadow of its own)
+            framing <str> - 'ascii' (readable) or 'binary' (compact) frames
+            name <str> - name of Arduino in metrics, traces and I/O stats
+
+        Returns:
+            none
+        '''
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.registers = shadow.ShadowRegisters() if registers is None else registers
+        self.name = name
+        self.ser = None
+        self.scheduler = DeviceScheduler(name, self.exchange, batch=None,
+                                         idle=self.drain, idle_period=timeout,
+                                         supersedes=supersedes)
+        self.listeners = []             ## called with every report line
+        self.framing = framing
+        self.encode = protocol.encoders[framing]
+        self.sequence = 0               ## of last binary frame sent
+        self.present = True             ## False while unplugged
+
+    def unplug(self):
+        '''Fails frames to an Arduino that was unplugged at once, until replug()'''
+
+        self.present = False
+        self.registers.invalidate('arduino')
+        with self.scheduler.condition:  ## wake the I/O thread to close the port,
+            self.scheduler.condition.notify()   ## freeing its name for the kernel
+
+    def replug(self):
+        '''Lets frames through again, opening the port afresh'''
+
+        self.close()                    ## only the I/O thread uses it while unplugged
+        self.present = True
+
+    def send(self, frame, lane=WRITE):
+        '''
+        Queues a frame for the I/O thread and waits for its acknowledgement
+
+        Arguments:
+            frame <str> - space separated setpoints, e.g. "A50.0 P100 D0"
+            lane <int> - SAFETY for frames that switch the laser off, or WRITE
+
+        Returns:
+            Error codes (see local file errors.txt)
+        '''
+        return self.scheduler.call(frame, lane)
+
+    def open(self):
+        '''Opens the serial port if it is not open already'''
+
+        if self.ser is not None and self.ser.is_open: return
+        start = time.perf_counter()
+        self.ser = serial.Serial(port=self.port,
+                                 baudrate=self.baudrate,
+                                 timeout=self.timeout,
+                                 write_timeout=self.timeout,
+                                 dsrdtr=False)
+        self.ser.reset_input_buffer()
+        phase(self.name, 'open', start)
+
+    def close(self):
+        '''Closes the serial port, ignoring any errors while doing so'''
+
+        if self.ser is not None:
+            try: self.ser.close()
+            except Exception: pass
+        self.ser = None
+
+    def readAck(self, sequence):
+        '''
+        Reads the acknowledgement of one frame, passing on any reports before it
+
+        Arguments:
+            sequence <int> - sequence number of frame (binary framing only)
+
+        Returns:
+            Error codes (see local file errors.txt), 32 if the acknowledgement
+            is not complete within self.timeout (or the deadline, if sooner)
+        '''
+        if self.framing == 'ascii':
+            while True:
+                if budget.limit(self.ser, self.timeout) == 0.0: return '32'
+                response = self.ser.readline()
+                if not response.startswith(b'CAL '): break
+                self.report(response)
+            if response == b'OK\r\n': return '00'
+            if response == b'' or not response.endswith(b'\n'): return '32'
+            return ['34', str(response)]
+
+        ## acknowledgements of earlier frames (e.g. ones that timed out) are
+        ## skipped by their sequence number, rather than taken for this one
+        while True:
+            if budget.limit(self.ser, self.timeout) == 0.0: return '32'
+            first = self.ser.read(1)
+            if first == b'': return '32'
+            if first == b'C': self.report(first + self.ser.readline())
+            if first[0] != protocol.ACK_SYNC: continue
+            response = self.ser.read(protocol.ACK_SIZE - 1)
+            if len(response) < protocol.ACK_SIZE - 1: return '32'
+            if response[0] == sequence: break
+        if response[1] != 0x00: return ['34', protocol.statuses.get(response[1], 'unknown status')]
+        return '00'
+
+    def report(self, line):
+        '''Passes a report line from the sketch to every listener'''
+
+        for listener in self.listeners:
+            listener(line.decode(encoding='ascii', errors='replace').strip())
+
+    def drain(self):
+        '''Reads reports that arrived while the link was idle'''
+
+        if not self.present: self.close()
+        if self.ser is None: return
+        try:
+            budget.limit(self.ser, self.timeout)    ## undo a shortened timeout
+            while self.ser.in_waiting:
+                line = self.ser.readline()
+                if line.startswith(b'CAL '): self.report(line)
+        except serial.SerialException:
+            self.close()
+
+    def exchange(self, frames):
+        '''
+        Writes all frames in one go, then reads one acknowledgement per frame
+
+        Arguments:
+            frames <list> - frames (without end-of-frame marker) to send
+
+        Returns:
+            List of error codes, one per frame
+        '''
+        if not self.present:
+            self.close()
+            return [['31', 'Arduino is unplugged, waiting for it to return']] * len(frames)
+        sequences = [(self.sequence + 1 + i) & 0xFF for i in range(len(frames))]
+        self.sequence = (self.sequence + len(frames)) & 0xFF
+        try:
+            self.open()
+            budget.limit(self.ser, self.timeout)    ## of the latest request
+            start = time.perf_counter()
+            self.ser.write(b''.join(self.encode(frame, sequence)
+                                    for frame, sequence in zip(frames, sequences)))
+            written = phase(self.name, 'write', start)
+        except serial.SerialTimeoutException as e:
+            self.registers.invalidate('arduino')
+            return [['32', str(e)]] * len(frames)
+        except serial.SerialException as e:
+            self.close()
+            self.registers.invalidate('arduino')
+            return [['31', str(e)]] * len(frames)
+        except Exception as e:
+            self.registers.invalidate('arduino')
+            return [['30', str(e)]] * len(frames)
+
+        results = []
+        for sequence in sequences:
+            try:
+                results.append(self.readAck(sequence))
+            except serial.SerialException as e:
+                self.close()
+                self.registers.invalidate('arduino')
+                return results + [['31', str(e)]] * (len(frames) - len(results))
+        phase(self.name, 'read', written)
+
+        if any(result != '00' for result in results):
+            self.registers.invalidate('arduino')
+            if self.ser is not None:
+                self.ser.reset_input_buffer()   ## drop acknowledgements out of step
+        return results
+
+## CALIBRATION CACHE ##########################################################
+
+## modulation modes that calibrate their divisor, by number used in the sketch
+calibrated_modes = {1: 'sine', 3: 'triangle', 4: 'sawtooth'}
+
+def recordCalibration(line):
+    '''Stores a "CAL <mode> <period us> <power> <divisor>" report in the cache'''
 
-def sendSerial(string, path='/dev/ttyACM0'):
     try:
-        with serial.Serial(port = path,
-                           baudrate = 9600,
-                           timeout = 5,
-                           dsrdtr = False) as ser:
-            ser.write((string + ' \r\n').encode(encoding='ascii'))
-            time.sleep(0.1)
-            response = ser.readline()
-            if response == b'OK\r\n':
-                return('00')
-            elif response == b'':
-                return('32')
-            else: return(['34', str(response)])
-    except serial.SerialException as e:
-        return(['31', str(e)])
-    except Exception as e:
-        return(['30', str(e)])
+        mode, period, power, divisor = line.split()[1:]
+        mode = calibrated_modes[int(mode)]
+        calibration.cache.record(mode, int(period), int(power), float(divisor))
+    except (ValueError, KeyError):
+        pass                            ## malformed report, nothing to learn
+
+## PERSISTENT LINKS ###########################################################
+
+def newLink(name):
+    '''Creates link to the Arduino of a device, reporting to its own cache'''
+
+    created = ArduinoLink(port=backend.port('arduino', name),
+                          registers=shadow.registers.of(name),
+                          name=name + '.arduino')
+    created.listeners.append(devices.bound(name, recordCalibration))
+    return created
+
+## link to the Arduino of the current device (see devices.py), opened on first use
+link = devices.PerDevice(newLink)
+
+def presetDivisor(mode=None, period=None, power=None):
+    '''
+    Looks up divisor the sketch should start calibrating from
+
+    Arguments:
+        mode <str> - modulation mode (shadowed mode if None)
+        period <float> - milliseconds of period of one cycle (shadowed if None)
+        power <float> - laser power as a percentage (shadowed if None)
+
+    Returns:
+        Divisor <float>, or None if settings are unknown or not cached
+    '''
+
+    if mode is None: mode = link.registers.get('modulation')
+    if period is None: period = link.registers.get('period')
+    if power is None: power = link.registers.get('power')
+    if mode not in calibrated_modes.values() or period is None or power is None:
+        return None
+
+    ## same rounding as the sketch, so keys match what it reports
+    return calibration.cache.lookup(mode, int(period * 1e3 + 0.5),
+                                    int(4095 * (power / 100.0) + 0.5))
+
+## PRIVATE FUNCTIONS ##########################################################
+
+def sendSerial(string, lane=WRITE):
+    '''Sends one frame over the shared link, returns error codes'''
+
+    return(link.send(string, lane))
+
+def sendSetpoints(power=None, threshold=None, period=None, delay=None, divisor=None):
+    '''
+    Sends several setpoints in one frame, acknowledged once for all of them
+
+    Arguments:
+        power <float> [0.0 - 100.0] - laser power as a percentage
+        threshold <float> [0.0 - 100.0] - camera trigger threshold percentage
+        period <float> [0.0 - 3,600,000.0] - milliseconds of period of one cycle
+        delay <float> [0.0 - 3,600,000.0] - milliseconds of delay between cycles
+        divisor <float> - divisor to start calibrating from (from cache)
+        (setpoints left as None are not sent)
+
+    Returns:
+        Error codes (see local file errors.txt)
+    '''
+
+    fields = [(key, value) for key, value in
+              (('A', power), ('T', threshold), ('P', period), ('D', delay))
+              if value is not None]
+    if len(fields) == 0: return('01')
+    if divisor is not None: fields.append(('C', round(divisor, 4)))
+    lane = SAFETY if power == 0 else WRITE     ## switching off goes first
+    return(sendSerial(' '.join(key + str(value) for key, value in fields), lane))
+
+def uploadWaveform(shape, period):
+    '''
+    Uploads a precomputed table of one period of a wave for arbitrary mode
+
+    Arguments:
+        shape <str> - name of wave shape, see waveform.shapes
+        period <float> - milliseconds of period of one cycle
+
+    Returns:
+        Error codes (see local file errors.txt)
+    '''
+
+    computed = waveform.table(shape, period)
+    if computed is None: return('25')
+
+    ## frames are sent one at a time, as the sketch may only read serial once
+    ## per period in other modes and its receive buffer holds a single frame
+    for frame in waveform.frames(*computed):
+        code = sendSerial(frame)
+        if code != '00': return(code)
+    return('00')
 
 ## PUBLIC FUNCTIONS ###########################################################
 
@@ -71,7 +402,46 @@ def setLaserPower(pwr):
         Error codes (see local file errors.txt)
     '''
 
-    return(sendSerial("A" + str(pwr)))
+    return(sendSetpoints(power=pwr, divisor=presetDivisor(power=pwr)))
+
+
+def streamPower(values, rate, cancel=None):
+    '''
+    Streams a sequence of power values, applied by the sketch at a fixed rate
+
+    Arguments:
+        values <list of int> [0 - 4095] - 12-bit laser powers, in order
+        rate <float> - values applied per second
+        cancel <threading.Event> - stops the stream at once when set
+
+    Returns:
+        Error codes (see local file errors.txt)
+    '''
+
+    interval = int(round(1e6 / rate)) if rate > 0 else 0
+    if interval < config.ARDUINO_STREAM_MIN_US or len(values) == 0: return('25')
+    code = sendSerial('S' + str(interval))
+    if code != '00': return(code)
+    link.registers.set('power', None)   ## changing until stream has finished
+
+    ## keep the sketch's buffer topped up, without sending more than fits in
+    ## it, by estimating how many values it has applied since the first one
+    chunk = config.ARDUINO_STREAM_CHUNK
+    start = time.monotonic()
+    for sent in range(0, len(values), chunk):
+        part = values[sent:sent+chunk]
+        queued = sent - (time.monotonic() - start) * rate
+        if queued + len(part) > config.ARDUINO_STREAM_BUFFER:
+            wait = (queued + len(part) - config.ARDUINO_STREAM_BUFFER) / rate
+            if cancel is not None: cancel.wait(wait)
+            else: time.sleep(wait)
+        if cancel is not None and cancel.is_set():
+            return(sendSerial('S0', SAFETY))    ## drop values queued in the sketch
+        code = sendSerial('Q' + ''.join('%03X' % (int(value) & 0x0FFF) for value in part))
+        if code != '00': return(code)  ## stream stopped, e.g. by the interlock
+
+    link.registers.set('power', round(values[-1] * 100.0 / 4095, 2))
+    return('00')
 
 
 def setOperationMode(mode):
@@ -88,9 +458,10 @@ def setOperationMode(mode):
         none
     '''
 
-    if mode == 'gated':  GPIO.output([16, 26], (GPIO.HIGH, GPIO.LOW))
-    if mode == 'master': GPIO.output([16, 26], (GPIO.LOW,  GPIO.HIGH))
-    if mode == 'indep':  GPIO.output([16, 26], (GPIO.HIGH, GPIO.HIGH))
+    pins = devices.settings()['operation_pins']
+    if mode == 'gated':  GPIO.output(pins, (GPIO.HIGH, GPIO.LOW))
+    if mode == 'master': GPIO.output(pins, (GPIO.LOW,  GPIO.HIGH))
+    if mode == 'indep':  GPIO.output(pins, (GPIO.HIGH, GPIO.HIGH))
 
     
 def setTriggerThreshold(pwr):
@@ -104,10 +475,10 @@ def setTriggerThreshold(pwr):
         Error codes (see local file errors.txt)
     '''
 
-    return(sendSerial("T" + str(pwr)))
+    return(sendSetpoints(threshold=pwr, divisor=presetDivisor()))
 
 
-def setModulationMode(mode, period, delay):
+def setModulationMode(mode, period, delay, shape='sine'):
     '''
     Sets modulation mode of laser via GPIO and Serial port
 
@@ -119,18 +490,61 @@ def setModulationMode(mode, period, delay):
             triangle: laser is modulated to produce a triangle wave of given period
             sawtooth: laser is modulated to produce a sawtooth wave of given period
             pulse: laser repeatedly pulses for specified time (period) then waits (delay)
+            arbitrary: laser plays a table of the given shape, computed here
         period <float> [0.0 - 3,600,000.0] - milliseconds of period of one cycle
         delay <float> [0.0 - 3,600,000.0] - milliseconds of delay between cycles
+        shape <str> - shape of wave in arbitrary mode, see waveform.shapes
 
     Returns:
         Error codes (see local file errors.txt)
     '''
 
-    if mode == 'none':     GPIO.output([22, 27, 17], (GPIO.LOW,  GPIO.LOW,  GPIO.LOW))
-    if mode == 'sine':     GPIO.output([22, 27, 17], (GPIO.LOW,  GPIO.LOW,  GPIO.HIGH))
-    if mode == 'square':   GPIO.output([22, 27, 17], (GPIO.LOW,  GPIO.HIGH, GPIO.LOW))
-    if mode == 'triangle': GPIO.output([22, 27, 17], (GPIO.LOW,  GPIO.HIGH, GPIO.HIGH))
-    if mode == 'sawtooth': GPIO.output([22, 27, 17], (GPIO.HIGH, GPIO.LOW,  GPIO.LOW))
-    if mode == 'pulse':    GPIO.output([22, 27, 17], (GPIO.HIGH, GPIO.HIGH, GPIO.HIGH))
+    ## table must be in place before the sketch switches to arbitrary mode
+    if mode == 'arbitrary':
+        code = uploadWaveform(shape, period)
+        if code != '00': return(code)
+
+    setModulationPins(mode)
+    return(sendSetpoints(period=period, delay=delay,
+                         divisor=presetDivisor(mode, period)))
+
+
+def setModulationPins(mode):
+    '''
+    Selects modulation mode of the sketch via GPIO, without sending setpoints
+
+    Arguments:
+        mode <str> - modulation mode, see setModulationMode
+
+    Returns:
+        none
+    '''
+
+    pins = devices.settings()['mode_pins']
+    if mode == 'none':     GPIO.output(pins, (GPIO.LOW,  GPIO.LOW,  GPIO.LOW))
+    if mode == 'sine':     GPIO.output(pins, (GPIO.LOW,  GPIO.LOW,  GPIO.HIGH))
+    if mode == 'square':   GPIO.output(pins, (GPIO.LOW,  GPIO.HIGH, GPIO.LOW))
+    if mode == 'triangle': GPIO.output(pins, (GPIO.LOW,  GPIO.HIGH, GPIO.HIGH))
+    if mode == 'sawtooth': GPIO.output(pins, (GPIO.HIGH, GPIO.LOW,  GPIO.LOW))
+    if mode == 'arbitrary': GPIO.output(pins, (GPIO.HIGH, GPIO.LOW,  GPIO.HIGH))
+    if mode == 'pulse':    GPIO.output(pins, (GPIO.HIGH, GPIO.HIGH, GPIO.HIGH))
+
+
+def setSetpoints(power=None, threshold=None, period=None, delay=None, mode=None):
+    '''
+    Sets several setpoints at once, in a single frame (e.g. by APPLY)
+
+    Arguments:
+        power <float> [0.0 - 100.0] - laser power as a percentage
+        threshold <float> [0.0 - 100.0] - camera trigger threshold percentage
+        period <float> [0.0 - 3,600,000.0] - milliseconds of period of one cycle
+        delay <float> [0.0 - 3,600,000.0] - milliseconds of delay between cycles
+        mode <str> - modulation mode the setpoints are for (shadowed if None)
+        (setpoints left as None are not sent)
+
+    Returns:
+        Error codes (see local file errors.txt)
+    '''
 
-    return(sendSerial("P" + str(period) + ' ' + "D" + str(delay)))
+    return(sendSetpoints(power, threshold, period, delay,
+                         presetDivisor(mode, period, power)))
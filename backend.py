@@ -0,0 +1,94 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Selects real or simulated hardware, depending on config.BACKEND
+
+##### IMPORTS #################################################################
+
+import os                               ## paths of simulated ports
+from threading import Lock              ## backend is loaded by the first user
+import config                           ## backend selection and ports
+
+##### BACKENDS ################################################################
+
+class HardwareBackend:
+    '''Real GPIO of the Raspberry Pi, and the serial ports in config.DEVICES'''
+
+    def __init__(self):
+        import RPi.GPIO                 ## only importable on a Raspberry Pi
+        self.GPIO = RPi.GPIO
+        self.ports = {name: {'laser'   : settings['laser_port'],
+                             'arduino' : settings['arduino_port']}
+                      for name, settings in config.DEVICES.items()}
+
+class SimulatedBackend:
+    '''
+    Fake GPIO of simulator.py, and a fake laser and Arduino (on pseudo-
+    terminals) for every device in config.DEVICES
+
+        - ports are stable links to the pseudo-terminals, in a directory of
+          their own (as /dev/serial/by-id/ is for real adapters), so that
+          fakes can be unplugged and plugged back in
+    '''
+
+    def __init__(self):
+        import simulator
+        import tempfile, shutil, atexit
+        self.GPIO = simulator.FakeGPIO()    ## stand-in for RPi.GPIO
+        self.links = tempfile.mkdtemp(prefix='i14_laser-')
+        atexit.register(shutil.rmtree, self.links, True)
+        self.fakes = {name: {kind: fake(link=os.path.join(self.links, name + '-' + kind))
+                             for kind, fake in [('laser', simulator.FakeBioRay),
+                                                ('arduino', simulator.FakeArduino)]}
+                      for name in config.DEVICES}
+        self.ports = {name: {kind: fake.port for kind, fake in fakes.items()}
+                      for name, fakes in self.fakes.items()}
+        self.laser_device = self.fakes[config.DEFAULT_DEVICE]['laser']
+        self.arduino_device = self.fakes[config.DEFAULT_DEVICE]['arduino']
+
+## backend classes by name, as used in config.BACKEND (more can be added)
+backends = {
+    'hardware'  : HardwareBackend,
+    'simulated' : SimulatedBackend,
+}
+
+##### BACKEND SELECTION #######################################################
+
+if config.BACKEND not in backends:
+    raise ValueError('Unknown backend: ' + str(config.BACKEND))
+
+selected = None                         ## backend in use, once loaded
+lock = Lock()
+
+def load():
+    '''
+    Returns the backend selected by config.BACKEND, loading it on first use
+
+        - importing this module touches no hardware, so the server can bind
+          its socket (and any module can be imported on a machine without
+          GPIO) before the backend is needed
+    '''
+    global selected
+    if selected is None:
+        with lock:
+            if selected is None: selected = backends[config.BACKEND]()
+    return selected
+
+def port(kind, name=config.DEFAULT_DEVICE):
+    '''Returns serial port of the laser or Arduino (kind) of a device'''
+
+    return load().ports[name][kind]
+
+class lazyGPIO:
+    '''Forwards everything to the GPIO of the backend, loading it on first use'''
+
+    def __getattr__(self, name):
+        return getattr(load().GPIO, name)
+
+GPIO = lazyGPIO()                       ## use as the RPi.GPIO module
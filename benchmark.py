@@ -0,0 +1,535 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Benchmark suite for the controller, run against simulated hardware
+## Usage: python3 benchmark.py [results.json]
+##
+## Results are printed and written as JSON (default: benchmark.json) so that
+## runs can be compared to catch performance regressions.
+
+##### IMPORTS #################################################################
+
+import os                               ## location of server for startup runs
+import sys                              ## command line arguments
+import subprocess                       ## server started in its own process
+import json                             ## machine readable results
+import time                             ## monotonic clock for measurements
+import socket                           ## clients of the benchmarked server
+import platform                         ## environment of the benchmark run
+import asyncio                          ## for running the async server
+from threading import Thread            ## servers and clients run in threads
+import serial                           ## for the open-per-call reference
+import config                           ## selects simulated backend
+
+config.BACKEND = 'simulated'            ## must happen before hardware imports
+
+import simulator                        ## simulated hardware
+import backend                          ## simulated devices used by server
+from BioRay import LaserSession         ## persistent laser session
+import protocol                         ## Arduino frame encodings
+
+##### HELPERS #################################################################
+
+def measure(function, repeats):
+    '''Calls function repeatedly, returns sorted list of latencies (seconds)'''
+
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - start)
+    return sorted(latencies)
+
+def summary(latencies, elapsed=None):
+    '''Returns dict with median, 99th percentile (ms) and rate (per second)'''
+
+    result = {
+        'p50_ms' : latencies[len(latencies)//2] * 1e3,
+        'p99_ms' : latencies[min(len(latencies)-1, int(len(latencies)*0.99))] * 1e3,
+    }
+    if elapsed is None: elapsed = sum(latencies)
+    result['per_second'] = len(latencies) / elapsed
+    return result
+
+def report(name, result):
+    '''Prints one line of results'''
+
+    print('{0:<44} p50 {1:10.4f} ms   p99 {2:10.4f} ms   {3:10.0f} /s'.format(
+        name, result['p50_ms'], result['p99_ms'], result['per_second']))
+
+##### LASER SESSION ###########################################################
+
+def open_per_call(port, msg):
+    '''Reference implementation: opens the port and waits out the timeout'''
+
+    with serial.Serial(port=port, baudrate=115200, timeout=0.1) as ser:
+        ser.write((msg + '\r\n').encode(encoding='ascii'))
+        response = [line.decode(encoding='ascii').rstrip() for line in ser.readlines()]
+        if response[-1] == 'OK': return(['00', response[0]])
+        else: return(['33', response[-1]])
+
+def bench_laser(repeats=50):
+    '''Compares open-per-call serial access with the persistent session'''
+
+    fake = simulator.FakeBioRay()
+    session = LaserSession(port=fake.port)
+    results = {
+        'open_per_call' : summary(measure(
+            lambda: open_per_call(fake.port, 'SYST:STAT?'), repeats)),
+        'persistent_session' : summary(measure(
+            lambda: session.query('SYST:STAT?'), repeats)),
+    }
+    session.close()
+    for name, result in results.items(): report('laser: '+name, result)
+    return results
+
+##### ARDUINO FRAMING #########################################################
+
+def bench_framing(repeats=500):
+    '''Compares ASCII and binary framing of single power setpoints'''
+
+    from arduino import ArduinoLink
+    from shadow import ShadowRegisters
+    results = {}
+    for framing in ['ascii', 'binary']:
+        fake = simulator.FakeArduino(delay=0)
+        link = ArduinoLink(port=fake.port, registers=ShadowRegisters(), framing=framing)
+        results[framing] = summary(measure(lambda: link.send('A50.0'), repeats))
+
+        ## the pseudo-terminal has no baud rate, so report what the real
+        ## serial line allows for this frame size (10 bits per byte)
+        size = len(protocol.encoders[framing]('A50.0', 0))
+        results[framing]['bytes_per_frame'] = size
+        results[framing]['line_limit_per_second'] = config.ARDUINO_BAUDRATE / (10 * size)
+        report('arduino: '+framing+' setpoint', results[framing])
+
+        ## streamed power values, sent in chunks
+        chunk = 'Q' + '7FF' * config.ARDUINO_STREAM_CHUNK
+        size = len(protocol.encoders[framing](chunk, 0)) / config.ARDUINO_STREAM_CHUNK
+        results[framing]['stream_bytes_per_value'] = size
+        results[framing]['stream_line_limit_per_second'] = config.ARDUINO_BAUDRATE / (10 * size)
+    return results
+
+##### PARSER ##################################################################
+
+def bench_parser(repeats=2000):
+    '''Measures parser overhead on commands that need no serial I/O'''
+
+    import externalParser
+    from shadow import registers
+    registers.set('power', 40.0)        ## make the commands below no-ops
+    registers.set('mains', 'ON')
+
+    results = {}
+    for message in ['LASER_POWER 40', 'LASER_MAINS ON', '?LASER_POWER',
+                    'LASER_POWER abc']:
+        results[message] = summary(measure(
+            lambda: externalParser.parse(message.split(' ')), repeats))
+        report('parser: '+message, results[message])
+    return results
+
+##### METRICS #################################################################
+
+def bench_metrics(repeats=100000):
+    '''Measures cost of recording metrics, and of spans while tracing is off'''
+
+    import metrics, tracing
+    registry = metrics.Registry()       ## keep benchmark out of real metrics
+    labels = (('command', 'LASER_POWER'),)
+    code = (('code', '00'),)
+
+    def per_request():
+        start = time.perf_counter()
+        registry.count('return_codes', code)
+        registry.observe('command', labels, time.perf_counter() - start)
+
+    def untraced_span():
+        with tracing.span('command'): pass
+
+    results = {}
+    for name, function in [('count', lambda: registry.count('return_codes', code)),
+                           ('observe', lambda: registry.observe('command', labels, 0.00123)),
+                           ('per_request', per_request),
+                           ('untraced_span', untraced_span)]:
+        start = time.perf_counter()
+        for _ in range(repeats): function()
+        results[name + '_us'] = (time.perf_counter() - start) / repeats * 1e6
+        print('{0:<44} {1:10.3f} us per call'.format('metrics: '+name, results[name + '_us']))
+    return results
+
+##### STARTUP #################################################################
+
+## run in a fresh interpreter: imports the server, reports how long that took
+## and serves on the given port, with simulated hardware
+STARTUP_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import config
+config.BACKEND = 'simulated'
+import server
+server.log = lambda message: None
+server.host, server.port = '127.0.0.1', int(sys.argv[1])
+print(time.perf_counter() - start, flush=True)
+server.serveThreaded(server.reserveSocket())
+'''
+
+def bench_startup(repeats=5):
+    '''
+    Measures how soon a freshly started server accepts connections, and how
+    soon it carries out its first command (which needs the hardware)
+    '''
+    runs = {'import_s': [], 'listening_s': [], 'ready_s': []}
+    for _ in range(repeats):
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        address = probe.getsockname()
+        probe.close()
+
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, '-c', STARTUP_SCRIPT, str(address[1])],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stdout=subprocess.PIPE)
+        try:
+            while True:
+                try: client = benchClient(address)
+                except ConnectionRefusedError: time.sleep(0.001)
+                else: break
+            runs['listening_s'].append(time.perf_counter() - start)
+            reply = client.request('LASER_POWER 10')
+            while reply.startswith(b'!'):   ## interlock read as hardware starts
+                reply = client.receive()
+            runs['ready_s'].append(time.perf_counter() - start)
+            runs['import_s'].append(float(process.stdout.readline()))
+            client.close()
+        finally:
+            process.kill()
+            process.wait()
+
+    results = {name: sorted(values)[len(values)//2] for name, values in runs.items()}
+    for name, value in sorted(results.items()):
+        print('{0:<44} {1:10.4f} s (median)'.format('startup: '+name, value))
+    return results
+
+##### FRONT-END PROCESSES #####################################################
+
+PROCESSES_SCRIPT = '''
+import sys
+import config
+config.BACKEND = 'simulated'
+config.FRONTENDS = int(sys.argv[2])
+config.CALIBRATION_FILE = config.HISTORY_FILE = None
+config.DAEMON_SOCKET += '.bench'
+config.SNAPSHOT_FILE += '.bench'
+import server
+server.log = lambda message: None
+server.host, server.port = '127.0.0.1', int(sys.argv[1])
+if config.FRONTENDS > 0: server.serveProcesses(server.reserveSocket(), 'threaded')
+else: server.serveThreaded(server.reserveSocket())
+'''
+
+def bench_processes(frontends=(0, 2), clients=16, repeats=300):
+    '''
+    Measures fresh laser reads while many clients keep the server busy,
+    with everything in one process and with separate front-end processes
+    '''
+    results = {}
+    for count in frontends:
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        address = probe.getsockname()
+        probe.close()
+
+        process = subprocess.Popen([sys.executable, '-c', PROCESSES_SCRIPT,
+                                    str(address[1]), str(count)],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        try:
+            while True:
+                try: client = benchClient(address)
+                except ConnectionRefusedError: time.sleep(0.01)
+                else: break
+            reply = client.request('?LASER_POWER')  ## waits for the hardware
+            while reply.startswith(b'!'): reply = client.receive()
+
+            stop = []
+            loaded = [0] * clients
+
+            def loading(n):
+                connection = benchClient(address)
+                while not stop:
+                    connection.request('?STATE')
+                    loaded[n] += 1
+                connection.close()
+
+            threads = [Thread(target=loading, args=(n,)) for n in range(clients)]
+            for thread in threads: thread.start()
+            time.sleep(0.5)             ## let the load settle
+            latencies = []
+            start = time.perf_counter()
+            for _ in range(repeats):
+                sent = time.perf_counter()
+                reply = client.request('?LASER_STATUS !fresh')
+                while reply.startswith(b'!'): reply = client.receive()
+                latencies.append(time.perf_counter() - sent)
+            elapsed = time.perf_counter() - start
+            stop.append(True)
+            for thread in threads: thread.join()
+            reply = client.request('?METRICS')
+            while reply.startswith(b'!'): reply = client.receive()
+            serial = [word.rsplit('=', 1)[1].split('/') for word in
+                      reply.decode(encoding='ascii').split(' ')
+                      if word.startswith('serial{device="laser1.laser",phase="read"}')][0]
+            client.close()
+        finally:
+            process.kill()
+            process.wait()
+
+        results[str(count)] = summary(sorted(latencies))
+        results[str(count)]['load_per_second'] = sum(loaded) / elapsed
+        results[str(count)]['serial_read_p99_ms'] = float(serial[2])
+        report('processes: '+str(count)+' front-ends, fresh read', results[str(count)])
+    return results
+
+##### SERVER ##################################################################
+
+def start_server(mode):
+    '''Starts server in a background thread, returns (host, port)'''
+
+    import server
+    server.log = lambda message: None               ## keep output readable
+    server.host, server.port = '127.0.0.1', 0       ## any free port
+    serversocket = server.reserveSocket()
+    address = serversocket.getsockname()
+
+    def serving():
+        if mode == 'async':
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            server.asyncServer().serve(serversocket)
+        else:
+            server.serveThreaded(serversocket)
+    Thread(target=serving, daemon=True).start()
+    time.sleep(0.2)                     ## let the server start listening
+    return address
+
+class benchClient:
+    '''Blocking client that sends one command and waits for its reply'''
+
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.buffer = b''
+
+    def request(self, message):
+        self.sock.sendall((message + '\r\n').encode(encoding='ascii'))
+        return self.receive()
+
+    def receive(self):
+        while b'\r\n' not in self.buffer:
+            self.buffer += self.sock.recv(4096)
+        reply, self.buffer = self.buffer.split(b'\r\n', 1)
+        return reply
+
+    def close(self):
+        self.sock.close()
+
+## command types, each a function of the iteration number returning a message
+command_types = {
+    '?LASER_POWER'        : lambda i: '?LASER_POWER',
+    '?LASER_STATUS'       : lambda i: '?LASER_STATUS',
+    '?LASER_STATUS !fresh': lambda i: '?LASER_STATUS !fresh',
+    'LASER_POWER'         : lambda i: 'LASER_POWER ' + str(10 + i % 2),
+    'LASER_MAINS'         : lambda i: 'LASER_MAINS ' + ('ON', 'OFF')[i % 2],
+    'LASER_MODULATION'    : lambda i: 'LASER_MODULATION sine ' + str(100 + i % 2) + ' 0',
+}
+
+def serial_round_trips():
+    '''Returns number of transactions seen by the simulated devices so far'''
+
+    return {'laser'   : backend.load().laser_device.transactions,
+            'arduino' : backend.load().arduino_device.transactions}
+
+def bench_commands(address, mode, repeats=500):
+    '''Measures latency, rate and serial round trips of every command type'''
+
+    client = benchClient(address)
+    results = {}
+    for name, message in command_types.items():
+        before = serial_round_trips()
+        latencies = []
+        for i in range(repeats):
+            text = message(i)
+            start = time.perf_counter()
+            client.request(text)
+            latencies.append(time.perf_counter() - start)
+        after = serial_round_trips()
+        results[name] = summary(sorted(latencies))
+        results[name]['serial_round_trips'] = {
+            device: (after[device] - before[device]) / repeats for device in after}
+        report(mode+': '+name, results[name])
+    client.close()
+    return results
+
+def bench_scaling(address, mode, clients=(1, 2, 4, 8, 16, 32), repeats=200):
+    '''Measures total command rate with several clients sending at once'''
+
+    results = {}
+    for count in clients:
+        connections = [benchClient(address) for _ in range(count)]
+        latencies = [[] for _ in range(count)]
+
+        def sending(n):
+            for i in range(repeats):
+                start = time.perf_counter()
+                connections[n].request('?LASER_STATUS' if i % 2 else '?LASER_POWER')
+                latencies[n].append(time.perf_counter() - start)
+
+        threads = [Thread(target=sending, args=(n,)) for n in range(count)]
+        start = time.perf_counter()
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        elapsed = time.perf_counter() - start
+        for connection in connections: connection.close()
+
+        results[str(count)] = summary(sorted(sum(latencies, [])), elapsed)
+        report(mode+': '+str(count)+' clients', results[str(count)])
+    return results
+
+## two whole configurations, applied in turn so every setting changes
+configurations = [
+    ['LASER_MAINS ON', 'LASER_POWER 40', 'LASER_MODE MASTER', 'LASER_MOD_POLARITY INVERT',
+     'LASER_MODULATION SINE 100 0', 'LASER_TRIGGER_THRESHOLD 50'],
+    ['LASER_MAINS OFF', 'LASER_POWER 20', 'LASER_MODE INDEP', 'LASER_MOD_POLARITY PASS',
+     'LASER_MODULATION SQUARE 50 10', 'LASER_TRIGGER_THRESHOLD 30'],
+]
+
+def bench_apply(address, mode, repeats=50):
+    '''Measures reconfiguration: one command at a time, or all in one APPLY'''
+
+    client = benchClient(address)
+    results = {}
+    for name in ['separate', 'apply']:
+        before = serial_round_trips()
+        latencies = []
+        for i in range(repeats):
+            commands = configurations[i % 2]
+            start = time.perf_counter()
+            if name == 'apply': client.request('APPLY ' + '; '.join(commands))
+            else:
+                for command in commands: client.request(command)
+            latencies.append(time.perf_counter() - start)
+        after = serial_round_trips()
+        results[name] = summary(sorted(latencies))
+        results[name]['serial_round_trips'] = {
+            device: (after[device] - before[device]) / repeats for device in after}
+        report(mode+': reconfigure, '+name, results[name])
+    client.close()
+    return results
+
+def bench_client(address, mode, repeats=500, size=50):
+    '''Measures client library: one request at a time, batches and a pool'''
+
+    from i14client import Client, ClientPool
+    results = {}
+    messages = ['?LASER_STATUS' if i % 2 else '?LASER_POWER' for i in range(repeats)]
+    with Client(*address) as client:
+        results['request'] = summary(measure(lambda: client.request('?LASER_POWER'), repeats))
+        report(mode+': client request', results['request'])
+
+        start = time.perf_counter()
+        for i in range(0, repeats, size): client.batch(messages[i:i+size])
+        elapsed = time.perf_counter() - start
+        results['batch'] = {'per_second'  : repeats / elapsed,
+                            'mean_ms'     : elapsed / repeats * 1e3,
+                            'batch_size'  : size}
+        print('{0:<44} {1:10.3f} ms per request'.format(
+            mode+': client batch of '+str(size), results['batch']['mean_ms']))
+
+    with ClientPool(*address, size=4) as pool:
+        def sending(n):
+            for message in messages[n::8]: pool.request(message)
+        threads = [Thread(target=sending, args=(n,)) for n in range(8)]
+        start = time.perf_counter()
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        elapsed = time.perf_counter() - start
+        results['pool'] = {'per_second'  : repeats / elapsed,
+                           'mean_ms'     : elapsed / repeats * 1e3}
+        print('{0:<44} {1:10.3f} ms per request'.format(
+            mode+': client pool, 8 threads', results['pool']['mean_ms']))
+    return results
+
+def bench_hotplug(address, repeats=10):
+    '''
+    Measures a USB reset of the laser and the Arduino: how fast commands
+    fail while they are gone, and how soon after they are back (as seen by
+    the watcher's next look) they are working with their settings restored
+    '''
+    client = benchClient(address)
+    fakes = backend.load().fakes[config.DEFAULT_DEVICE]
+    laser, board = fakes['laser'], fakes['arduino']
+    client.request('LASER_MOD_POLARITY INVERT')
+    failing, recovery = [], []
+    for i in range(repeats):
+        power = 20.0 + i
+        client.request('LASER_POWER ' + str(power))
+        laser.unplug()
+        board.unplug()
+        time.sleep(2 * config.HOTPLUG_PERIOD)   ## noticed by the watcher
+        for message in ['?LASER_STATUS !fresh', 'LASER_POWER 50']:
+            start = time.perf_counter()
+            client.request(message)
+            failing.append(time.perf_counter() - start)
+        laser.registers['SOUR:AM:MPOL'] = 'PASS'    ## as if power cycled
+        start = time.perf_counter()
+        laser.replug()
+        board.replug()
+        while (board.setpoints['A'] != power or laser.registers['SOUR:AM:MPOL'] != 'INVERT'
+               or client.request('?LASER_POWER') != str(power).encode(encoding='ascii')):
+            if time.perf_counter() - start > 10: break
+            time.sleep(0.001)
+        recovery.append(time.perf_counter() - start)
+    client.close()
+    results = {'unplugged': summary(sorted(failing)), 'recovery': summary(sorted(recovery))}
+    report('hotplug: command while unplugged', results['unplugged'])
+    report('hotplug: replugged until restored', results['recovery'])
+    return results
+
+##### MAIN ####################################################################
+
+if __name__ == '__main__':
+    output = sys.argv[1] if len(sys.argv) > 1 else 'benchmark.json'
+    results = {
+        'environment' : {'python'   : platform.python_version(),
+                         'platform' : platform.platform(),
+                         'time'     : time.time()},
+        'startup'     : bench_startup(),
+        'laser'       : bench_laser(),
+        'framing'     : bench_framing(),
+        'parser'      : bench_parser(),
+        'metrics'     : bench_metrics(),
+        'processes'   : bench_processes(),
+        'commands'    : {},
+        'scaling'     : {},
+        'client'      : {},
+        'apply'       : {},
+        'hotplug'     : {},
+    }
+    for mode in ['threaded', 'async']:
+        address = start_server(mode)
+        results['commands'][mode] = bench_commands(address, mode)
+        results['scaling'][mode] = bench_scaling(address, mode)
+        results['client'][mode] = bench_client(address, mode)
+        results['apply'][mode] = bench_apply(address, mode)
+    results['hotplug'] = bench_hotplug(address)
+
+    import BioRay, arduino              ## serial contention during the runs
+    results['io'] = {'laser'   : BioRay.scheduler.stats(),
+                     'arduino' : arduino.link.scheduler.stats()}
+
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+    print('Results written to '+output)
@@ -0,0 +1,92 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Time budget of the request a thread is working on, which every queue and
+## serial read or write on its way takes its timeout from
+
+##### IMPORTS #################################################################
+
+import time                             ## monotonic clock for deadlines
+from threading import local             ## deadline of each thread
+
+##### DEADLINES ###############################################################
+
+selection = local()                     ## .deadline of request of each thread
+
+def deadline():
+    '''Returns monotonic time the current request must be done by, or None'''
+
+    return getattr(selection, 'deadline', None)
+
+def remaining(default=None):
+    '''
+    Returns seconds left until the deadline of the current request
+
+    Arguments:
+        default <float> - seconds to use without a deadline, and the most
+                          that is returned (None: no limit)
+
+    Returns:
+        Seconds <float> (0.0 once the deadline has passed), or default
+    '''
+    end = deadline()
+    if end is None: return default
+    left = max(end - time.monotonic(), 0.0)
+    return left if default is None else min(left, default)
+
+def expired():
+    '''Returns whether the deadline of the current request has passed'''
+
+    end = deadline()
+    return end is not None and time.monotonic() >= end
+
+class until:
+    '''
+    Sets the deadline (monotonic time) for the code in a with block, on this
+    thread only; a deadline that is already set is never extended
+    '''
+
+    def __init__(self, end):
+        self.end = end
+
+    def __enter__(self):
+        self.previous = deadline()
+        if self.previous is None or (self.end is not None and self.end < self.previous):
+            selection.deadline = self.end
+        return self
+
+    def __exit__(self, *exc):
+        selection.deadline = self.previous
+        return False
+
+def within(seconds):
+    '''Sets a deadline seconds from now for the code in a with block'''
+
+    return until(time.monotonic() + seconds)
+
+##### SERIAL PORTS ############################################################
+
+def limit(port, timeout):
+    '''
+    Shortens read and write timeouts of a serial port to the remaining budget
+
+        - ports are only reconfigured when the timeout changes, so requests
+          with plenty of budget left cost nothing extra
+
+    Arguments:
+        port <serial.Serial> - open serial port
+        timeout <float> - timeout of the port without a deadline
+
+    Returns:
+        Timeout now in use <float> (0.0 once the deadline has passed)
+    '''
+    timeout = remaining(timeout)
+    if port.timeout != timeout: port.timeout = timeout
+    if port.write_timeout != timeout: port.write_timeout = timeout
+    return timeout
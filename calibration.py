@@ -0,0 +1,101 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## On-disk cache of wave divisors the Arduino has converged to while calibrating
+
+##### IMPORTS #################################################################
+
+import os                               ## for replacing cache file atomically
+import json                             ## cache file format
+from threading import Lock              ## cache is shared between threads
+import config                           ## location of cache file
+import devices                          ## one cache per device
+
+##### CALIBRATION CACHE #######################################################
+
+class CalibrationCache:
+    '''
+    Converged divisors, keyed by modulation mode, period and power
+
+        - the sketch reports "CAL <mode> <period> <power> <divisor>" whenever
+          it finishes calibrating, which is recorded here and saved to disk
+        - period is in microseconds and power is the 12-bit DAC value, exactly
+          as the sketch holds them, so keys match what was calibrated
+        - unknown settings are estimated from nearby periods of the same mode
+          (same power preferred), as steps per wave grow with its period
+    '''
+
+    def __init__(self, path=config.CALIBRATION_FILE):
+        '''
+        Init function for calibration cache, loads previously saved entries
+
+        Arguments:
+            path <str> - JSON file that entries are saved to
+
+        Returns:
+            none
+        '''
+        self.path = path
+        self.lock = Lock()
+        self.entries = {}
+        try:
+            with open(path) as file:
+                for key, divisor in json.load(file).items():
+                    mode, period, power = key.split(':')
+                    self.entries[(mode, int(period), int(power))] = float(divisor)
+        except (OSError, ValueError):
+            pass                        ## no usable cache yet, start empty
+
+    def record(self, mode, period, power, divisor):
+        '''Stores a converged divisor and saves the cache to disk'''
+
+        with self.lock:
+            if self.entries.get((mode, period, power)) == divisor: return
+            self.entries[(mode, period, power)] = divisor
+            data = {'%s:%d:%d' % key: value for key, value in self.entries.items()}
+            try:
+                with open(self.path + '.tmp', 'w') as file:
+                    json.dump(data, file, indent=1, sort_keys=True)
+                os.replace(self.path + '.tmp', self.path)
+            except OSError:
+                pass                    ## cache still works, only in memory
+
+    def lookup(self, mode, period, power):
+        '''
+        Returns divisor to start calibrating from for given settings
+
+        Arguments:
+            mode <str> - modulation mode, e.g. 'sine'
+            period <int> - microseconds of period of one cycle
+            power <int> [0 - 4095] - laser power as a 12-bit DAC value
+
+        Returns:
+            Cached or estimated divisor <float>, or None if nothing is known
+        '''
+
+        with self.lock:
+            if (mode, period, power) in self.entries:
+                return self.entries[(mode, period, power)]
+            points = ([(p, d) for (m, p, w), d in self.entries.items() if m == mode and w == power] or
+                      [(p, d) for (m, p, w), d in self.entries.items() if m == mode])
+        if len(points) == 0 or period <= 0: return None
+
+        below = max((point for point in points if point[0] <= period), default=None)
+        above = min((point for point in points if point[0] > period), default=None)
+        if below is not None and below[0] == period: return below[1]
+        if below is not None and above is not None:
+            fraction = (period - below[0]) / (above[0] - below[0])
+            return below[1] + fraction * (above[1] - below[1])
+        p, d = below if below is not None else above
+        return d * period / p if p > 0 else None
+
+## cache of the current device (see devices.py), the Arduinos of different
+## devices converge to different divisors
+cache = devices.PerDevice(lambda name: CalibrationCache(
+    devices.filename(config.CALIBRATION_FILE, name)))
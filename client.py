@@ -8,33 +8,31 @@
 ###############################################################################
 
 ## A simple python file that demonstrates how to communicate with server.py
+## (programs should import the client library, see i14client)
 
 ##### IMPORTS #################################################################
 
 import socket
+from i14client import Client, LaserError
 
 ##### HOST AND PORT SETUP #####################################################
 
 host = socket.gethostname()     ## CHANGE THIS TO IP OR HOSTNAME OF SERVER
 port = 14000
 
-##### ATTEMPT TO CONNECT TO SERVER ############################################
+##### CONNECT TO SERVER #######################################################
 
-try:    ## create client socket and bind to server
-    clientsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    clientsocket.connect((host, port))
-except Exception as e:  ## socket may be left open from a crashed session
-    print(e)
-    clientsocket.close()    ## close socket and recreate it
-    clientsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    clientsocket.connect((host, port))  ## attempt to connect again
+client = Client(host, port)     ## connects on first message, reconnects if lost
+client.listeners.append(lambda message: print('RECEIVED MESSAGE:', message))
 
 ##### INFINITE LOOP FOR SENDING AND RECEIVING MESSAGES ########################
 
 while True:
     msg = input('SEND MESSAGE TO SERVER: ')
     if msg == 'exit':
-        clientsocket.close()
-    else:
-        clientsocket.send((msg+'\r\n').encode(encoding='ascii'))
-        print('RECEIVED MESSAGE:', clientsocket.recv(1024).decode('ascii'))
+        client.close()
+        break
+    try:
+        print('RECEIVED MESSAGE:', client.request(msg))
+    except (LaserError, ValueError, OSError) as e:
+        print('RECEIVED ERROR:', e)
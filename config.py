@@ -0,0 +1,165 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Central place for all tunable settings of the laser controller
+
+import os       ## for environment overrides
+
+##### LASER SERIAL PORT #######################################################
+
+LASER_PORT = '/dev/ttyUSB0'     ## USB-to-Serial adapter of the BioRay laser
+LASER_BAUDRATE = 115200         ## fixed by laser firmware
+LASER_TIMEOUT = 0.1             ## max seconds to wait for a line from laser
+LASER_RETRIES = 1               ## reconnect attempts after a SerialException
+
+##### ARDUINO SERIAL PORT #####################################################
+
+ARDUINO_PORT = '/dev/ttyACM0'   ## USB serial port of the Arduino Uno
+ARDUINO_BAUDRATE = 115200       ## must match SERIAL_BAUDRATE in the sketch
+ARDUINO_TIMEOUT = 1.0           ## max seconds to wait for an acknowledgement
+ARDUINO_PROTOCOL = 'binary'     ## 'binary' (compact, checksummed) frames, or
+                                ## 'ascii' lines that are easy to debug by hand
+ARDUINO_STREAM_BUFFER = 64      ## power values the sketch can queue (STREAM_SIZE)
+ARDUINO_STREAM_CHUNK = 16       ## power values sent per stream frame
+ARDUINO_STREAM_MIN_US = 500     ## shortest interval between streamed values
+
+##### DEVICES #################################################################
+
+## every laser and the Arduino modulating it, addressed by clients with
+## "@name COMMAND ..." (commands without an address go to DEFAULT_DEVICE);
+## each device has its own serial ports, I/O threads, shadow registers,
+## telemetry, history, calibration cache and timed programs; ports are best
+## given by their stable /dev/serial/by-id/... paths, which keep pointing at
+## the same adapter when it comes back from a USB reset under a new name
+DEVICES = {
+    'laser1' : {
+        'laser_port'     : LASER_PORT,
+        'arduino_port'   : ARDUINO_PORT,
+        'reset_pin'      : 25,              ## GPIO (BCM) resetting the Arduino
+        'mode_pins'      : [22, 27, 17],    ## modulation mode signals
+        'operation_pins' : [16, 26],        ## operation mode signals
+    },
+}
+DEFAULT_DEVICE = 'laser1'
+
+##### SERIAL I/O SCHEDULING ###################################################
+
+IO_DEADLINE = 2.0               ## seconds a request to a device may take, from
+                                ## being queued until its result is returned
+BUDGETS = {                     ## seconds a command may take by class, from
+    'query'   : 1.0,            ## being parsed until it is answered (clients
+    'command' : 2.0,            ## set their own by ending a message with
+    'upload'  : 10.0,           ## !DEADLINE=ms); serial I/O gets what is left
+}
+
+##### HOT-REPLUG ##############################################################
+
+HOTPLUG_PERIOD = 0.05           ## seconds between looks at the device nodes of
+                                ## the serial ports (to notice a USB reset)
+HOTPLUG_SETTLE = 3.0            ## seconds a device that is back may take to
+                                ## answer before restoring it is given up
+
+##### NETWORK SERVER ##########################################################
+
+SERVER_PORT = 14000             ## TCP port that clients connect to
+SERVER_MODE = 'threaded'        ## 'threaded' (thread per client) or 'async'
+SERVER_MAX_CONNECTIONS = 256    ## async mode: clients beyond this are refused
+SERVER_WORKERS = 4              ## async mode: threads for hardware calls
+SERVER_WRITE_BUFFER = 65536     ## async mode: bytes queued per client before
+                                ## the connection stops reading (backpressure)
+SERVER_IDLE_TIMEOUT = None      ## seconds a client may send nothing (or not
+                                ## take replies) before it is disconnected
+                                ## (None: never, e.g. for telemetry listeners)
+APPLY_MAX_LENGTH = 512          ## bytes of an APPLY message (others: 128),
+APPLY_MAX_WORDS = 64            ## and its words (others: 8), as it carries a
+                                ## whole configuration
+
+##### PROCESSES ###############################################################
+
+FRONTENDS = 0                   ## network front-end processes next to the
+                                ## hardware daemon (0: everything in one process)
+DAEMON_SOCKET = '/tmp/i14_laser.sock'   ## Unix socket of the hardware daemon
+DAEMON_WORKERS = 16             ## daemon threads running forwarded commands
+DAEMON_TIMEOUT = 10.0           ## seconds a front-end waits for the daemon
+DAEMON_MARGIN = 1.0             ## seconds it waits beyond the budget of a command
+DAEMON_RECONNECT = 0.5          ## seconds between attempts to reach the daemon
+SNAPSHOT_FILE = '/dev/shm/i14_laser.snapshot' if os.path.isdir('/dev/shm') \
+                else '/tmp/i14_laser.snapshot'  ## state shared with front-ends
+SNAPSHOT_SIZE = 65536           ## bytes of shared memory for the snapshot
+SNAPSHOT_PERIOD = 0.1           ## seconds between snapshots of telemetry
+
+##### METRICS #################################################################
+
+METRICS_PORT = None             ## local TCP port of the Prometheus text endpoint
+                                ## (None: metrics only available by ?METRICS)
+
+##### TRACING #################################################################
+
+TRACE_ENABLED = False           ## record spans of every request (TRACING ON/OFF)
+TRACE_BUFFER = 256              ## most recent traces kept in memory
+TRACE_SLOW = 0.1                ## seconds a request must take to be in ?TRACES
+TRACE_DUMP = 10                 ## most traces returned by ?TRACES
+TRACE_FILE = None               ## path of JSON-lines file every trace is
+                                ## appended to (None: traces kept in memory)
+
+##### TELEMETRY ###############################################################
+
+TELEMETRY_PERIOD = 1.0          ## seconds between background polls of laser
+TELEMETRY_REGISTERS = {         ## laser registers polled, with TTL in seconds
+    'SYST:STAT?'    : 2.0,      ## (cached value is used while younger than
+    'SYST:FAUL?'    : 2.0,      ##  its TTL, otherwise the laser is read live)
+    'SOUR:AM:STAT?' : 2.0,
+    'SOUR:AM:MPOL?' : 2.0,
+    'SOUR:TEMP:DIOD?' : 2.0,
+    'SOUR:TEMP:INT?'  : 2.0,
+}
+TELEMETRY_MAX_RATE = 10.0       ## highest SUBSCRIBE rate in Hz
+
+##### SAFETY INTERLOCK ########################################################
+
+INTERLOCK_PIN = 23              ## GPIO (BCM) high when interlock is closed
+OVERRIDE_PIN = 24               ## GPIO (BCM) high when override is on
+INTERLOCK_DEBOUNCE = 0.005      ## seconds for interlock contacts to settle
+
+##### TIMED PROGRAMS ##########################################################
+
+PROGRAM_MAX_STEPS = 1000        ## most steps in a single program
+PROGRAM_RAMP_RATE = 500.0       ## power values per second during a ramp
+
+##### CALIBRATION CACHE #######################################################
+
+## converged wave divisors reported by the Arduino, kept between restarts
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'calibration.json')
+
+##### TELEMETRY HISTORY #######################################################
+
+HISTORY_PERIOD = 1.0            ## seconds between samples of history fields
+HISTORY_TIERS = [               ## (seconds per bucket, number of buckets), finest
+    (1, 3600),                  ## first: raw samples for an hour, then
+    (60, 1440),                 ## min/max/mean per minute for a day and
+    (900, 2880),                ## per quarter hour for a month (28 bytes per
+]                               ## bucket and field, ~1.1 MB for five fields)
+HISTORY_MAX_POINTS = 1000       ## most points returned by one ?HISTORY query
+HISTORY_SAVE_PERIOD = 300.0     ## seconds between saves of the segment file
+HISTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'history.seg')  ## fixed size, None: not saved
+
+##### HARDWARE BACKEND ########################################################
+
+## 'hardware' drives the real GPIO and serial ports, 'simulated' replaces them
+## with the fake devices of simulator.py (for development and benchmarks)
+BACKEND = os.environ.get('I14_BACKEND', 'hardware')
+
+##### ARBITRARY WAVEFORMS #####################################################
+
+WAVEFORM_SAMPLES = 256          ## most samples per period, fixed by WAVE_SIZE
+WAVEFORM_MIN_SAMPLE_US = 200    ## shortest sample the sketch can keep up with
+                                ## (one I2C write to the DAC, plus checks)
+WAVEFORM_FRAME_SAMPLES = 16     ## samples per upload frame (FRAME_SIZE is 64)
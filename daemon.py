@@ -0,0 +1,156 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Hardware daemon: the only process that talks to the devices, running the
+## commands that network front-end processes (see frontend.py) forward to it
+
+##### IMPORTS #################################################################
+
+import os                               ## for removing a stale socket file
+import socket                           ## Unix socket shared with front-ends
+from threading import Thread, Lock      ## one thread per front-end
+from concurrent.futures import ThreadPoolExecutor   ## forwarded commands
+import config                           ## socket, workers and snapshot
+import tracing                          ## spans of forwarded commands
+from errors import return_code          ## EXTERNAL RETURN CODE DICTIONARY
+from externalParser import parse, monitor, state, started   ## EXTERNAL RULEBOOK
+from snapshot import Snapshot, SnapshotWriter   ## state shared with front-ends
+
+##### FRAMING #################################################################
+
+## every message between daemon and front-ends is a header line giving its
+## number and length, followed by that many bytes:
+##     front-end -> daemon: number, then peer and words of a command
+##     daemon -> front-end: number of the command, then its reply, or * and
+##                          an unsolicited message for every client
+
+def frame(number, data):
+    '''Returns message of a number and bytes, ready to be sent'''
+
+    return (number + ' ' + str(len(data)) + '\n').encode(encoding='ascii') + data
+
+def readFrame(file):
+    '''Returns (number, bytes) of the next message read from file, raises EOFError'''
+
+    header = file.readline()
+    if not header.endswith(b'\n'): raise EOFError('Connection closed')
+    number, length = header.decode(encoding='ascii').split()
+    data = file.read(int(length))
+    if len(data) != int(length): raise EOFError('Connection closed')
+    return number, data
+
+##### FRONT-END CONNECTIONS ###################################################
+
+class frontendConnection(Thread):
+    '''Reads commands of one front-end and sends their replies back'''
+
+    def __init__(self, daemon, sock):
+        Thread.__init__(self, daemon=True)
+        self.daemon = daemon
+        self.sock = sock
+        self.send_lock = Lock()
+        self.start()
+
+    def send(self, data):
+        '''Sends data to front-end, one message at a time'''
+
+        with self.send_lock: self.sock.sendall(data)
+
+    def handle(self, number, data):
+        '''Runs one forwarded command and sends its reply'''
+
+        peer, _, message = data.decode(encoding='ascii').partition(' ')
+        words = message.split(' ')
+        trace = tracing.begin(peer)
+        try:
+            if trace is not None: trace.command = words[0]
+            reply = parse(words)
+        except Exception as e:          ## 17 is kept for failures to reach us
+            reply = return_code(['18', str(e)])
+        finally:
+            tracing.finish(trace)
+        command = words[1:2] if words[0].startswith('@') else words[:1]
+        if not ''.join(command).startswith('?'):        ## may have changed state
+            self.daemon.writer.write()  ## never raises, keeps the last snapshot
+        try: self.send(frame(number, reply))
+        except OSError: pass            ## front-end has gone away
+
+    def run(self):
+        '''Hands every command to the worker threads until the front-end closes'''
+
+        self.daemon.connections.add(self)
+        file = self.sock.makefile('rb')
+        try:
+            while True:
+                number, data = readFrame(file)
+                self.daemon.executor.submit(self.handle, number, data)
+        except (EOFError, OSError, ValueError):
+            pass
+        finally:
+            self.daemon.connections.discard(self)
+            self.sock.close()
+
+##### HARDWARE DAEMON #########################################################
+
+class hardwareDaemon:
+    '''
+    Owns the devices on behalf of any number of front-end processes
+
+        - commands arrive over a Unix socket and run on a pool of worker
+          threads, so commands of different clients (and devices) still run
+          in parallel while parsing, logging and client sockets stay in the
+          front-ends
+        - telemetry of every device is written to a shared snapshot, which
+          front-ends read for subscriptions and ?STATE without asking
+        - interlock changes are pushed to every front-end as they happen
+    '''
+
+    def __init__(self, path=config.DAEMON_SOCKET, workers=config.DAEMON_WORKERS):
+        '''
+        Init function for hardware daemon, binds its socket and creates the
+        snapshot but starts no threads, so front-ends can be forked after it
+
+        Arguments:
+            path <str> - path of the Unix socket front-ends connect to
+            workers <int> - threads running forwarded commands
+
+        Returns:
+            none
+        '''
+        if os.path.exists(path): os.remove(path)    ## left by a previous run
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+        self.executor = ThreadPoolExecutor(workers)
+        self.connections = set()
+        self.snapshot = Snapshot(create=True)
+        self.writer = SnapshotWriter(self.snapshot, self.sample)
+        monitor.listeners.append(self.interlockChanged)
+
+    def sample(self):
+        '''Returns state of every device for the snapshot, once started'''
+
+        return {'devices': state() if started.is_set() else {}}
+
+    def interlockChanged(self, status):
+        '''Tells every front-end, and the snapshot, that the interlock changed'''
+
+        self.writer.wake()
+        message = frame('*', b'!INTERLOCK ' + return_code(status))
+        for connection in list(self.connections):
+            try: connection.send(message)
+            except OSError: pass
+
+    def serve(self):
+        '''Accepts front-ends forever'''
+
+        self.writer.start()
+        while True:
+            sock, _ = self.sock.accept()
+            frontendConnection(self, sock)
@@ -0,0 +1,117 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Devices (laser and Arduino pairs) driven by the server, and which one a
+## thread is currently working with
+
+##### IMPORTS #################################################################
+
+import os                               ## for per-device file names
+from threading import local, Lock       ## device selected by each thread
+import config                           ## configured devices
+
+##### DEVICE SELECTION ########################################################
+
+for name, settings in config.DEVICES.items():
+    missing = {'laser_port', 'arduino_port', 'reset_pin', 'mode_pins',
+               'operation_pins'} - set(settings)
+    if missing: raise ValueError('Device ' + name + ' lacks ' + ', '.join(sorted(missing)))
+if config.DEFAULT_DEVICE not in config.DEVICES:
+    raise ValueError('Unknown default device: ' + str(config.DEFAULT_DEVICE))
+
+selection = local()                     ## .name of device of each thread
+
+def names():
+    '''Returns names of all configured devices, default device first'''
+
+    return [config.DEFAULT_DEVICE] + sorted(name for name in config.DEVICES
+                                            if name != config.DEFAULT_DEVICE)
+
+def current():
+    '''Returns name of device this thread works with (default if none chosen)'''
+
+    return getattr(selection, 'name', None) or config.DEFAULT_DEVICE
+
+def chosen():
+    '''Returns name of device this thread chose with using(), None if it did not'''
+
+    return getattr(selection, 'name', None)
+
+def settings(name=None):
+    '''Returns configuration of a device (of the current device if None)'''
+
+    return config.DEVICES[current() if name is None else name]
+
+class using:
+    '''Selects a device for the code in a with block (on this thread only)'''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.previous = getattr(selection, 'name', None)
+        selection.name = self.name
+        return self
+
+    def __exit__(self, *exc):
+        selection.name = self.previous
+        return False
+
+def filename(path, name):
+    '''
+    Returns file a device keeps its own copy of something in, e.g. the
+    calibration cache: path itself for the default device, so that files of
+    a single-device setup keep their names, or path with -name added
+    '''
+    if path is None or name == config.DEFAULT_DEVICE: return path
+    root, extension = os.path.splitext(path)
+    return root + '-' + name + extension
+
+def bound(name, function):
+    '''Returns function that always runs with a device selected, e.g. in threads'''
+
+    def running(*args, **kwargs):
+        with using(name): return function(*args, **kwargs)
+    return running
+
+##### PER DEVICE OBJECTS ######################################################
+
+class PerDevice:
+    '''
+    One instance of something (session, shadow registers, ...) per device
+
+        - instances are created by factory(name) when a device first needs
+          one, so unused devices cost nothing
+        - attributes are looked up on the instance of the current device,
+          so it can be used in place of a single shared instance
+    '''
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.instances = {}
+        self.lock = Lock()
+
+    def of(self, name):
+        '''Returns instance of a device, creating it on first use'''
+
+        instance = self.instances.get(name)
+        if instance is None:
+            with self.lock:
+                instance = self.instances.get(name)
+                if instance is None:
+                    instance = self.instances[name] = self.factory(name)
+        return instance
+
+    def created(self):
+        '''Returns (name, instance) of every device that has an instance'''
+
+        with self.lock: return list(self.instances.items())
+
+    def __getattr__(self, attribute):
+        return getattr(self.of(current()), attribute)
@@ -7,6 +7,11 @@
 ###                                                                         ###
 ###############################################################################
 
+import metrics      ## every formatted return code is counted
+import sys          ## background errors are logged to stderr
+import traceback    ## with the traceback of the exception
+from datetime import datetime   ## UTC time for logging purposes
+
 ### CREATE UNIVERSAL ERROR HANDLER, DEPENDING ON TYPE, PRINTS APPROPRIATE ERROR
 
 def return_code(obj):
@@ -32,6 +37,10 @@ def return_code(obj):
         "12" : '12 : Received message is not terminated correctly',
         "13" : '13 : Received message contains no commands',
         "14" : '14 : Received message contains too many arguments',
+        "15" : '15 : Server has reached its connection limit',
+        "16" : '16 : Received message addresses an unknown device',
+        "17" : '17 : Server cannot reach the hardware daemon',
+        "18" : '18 : Server failed while carrying out the command',        # {+++}
         ##### 2X : PARSING ERRORS #################################################
         "20" : '20 : Command not recognized',
         "21" : '21 : Not enough arguments provided for this command',
@@ -40,6 +49,9 @@ def return_code(obj):
         "24" : '24 : One or more provided argument(s) are not of expected type',
         "25" : '25 : One or more provided argument(s) are not in range',
         "26" : '26 : Operation mode is not compatible with current modulation mode',
+        "27" : '27 : Program does not exist',
+        "28" : '28 : A program is already running',
+        "29" : '29 : Program has too many steps',
         ##### 3X : TTY PORT ERRORS ################################################
         "30" : '30 : Unexpected TTY port error',                            # {+++}
         "31" : '31 : Unable to connect to specified TTY port',              # {+++}
@@ -54,6 +66,9 @@ def return_code(obj):
         ###########################################################################
     }
 
+    code = obj if type(obj) is str else obj[0]
+    metrics.count('return_codes', (('code', code),))
+
     if type(obj) is str:
         if (0 < int(obj) < 10 and obj not in ['01', '02', '04']):
             message = obj + ' : More than one warning has occured'
@@ -65,3 +80,23 @@ def return_code(obj):
         message += ' : ' + str(obj[1])
 
     return (message+'\r\n').encode(encoding='ascii')
+
+### LOG ERRORS OF BACKGROUND THREADS, WHICH HAVE NO CLIENT TO REPLY TO
+
+def log(message):
+    '''Prints message to stderr, prefixed with current UTC time'''
+
+    print(str(datetime.utcnow())+" "+message, file=sys.stderr, flush=True)
+
+def log_exception(context):
+    '''
+    Prints the exception being handled, prefixed with current UTC time and
+    what was being done, so that a background thread can log it and go on
+
+    Arguments:
+        context <str> - what failed, e.g. 'TELEMETRY POLL OF SYST:STAT?'
+
+    Returns:
+        none
+    '''
+    log(context+" FAILED: "+traceback.format_exc().rstrip())
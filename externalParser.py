@@ -9,307 +9,1206 @@
 
 ##### IMPORTS #################################################################
 
-import RPi.GPIO as GPIO                 ## for GPIO control
+import math                             ## for checking numeric arguments
+import time                             ## for timing commands
+from threading import Thread, Event, Lock   ## for starting up hardware
+from backend import GPIO                ## real or simulated GPIO
 from BioRay import laser                ## EXTERNAL BIORAY SERIAL CONTROLLER
+import BioRay                           ## laser I/O scheduler, for stats
+from scheduler import lane_names        ## I/O scheduler lanes, for stats
 from errors import return_code          ## EXTERNAL RETURN CODE DICTIONARY
+from errors import log_exception        ## errors of background threads
 import arduino                          ## Arduino laser controller
+from telemetry import TelemetryPoller, TelemetryPublisher  ## telemetry
+import config                           ## telemetry settings
+from shadow import registers            ## shadow of settable registers
+from interlock import InterlockMonitor  ## cached safety interlock state
+
+import waveform                         ## shapes of arbitrary waveforms
+from program import ProgramExecutor, Step  ## timed programs
+from history import History, HistoryRecorder  ## telemetry history
+import metrics                          ## counters and latency histograms
+import tracing                          ## spans of each request, if enabled
+import devices                          ## state and I/O of each device
+import budget                           ## deadline of each command
+import backend                          ## serial ports of each device
+from hotplug import PortWatcher         ## device nodes of serial ports
 
 ##### GLOBAL VARS #############################################################
 
-LASER_POWER = 0                 ## reset laser power to zero
-LASER_MODE = 'indep'            ## reset laser mode to independent operation
-LASER_MODULATION = 'none'       ## reset modulation to none (no modulation)
-LASER_MODULATION_PERIOD = 0     ## reset modulation period to default
-LASER_MODULATION_DELAY = 0      ## reset modulation to default
-LASER_TRIGGER_THRESHOLD = 0     ## reset camera trigger threshold to default
-
+## power, modulation, period, delay and threshold (Arduino), mains and
+## polarity (laser) and the operation mode are kept in shadow registers of
+## each device, see shadow.py and devices.py
 STRICT_MODE = True
 
 ##### STARTUP INIT ############################################################
 
-## set up GPIO pins
-GPIO.setmode(GPIO.BCM)
-GPIO.setwarnings(False)
-GPIO.setup([23,24], GPIO.IN) ## 16: INTERLOCK; 26: INTERLOCK_OVERRIDE
-
-arduino.reset()
+## watch interlock (23) and override (24) pins via edge interrupts, one
+## interlock guards every device
+monitor = InterlockMonitor()
+
+def new_poller(name):
+    '''Creates telemetry poller of the laser of a device'''
+
+    created = TelemetryPoller(devices.bound(name, laser))
+    created.listeners.append(devices.bound(name, shadow_update))
+    return created
+
+## poll laser registers of every device in the background
+poller = devices.PerDevice(new_poller)
+
+## timed programs of every device, aborted by the interlock
+programs = devices.PerDevice(lambda name: ProgramExecutor())
+
+started = Event()                       ## set once startup() has finished
+startup_lock = Lock()
+
+def startup():
+    '''
+    Sets up the hardware and starts background threads, only once
+
+        - importing this module touches no hardware; the server calls this
+          as soon as its socket is listening, and parse() calls it before
+          the first command in case nobody has yet
+        - the Arduino resets of all devices, which wait for the boards, run
+          alongside each other and the interlock monitor and telemetry
+        - the serial ports of every device are watched from then on, so that
+          a device that drops off the USB bus is noticed (see HOT-REPLUG)
+        - callers return once everything is ready (the interlock reads as
+          open, failing safe, until then)
+    '''
+    with startup_lock:
+        if started.is_set(): return
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+        resetting = [Thread(target=devices.bound(name, arduino.reset), daemon=True)
+                     for name in devices.names()]
+        for thread in resetting: thread.start()
+        monitor.start()
+        for name in devices.names():
+            poller.of(name).start()
+            recorder.of(name).start()
+            for kind in ['laser', 'arduino']:
+                watcher.watch((name, kind), backend.port(kind, name))
+        watcher.start()
+        for thread in resetting: thread.join()
+        started.set()
+
+##### SHADOW REGISTERS ########################################################
+
+def shadow_update(register, result):
+    '''Keeps shadowed laser registers in step with polled values'''
+
+    if register == 'SOUR:AM:STAT?': registers.set('mains', result[1])
+    if register == 'SOUR:AM:MPOL?': registers.set('polarity', result[1])
+    if register == 'SYST:FAUL?' and result[1].strip('0 ') != '':
+        registers.invalidate('laser')   ## laser faulted, settings unreliable
+
+def written(name, register, value):
+    '''Records a value written to the laser in its shadow register and snapshot'''
+
+    registers.set(name, value)
+    poller.store(register, value)
+
+def shadow_read(name, register):
+    '''Returns shadowed laser register, reading the laser only if unknown'''
+
+    value = registers.get(name)
+    if value is None:
+        result = poller.get(register, fresh=True)
+        if result[0] == '00': value = result[1]
+    return value
+
+def shadow_query(name):
+    '''Returns shadowed register as a reply to a query'''
+
+    value = registers.get(name)
+    if value is None: value = 'UNKNOWN'
+    return (str(value)+'\r\n').encode(encoding='ascii')
 
 ##### SAFETY CHECKS ###########################################################
 
+def cut_power():
+    '''Switches power of laser of the current device off'''
+
+    programs.abort('INTERLOCK', wait=0) ## no further steps, without waiting
+    registers.set('power', 0.0)         ## Arduino cuts power when open,
+    arduino.setLaserPower(0.0)          ## but do not rely on it alone
+    programs.join()                     ## then let the step in progress end
+
+def interlock_changed(status):
+    '''Switches power of every laser off as soon as the interlock opens'''
+
+    if status == '90':                  ## all at once, so none waits for another
+        cutting = [Thread(target=devices.bound(name, cut_power))
+                   for name in devices.names()]
+        for thread in cutting: thread.start()
+        for thread in cutting: thread.join()
+
+monitor.listeners.append(interlock_changed)
+monitor.listeners.append(lambda status:
+    metrics.count('interlock_transitions', (('status', status),)))
+
 def interlock_check():
-    '''Returns interlock and override status'''
+    '''Returns interlock and override status (cached, see interlock.py)'''
 
-    if GPIO.input(23) == 1: return '00'    ## interlock closed
-    if GPIO.input(24) == 1: return '04'    ## interlock open, override on
-    LASER_POWER = 0
-    return '90'                            ## interlock open, override off
+    return monitor.status()
 
-##### ARGUMENT CHECKS #########################################################
+##### ARGUMENT SCHEMA #########################################################
 
-def argument_check(test_args, known_args):
-    '''Tests the validity of passed arguments against expected arguments'''
-
-    if len(test_args) < len(known_args):    ## is there too little arguments?
-        return '21'
-    if len(test_args) > len(known_args):    ## is there too many arguments?
-        return '22'
-    for i in range(len(test_args)):         ## go through every passed argument
-        if all(isinstance(x, str) for x in known_args[i]):  ## expecting string
-            if test_args[i].upper() not in known_args[i]:   ## is it recognized?
-                return '23'
-        else:                                               ## expecting number
-            if not test_args[i].isnumeric():    ## is the passed arg numeric?
-                return '24'
-            if not STRICT_MODE:                    ## is it in range?
-                if float(test_args[i]) < known_args[i][0]:
-                    test_args[i] = known_args[i][0]
-                    return '02'
-                if float(test_args[i]) > known_args[i][1]:
-                    test_args[i] = known_args[i][1]
-                    return '02'
-            else:              ## if strict mode, throw error instead of warning
-                if (float(test_args[i]) < known_args[i][0]
-                or  float(test_args[i]) > known_args[i][1]):
-                    return '25'
-    return '00'
+class Choice:
+    '''Argument that must be one of a set of words (case insensitive)'''
 
-##### QUERY HANDLER ###########################################################
+    def __init__(self, *words):
+        '''Precomputes the uppercase set of accepted words'''
 
-def query(list):
-    '''HANDLES ALL LASER QUERY RESPONSES'''
+        if len(words) == 0 or not all(isinstance(word, str) and word for word in words):
+            raise ValueError('Choice needs one or more non-empty words')
+        self.words = frozenset(word.upper() for word in words)
 
-    if list[0] != '00': return return_code(list[0])
-    return (list[1]+'\r\n').encode(encoding='ascii')
+    def check(self, arg, strict):
+        '''Returns status code and uppercase argument'''
 
-##### COMMAND HANDLER #########################################################
+        value = arg.upper()
+        if value not in self.words: return '23', None
+        return '00', value
 
-def command(test_args, known_args, on_success, variable_update, *additional_checks):
-    '''GENERIC COMMAND PROCESSOR'''
+class Number:
+    '''Argument that must be a finite number within an inclusive range'''
 
-    ## check arguments and interlock
-    a_check = argument_check(test_args, known_args)
-    i_check = interlock_check()
-    warnings = '00'
+    def __init__(self, low, high):
+        '''Checks that the range is numeric and in order'''
 
-    ## analyse results, compile warnings
-    if a_check[0] != '0': return a_check        ## arguments are not good
-    if i_check[0] != '0': return i_check        ## ilock open, override off
-    warnings = "{0:0=2d}".format(int(warnings) + int(a_check) + int(i_check))
+        if not all(isinstance(x, (int, float)) and math.isfinite(x) for x in (low, high)):
+            raise ValueError('Number range must be finite numbers')
+        if low > high:
+            raise ValueError('Number range must be in order')
+        self.low = low
+        self.high = high
 
-    ## run aditional checks as requested
-    for check in additional_checks:
-        status = eval(check)
-        if status[0] != '0': return status
-        warnings = "{0:0=2d}".format(int(warnings) + int(status))
+    def check(self, arg, strict):
+        '''Returns status code and argument as float (clamped if not strict)'''
 
-    ## if action does not need carrying out, skip it
-    if int(warnings)%2 == 0:
-        result_of_eval = eval(on_success)
-        if type(result_of_eval) is list:
-            if result_of_eval[0] != '00': return result_of_eval
-        else:
-            if result_of_eval != '00': return result_of_eval
+        try: value = float(arg)
+        except ValueError: return '24', None
+        if not math.isfinite(value): return '24', None
+        if self.low <= value <= self.high: return '00', value
+        if strict: return '25', None            ## strict mode, throw error
+        return '02', float(min(max(value, self.low), self.high))  ## else warning
 
-    ## if you got here, only warnings or success
-    if variable_update != None: exec(variable_update)
-    return warnings
+class ChoiceList:
+    '''Argument that is a comma separated list of words from a set, or ALL'''
 
-##### RULEBOOK FUNCTIONS - LASER ##############################################
+    def __init__(self, *words):
+        '''Precomputes the uppercase set of accepted words'''
 
-def laser_mains_CMD(args):
-    '''Switches laser ON or OFF'''
+        self.choice = Choice(*words)
+        self.order = [word.upper() for word in words]
 
-    check = "'01' if test_args[0].upper() == laser('SOUR:AM:STAT?')[1] else '00'"
-    final = "laser('SOUR:AM:STAT '+test_args[0].upper())"
-    result = command(args, [['ON', 'OFF']], final, None, check)
+    def check(self, arg, strict):
+        '''Returns status code and list of uppercase words (in given order)'''
 
-    return return_code(result)
+        if arg.upper() == 'ALL': return '00', list(self.order)
+        values = []
+        for word in arg.split(','):
+            status, value = self.choice.check(word, strict)
+            if status != '00': return status, None
+            if value not in values: values.append(value)
+        return '00', values
 
-#######################################
+class Word:
+    '''Argument that can be any name made of letters, digits and underscores'''
 
-def laser_mains_QUERY():
-    '''Queries whether laser is ON or OFF'''
+    def check(self, arg, strict):
+        '''Returns status code and uppercase argument'''
 
-    return query(laser("SOUR:AM:STAT?"))
+        if not arg.replace('_', '').isalnum(): return '24', None
+        return '00', arg.upper()
 
-#######################################
+class Rest:
+    '''All remaining arguments, as a list of words (must be described last)'''
+
+    def check(self, args, strict):
+        '''Returns status code and list of words'''
+
+        if len(args) == 0: return '21', None
+        return '00', list(args)
+
+class Settings(Rest):
+    '''
+    All remaining arguments, as sub-commands separated by semicolons
+
+        - e.g. LASER_POWER 40; LASER_MODULATION SINE 100 0
+        - each sub-command must be one of the given commands, at most once,
+          and its arguments are checked as if it had been sent on its own
+    '''
+
+    def __init__(self, specs):
+        '''Keeps the CommandSpec of every command allowed as a sub-command'''
+
+        self.specs = specs
+
+    def check(self, args, strict):
+        '''Returns status code and dict of sub-command to parsed arguments'''
+
+        code, settings = '00', {}
+        for part in ' '.join(args).split(';'):
+            words = part.split()
+            if len(words) == 0: continue
+            name = words[0].upper()
+            if name not in self.specs: return '20', None
+            if name in settings: return '22', None
+            status, values = argument_check(words[1:], self.specs[name].args)
+            if values is None: return status, None
+            if status != '00': code = status
+            settings[name] = values
+        if len(settings) == 0: return '21', None
+        return code, settings
+
+##### ARGUMENT CHECKS #########################################################
+
+def argument_check(test_args, schema):
+    '''
+    Tests the validity of passed arguments against expected arguments
+
+    Arguments:
+        test_args <list> - arguments passed by client
+        schema <list> - Choice, ChoiceList, Number or Word for every expected
+                        argument, optionally followed by Rest
+
+    Returns:
+        Error code (00, or 02 if any argument was clamped into range)
+        List of parsed arguments, or None if the arguments are not good
+    '''
+    if len(schema) != 0 and isinstance(schema[-1], Rest):
+        if len(test_args) < len(schema) - 1: return '21', None
+        code, values = argument_check(test_args[:len(schema)-1], schema[:-1])
+        if values is None: return code, None
+        status, rest = schema[-1].check(test_args[len(schema)-1:], STRICT_MODE)
+        if status[0] != '0': return status, None
+        if status != '00': code = status
+        return code, values + [rest]
+    if len(test_args) < len(schema):        ## is there too little arguments?
+        return '21', None
+    if len(test_args) > len(schema):        ## is there too many arguments?
+        return '22', None
+    code, values = '00', []
+    for arg, expected in zip(test_args, schema):
+        status, value = expected.check(arg, STRICT_MODE)
+        if status[0] != '0': return status, None
+        if status != '00': code = status
+        values.append(value)
+    return code, values
+
+##### QUERY HANDLER ###########################################################
+
+def query(list):
+    '''HANDLES ALL LASER QUERY RESPONSES'''
+
+    if list[0] != '00': return return_code(list[0])
+    return (list[1]+'\r\n').encode(encoding='ascii')
+
+##### COMMAND SPECIFICATIONS ##################################################
+
+class CommandSpec:
+    '''
+    Precompiled description of a command that changes state
+
+        - args: Choice, ChoiceList, Number or Word for every expected
+          argument, optionally followed by Rest
+        - checks: callables receiving parsed arguments, returning a code;
+          01 (no effect) skips the action, any error aborts the command
+        - action: callable receiving parsed arguments (and the client that
+          sent the command, if client is True), carries the command out
+          and returns error codes (None counts as success)
+        - update: callable receiving parsed arguments, records new state
+        - interlock: whether the safety interlock must allow the command
+        - budget: class of command in config.BUDGETS, seconds it may take
+    '''
+
+    def __init__(self, args, action, update=None, checks=(), interlock=True,
+                       client=False, budget='command'):
+        '''Validates the specification once, when the rulebook is built'''
+
+        if not all(isinstance(arg, (Choice, ChoiceList, Number, Word, Rest)) for arg in args):
+            raise TypeError('Arguments must be described by Choice, ChoiceList, Number, Word or Rest')
+        if any(isinstance(arg, Rest) for arg in args[:-1]):
+            raise TypeError('Rest must describe the last argument')
+        if not all(callable(f) for f in [action] + list(checks)):
+            raise TypeError('Action and checks must be callable')
+        if update is not None and not callable(update):
+            raise TypeError('Update must be callable')
+        if budget not in config.BUDGETS:
+            raise ValueError('Unknown budget: ' + str(budget))
+        self.args = list(args)
+        self.action = action
+        self.update = update
+        self.checks = tuple(checks)
+        self.interlock = interlock
+        self.client = client
+        self.budget = budget
+
+    def __call__(self, test_args, client=None):
+        '''GENERIC COMMAND PROCESSOR'''
+
+        ## check arguments and interlock
+        with tracing.span('arguments'):
+            a_check, values = argument_check(test_args, self.args)
+        if a_check[0] != '0': return return_code(a_check)   ## arguments are not good
+        warnings = int(a_check)
+        if self.interlock:
+            with tracing.span('interlock'):
+                i_check = interlock_check()
+            if i_check[0] != '0': return return_code(i_check)   ## ilock open, override off
+            warnings += int(i_check)
+
+        ## run aditional checks
+        with tracing.span('checks'):
+            for check in self.checks:
+                status = check(values)
+                if status[0] != '0': return return_code(status)
+                warnings += int(status)
+
+        ## if action does not need carrying out, skip it
+        if warnings % 2 == 0:
+            with tracing.span('action'):
+                if self.client:
+                    if client is None: return return_code('20')    ## not on network
+                    result = self.action(values, client)
+                else:
+                    result = self.action(values)
+            if result is not None:
+                code = result[0] if type(result) is list else result
+                if code != '00': return return_code(result)
+
+        ## if you got here, only warnings or success
+        if self.update is not None: self.update(values)
+        return return_code("{0:0=2d}".format(warnings))
+
+class QuerySpec:
+    '''
+    Description of a query (command starting with ?)
+
+        - reply: callable returning the reply to the query
+        - fresh: reply accepts the !fresh modifier, which forces the value
+          to be read from the device instead of the telemetry snapshot
+        - args: if given, arguments are checked as for commands and reply
+          receives the parsed arguments instead
+        - budget: class of query in config.BUDGETS, seconds it may take
+    '''
+
+    def __init__(self, reply, fresh=False, args=None, budget='query'):
+        '''Validates the specification once, when the rulebook is built'''
+
+        if not callable(reply): raise TypeError('Reply must be callable')
+        if args is not None and fresh:
+            raise TypeError('Queries with arguments cannot be fresh')
+        if budget not in config.BUDGETS:
+            raise ValueError('Unknown budget: ' + str(budget))
+        self.reply = reply
+        self.fresh = fresh
+        self.args = None if args is None else list(args)
+        self.budget = budget
+
+    def __call__(self, test_args, client=None):
+        '''Returns reply to query as bytes'''
+
+        if self.args is not None:
+            a_check, values = argument_check(test_args, self.args)
+            if a_check[0] != '0': return return_code(a_check)
+
+        with tracing.span('reply'):
+            if self.args is not None:
+                result = self.reply(values)
+            elif self.fresh and '!FRESH' in [arg.upper() for arg in test_args]:
+                result = self.reply(fresh=True)
+            else:
+                result = self.reply()
+        if type(result) is str: result = result.encode(encoding='ascii')
+        return result
+
+##### RULEBOOK FUNCTIONS - LASER ##############################################
 
-def laser_power_CMD(args):
-    '''Sets amplitude of laser beam'''
+laser_mains_CMD = CommandSpec(      ## Switches laser ON or OFF
+    args   = [Choice('ON', 'OFF')],
+    checks = [lambda v: '01' if v[0] == shadow_read('mains', 'SOUR:AM:STAT?') else '00'],
+    action = lambda v: laser('SOUR:AM:STAT '+v[0]),
+    update = lambda v: written('mains', 'SOUR:AM:STAT?', v[0]))
 
-    check = "'01' if float(test_args[0]) == LASER_POWER else '00'"
-    final = "arduino.setLaserPower(float(test_args[0]))"
-    update = "LASER_POWER = float(test_args[0])"
-    result = command(args, [[0, 100]], final, update, check)
+def laser_mains_QUERY(fresh=False):
+    '''Queries whether laser is ON or OFF'''
+
+    return query(poller.get("SOUR:AM:STAT?", fresh))
+
+#######################################
 
-    return return_code(result)
+laser_power_CMD = CommandSpec(      ## Sets amplitude of laser beam
+    args   = [Number(0, 100)],
+    checks = [lambda v: '01' if v[0] == registers.get('power') else '00'],
+    action = lambda v: arduino.setLaserPower(v[0]),
+    update = lambda v: registers.set('power', v[0]))
 
 def laser_power_QUERY():
     '''Gets amplitude of laser beam'''
 
-    return (str(LASER_POWER)+'\r\n').encode(encoding='ascii')
-#######################!!!!!! NOT FINISHED FROM HERE ON
-def laser_status_QUERY():
+    return shadow_query('power')
+
+#######################################
+
+def laser_status_QUERY(fresh=False):
     '''Gets laser status code'''
 
-    return query(laser("SYST:STAT?"))
+    return query(poller.get("SYST:STAT?", fresh))
 
-def laser_fault_QUERY():
+def laser_fault_QUERY(fresh=False):
     '''Gets laser fault code'''
 
-    return query(laser("SYST:FAUL?"))
+    return query(poller.get("SYST:FAUL?", fresh))
+
+#######################################
 
-def laser_mode_CMD(args):
-    '''Sets laser operation mode'''
+def gated_compatible(mode, modulation):
+    '''Gated operation only works with square and pulse modulation'''
 
-    check_1 = "'26' if (args[0].lower() == 'gated' and (LASER_MODULATION not in ['square', 'pulse'])) else '00'"
-    check_2 = "'01' args[0].lower() == LASER_MODE else '00')"
-    final = "LASER_MODE = args[0].lower(); arduino.setOperationMode(LASER_MODE)"
-    result = command(args, [['GATED', 'MASTER', 'INDEP']], final, check_1, check_2)
+    if mode == 'GATED' and modulation not in ['square', 'pulse']: return '26'
+    return '00'
 
-    return return_code(result)
+laser_mode_CMD = CommandSpec(       ## Sets laser operation mode
+    args   = [Choice('GATED', 'MASTER', 'INDEP')],
+    checks = [lambda v: gated_compatible(v[0], registers.get('modulation')),
+              lambda v: '01' if v[0].lower() == registers.get('operation') else '00'],
+    action = lambda v: arduino.setOperationMode(v[0].lower()),
+    update = lambda v: registers.set('operation', v[0].lower()))
 
 def laser_mode_QUERY():
     '''Gets laser operation mode'''
 
-    return (str(LASER_MODE)+'\r\n').encode(encoding='ascii')
+    return shadow_query('operation')
 
-def laser_mod_polarity_CMD(args):
-    '''Sets laser modulation polarity'''
-
-    check = "'01' if args[0].upper() == laser('SOUR:AM:MPOL?') else '00')"
-    final = "laser('SOUR:AM:MPOL '+args[0].upper())"
-    result = command(args, [['PASS', 'INVERT']], final, check)
+#######################################
 
-    return return_code(result)
+laser_mod_polarity_CMD = CommandSpec(   ## Sets laser modulation polarity
+    args   = [Choice('PASS', 'INVERT')],
+    checks = [lambda v: '01' if v[0] == shadow_read('polarity', 'SOUR:AM:MPOL?') else '00'],
+    action = lambda v: laser('SOUR:AM:MPOL '+v[0]),
+    update = lambda v: written('polarity', 'SOUR:AM:MPOL?', v[0]))
 
-def laser_mod_polarity_QUERY():
+def laser_mod_polarity_QUERY(fresh=False):
     '''Gets laser modulation polarity'''
 
-    return query(laser("SYST:AM:MPOL?"))
+    return query(poller.get("SOUR:AM:MPOL?", fresh))
+
+#######################################
+
+def modulation_unchanged(values):
+    '''Warns if modulation mode, period and delay are already as requested'''
+
+    if (values[0].lower() == registers.get('modulation')
+    and values[1] == registers.get('period')
+    and values[2] == registers.get('delay')): return '01'
+    return '00'
+
+def set_modulation(values):
+    '''Records new modulation mode, period and delay'''
 
-def laser_modulation_CMD(args):
-    '''Sets modulation mode, period and delay of laser'''
+    registers.set('modulation', values[0].lower())
+    registers.set('period', values[1])
+    registers.set('delay', values[2])
 
-    #check_1 = "'26' if (LASER_MODE == 'gated' and (args[0].lower() not in ['square', 'pulse']) else '00'"
-    #check_2 = "'25' if (args[0].lower in ['sine', 'triangle', 'sawtooth'] and (args[1] > 1000 or args[2] > 1000)) else '00'"
-    #check_3 = "'01' if (args[0].lower() == LASER_MODULATION and args[1] == LASER_MODULATION_PERIOD and args[2] == LASER_MODULATION_DELAY) else '00'"
-    #final =
-    #result = command(args, [['none', 'sine', 'square', 'triangle', 'sawtooth', 'pulse'],[0, 3600000],[0, 3600000]])
-    return ''
-    #return return_code(result)
+laser_modulation_CMD = CommandSpec( ## Sets modulation mode, period and delay of laser
+    args   = [Choice('NONE', 'SINE', 'SQUARE', 'TRIANGLE', 'SAWTOOTH', 'PULSE'),
+              Number(0, 3600000), Number(0, 3600000)],
+    checks = [lambda v: gated_compatible(registers.get('operation').upper(), v[0].lower()),
+              modulation_unchanged],
+    action = lambda v: arduino.setModulationMode(v[0].lower(), v[1], v[2]),
+    update = set_modulation)
 
 def laser_modulation_QUERY():
     '''Gets modulation mode and paramters of laser'''
 
-    return (str(LASER_MODULATION)+'\r\n').encode(encoding='ascii')
+    return (' '.join(str(registers.get(name)) if registers.get(name) is not None
+                     else 'UNKNOWN' for name in ['modulation', 'period', 'delay'])
+            +'\r\n').encode(encoding='ascii')
+
+#######################################
+
+def waveform_unchanged(values):
+    '''Warns if arbitrary waveform, period and delay are already as requested'''
+
+    if values[0].lower() != registers.get('waveform'): return '00'
+    return modulation_unchanged(['ARBITRARY'] + values[1:])
+
+def set_waveform(values):
+    '''Records new arbitrary waveform, period and delay'''
+
+    set_modulation(['ARBITRARY'] + values[1:])
+    registers.set('waveform', values[0].lower())
 
-def laser_trigger_threshold_CMD(args):
-    return ''
+laser_waveform_CMD = CommandSpec(   ## Plays precomputed wave of any shape (arbitrary mode)
+    args   = [Choice(*waveform.shapes),
+              Number(2 * config.WAVEFORM_MIN_SAMPLE_US / 1e3, 3600000), Number(0, 3600000)],
+    checks = [lambda v: gated_compatible(registers.get('operation').upper(), 'arbitrary'),
+              waveform_unchanged],
+    action = lambda v: arduino.setModulationMode('arbitrary', v[1], v[2], v[0].lower()),
+    update = set_waveform,
+    budget = 'upload')
+
+def laser_waveform_QUERY():
+    '''Gets shape of arbitrary waveform, or NONE if another mode is in use'''
+
+    if registers.get('modulation') != 'arbitrary': return b'NONE\r\n'
+    return shadow_query('waveform')
+
+#######################################
+
+laser_trigger_threshold_CMD = CommandSpec(  ## Sets camera trigger threshold
+    args   = [Number(0, 100)],
+    checks = [lambda v: '01' if v[0] == registers.get('threshold') else '00'],
+    action = lambda v: arduino.setTriggerThreshold(v[0]),
+    update = lambda v: registers.set('threshold', v[0]))
 
 def laser_trigger_threshold_QUERY():
-    return ''
+    '''Gets camera trigger threshold'''
+
+    return shadow_query('threshold')
+
+##### RULEBOOK FUNCTIONS - APPLY ##############################################
+
+## commands that APPLY can carry out together (the last check of each warns
+## if it would have no effect, the others check it against the current state)
+apply_specs = {
+    'LASER_MAINS'              : laser_mains_CMD,
+    'LASER_POWER'              : laser_power_CMD,
+    'LASER_MODE'               : laser_mode_CMD,
+    'LASER_MOD_POLARITY'       : laser_mod_polarity_CMD,
+    'LASER_MODULATION'         : laser_modulation_CMD,
+    'LASER_TRIGGER_THRESHOLD'  : laser_trigger_threshold_CMD,
+}
+
+def apply_changes(settings):
+    '''Returns the sub-commands of APPLY that would have an effect'''
+
+    return {name: values for name, values in settings.items()
+            if apply_specs[name].checks[-1](values) == '00'}
+
+def apply_check(settings):
+    '''Checks sub-commands against the state they leave behind, not the current one'''
+
+    mode = settings.get('LASER_MODE', [registers.get('operation').upper()])[0]
+    modulation = settings.get('LASER_MODULATION', [registers.get('modulation')])[0]
+    status = gated_compatible(mode, modulation.lower() if modulation else None)
+    if status != '00': return status
+    return '00' if apply_changes(settings) else '01'
+
+def restore_setpoints(before, names):
+    '''Sets Arduino setpoints back to the values they had before APPLY'''
+
+    previous = {name: before[name] for name in names}
+    if None in previous.values() or arduino.setSetpoints(
+            mode=before['modulation'], **previous) != '00':
+        registers.invalidate('arduino')
+
+def restore_polarity(before):
+    '''Sets laser modulation polarity back to the value it had before APPLY'''
+
+    if before is None or laser('SOUR:AM:MPOL ' + before)[0] != '00':
+        registers.invalidate('laser')
+    else: poller.store('SOUR:AM:MPOL?', before)
+
+def apply_settings(settings):
+    '''
+    Carries out the sub-commands of APPLY that have an effect, all or nothing
+
+        - the Arduino setpoints (power, threshold, period, delay) are sent in
+          one frame, while the laser sets its polarity (or switches off)
+        - switching the laser on waits until everything else was applied, so
+          it never emits with only some of the new settings
+        - if any part fails, the parts already applied are set back to their
+          previous values (switching off is never undone) and the error of
+          the failed part is returned
+    '''
+    changes = apply_changes(settings)
+    before = {name: registers.get(name) for name in
+              ['polarity', 'operation', 'power', 'threshold', 'modulation', 'period', 'delay']}
+    undo = []                           ## of applied parts, run in reverse
+    failed = None
+
+    ## laser messages are on their way while the Arduino frame is sent
+    sent = []
+    if 'LASER_MOD_POLARITY' in changes:
+        sent.append((BioRay.submit('SOUR:AM:MPOL ' + changes['LASER_MOD_POLARITY'][0]),
+                     lambda: restore_polarity(before['polarity'])))
+    if changes.get('LASER_MAINS') == ['OFF']:
+        sent.append((BioRay.submit('SOUR:AM:STAT OFF'), lambda: None))
+
+    if 'LASER_MODE' in changes:
+        arduino.setOperationMode(changes['LASER_MODE'][0].lower())
+        undo.append(lambda: arduino.setOperationMode(before['operation']))
+
+    setpoints = {}
+    if 'LASER_POWER' in changes: setpoints['power'] = changes['LASER_POWER'][0]
+    if 'LASER_TRIGGER_THRESHOLD' in changes:
+        setpoints['threshold'] = changes['LASER_TRIGGER_THRESHOLD'][0]
+    mode = before['modulation']
+    if 'LASER_MODULATION' in changes:
+        mode, setpoints['period'], setpoints['delay'] = changes['LASER_MODULATION']
+        mode = mode.lower()
+        arduino.setModulationPins(mode)
+        undo.append(lambda: arduino.setModulationPins(before['modulation']))
+    if setpoints:
+        result = arduino.setSetpoints(mode=mode, **setpoints)
+        if result == '00': undo.append(lambda: restore_setpoints(before, setpoints))
+        else: failed = result
+
+    for future, restore in sent:
+        result = BioRay.result(future)
+        if result[0] == '00': undo.append(restore)
+        elif failed is None: failed = result
+
+    if failed is None and changes.get('LASER_MAINS') == ['ON']:
+        result = laser('SOUR:AM:STAT ON')
+        if result[0] != '00': failed = result
+
+    if failed is None: return '00'
+    for restore in reversed(undo): restore()
+    return failed
+
+def apply_update(settings):
+    '''Records the state left by every sub-command of APPLY'''
+
+    for name, values in settings.items():
+        apply_specs[name].update(values)
+
+apply_CMD = CommandSpec(            ## Applies several settings at once, all or nothing
+    args   = [Settings(apply_specs)],
+    checks = [lambda v: apply_check(v[0])],
+    action = lambda v: apply_settings(v[0]),
+    update = lambda v: apply_update(v[0]))
+
+##### HOT-REPLUG ##############################################################
+
+## watch the device nodes of every serial port, so that a laser or Arduino
+## whose USB adapter resets fails fast while it is gone, and is given its
+## settings back as soon as it re-enumerates
+watcher = PortWatcher()
+
+def port_changed(port, present):
+    '''Fails messages to an unplugged device at once, restores a replugged one'''
+
+    name, kind = port
+    metrics.count('hotplug_events', (('device', name + '.' + kind),
+                                     ('event', 'replugged' if present else 'unplugged')))
+    if not present:
+        (BioRay.session if kind == 'laser' else arduino.link).of(name).unplug()
+    else:                               ## slow, so not on the watcher thread
+        Thread(target=devices.bound(name, replugged), args=(kind,), daemon=True).start()
+
+watcher.listeners.append(port_changed)
+
+def restore_laser(known):
+    '''Checks that a replugged laser answers, then sets its polarity back'''
+
+    result = poller.get('SYST:STAT?', fresh=True)
+    if result[0] != '00': return result
+    if known['polarity'] is None: return '00'
+    settings = {'LASER_MOD_POLARITY': [known['polarity']]}
+    result = apply_settings(settings)
+    if result == '00': apply_update(settings)
+    return result
+
+def restore_arduino(known):
+    '''Sets setpoints and modulation of a freshly reset Arduino back'''
+
+    arduino.setOperationMode(registers.get('operation'))   ## reset cleared the pins
+    power = known['power'] if interlock_check()[0] == '0' else 0.0
+    settings = {'LASER_POWER': [power if power is not None else 0.0]}
+    if known['threshold'] is not None:
+        settings['LASER_TRIGGER_THRESHOLD'] = [known['threshold']]
+    if known['modulation'] not in [None, 'arbitrary']:
+        settings['LASER_MODULATION'] = [known['modulation'].upper(),
+                                        known['period'], known['delay']]
+    result = apply_settings(settings)
+    if result != '00': return result
+    apply_update(settings)
+
+    if known['modulation'] == 'arbitrary' and known['waveform'] is not None:
+        values = [known['waveform'], known['period'], known['delay']]
+        result = laser_waveform_CMD.action(values)
+        if result != '00': return result
+        set_waveform(values)
+    return '00'
+
+def replugged(kind):
+    '''
+    Sets up a laser or Arduino that is back on the USB bus as it was before
+
+        - the port is opened afresh; the laser must answer a status query,
+          the Arduino is reset as at startup (as re-enumerating resets it)
+        - the last known settings (see shadow.py) are then applied as by
+          APPLY; emission is never switched back on, and the power is set
+          to 0 unless the interlock allows commands
+        - a device that does not answer yet is tried again every
+          config.HOTPLUG_PERIOD, for up to config.HOTPLUG_SETTLE seconds
+    '''
+    start = time.perf_counter()
+    known = registers.last_known()      ## before a reset overwrites them
+    if kind == 'laser': BioRay.session.replug()
+    else: arduino.link.replug()
+    give_up = time.monotonic() + config.HOTPLUG_SETTLE
+    reset = kind == 'laser'             ## whether the Arduino was reset already
+    while True:
+        try:
+            with budget.until(give_up):
+                if not reset:
+                    result = arduino.reset() or '00'
+                    reset = result == '00'
+                if reset:
+                    result = restore_laser(known) if kind == 'laser' else restore_arduino(known)
+        except Exception as e:          ## logged, and tried again
+            log_exception('RESTORING REPLUGGED ' + devices.current().upper() + '.' + kind.upper())
+            result = ['30', str(e)]
+        if result == '00' or time.monotonic() >= give_up: break
+        time.sleep(config.HOTPLUG_PERIOD)
+    metrics.observe('hotplug_recovery', (('device', devices.current() + '.' + kind),
+                                         ('result', result if type(result) is str else result[0])),
+                    time.perf_counter() - start)
 
 ##### RULEBOOK FUNCTIONS - POWER, AMPS, TEMP ##################################
 
+def not_implemented():
+    '''Reply to a query the controller does not support yet, on a line of its own'''
+
+    return return_code(['20', 'Query is not implemented yet'])
+
 def power_now_QUERY():
-    return ''
+    return not_implemented()
 
 def power_max_QUERY():
-    return ''
+    return not_implemented()
 
 def power_nom_QUERY():
-    return ''
+    return not_implemented()
 
 def amps_now_QUERY():
-    return ''
+    return not_implemented()
 
-def temp_internal_now_QUERY():
-    return ''
+def temp_internal_now_QUERY(fresh=False):
+    return query(poller.get("SOUR:TEMP:INT?", fresh))
 
-def temp_diode_now_QUERY():
-    return ''
+def temp_diode_now_QUERY(fresh=False):
+    return query(poller.get("SOUR:TEMP:DIOD?", fresh))
 
 def temp_diode_max_QUERY():
-    return ''
+    return not_implemented()
 
 def temp_diode_min_QUERY():
-    return ''
+    return not_implemented()
 
 ##### RULEBOOK FUNCTIONS - INFO ###############################################
 
 def info_laser_QUERY():
     # some compound function
-    return ''
+    return not_implemented()
 
 def info_server_QUERY():
-    return 'I14 Laser Controller | Written in: Python 3.5 | Running on: RPi 3 B+'
+    return 'I14 Laser Controller | Written in: Python 3.5 | Running on: RPi 3 B+\r\n'
 
 ##### RULEBOOK FUNCTIONS - INTERLOCK ##########################################
 
 def interlock_status_QUERY():
-    if GPIO.input(23) == 0:
-        return 'OPEN'
+    if not monitor.closed:
+        return 'OPEN\r\n'
     else:
-        return 'CLOSED'
+        return 'CLOSED\r\n'
 
 def interlock_override_QUERY():
-    if GPIO.input(24) == 0:
-        return 'OFF'
+    if not monitor.override:
+        return 'OFF\r\n'
     else:
-        return 'ON'
+        return 'ON\r\n'
 
 ##### RULEBOOK FUNCTIONS - STRICT MODE ########################################
 
-def strict_mode_CMD(args):
-    pass
+def set_strict_mode(values):
+    '''Records whether out of range arguments are errors or warnings'''
+
+    global STRICT_MODE
+    STRICT_MODE = values[0] == 'ON'
+
+strict_mode_CMD = CommandSpec(      ## Sets status of strict mode
+    args      = [Choice('ON', 'OFF')],
+    checks    = [lambda v: '01' if (v[0] == 'ON') == STRICT_MODE else '00'],
+    action    = lambda v: '00',
+    update    = set_strict_mode,
+    interlock = False)
 
 def strict_mode_QUERY():
-    pass
+    return 'ON\r\n' if STRICT_MODE else 'OFF\r\n'
+
+##### RULEBOOK FUNCTIONS - TELEMETRY ##########################################
+
+def modulation_field():
+    '''Returns modulation mode, period and delay as one telemetry field'''
+
+    values = [registers.get(name) for name in ['modulation', 'period', 'delay']]
+    return '/'.join('UNKNOWN' if value is None else str(value) for value in values)
+
+def laser_field(register):
+    '''Returns function giving polled laser register as a telemetry field'''
+
+    def field():
+        result = poller.get(register)
+        return result[1] if result[0] == '00' else 'ERR'
+    return field
+
+## fields that clients can subscribe to, sampled once per publisher tick (of
+## the current device, so they are bound to one with device_fields)
+telemetry_fields = {
+    'STATUS'        : laser_field('SYST:STAT?'),
+    'FAULT'         : laser_field('SYST:FAUL?'),
+    'MAINS'         : laser_field('SOUR:AM:STAT?'),
+    'POWER'         : lambda: registers.get('power'),
+    'TEMP_DIODE'    : laser_field('SOUR:TEMP:DIOD?'),
+    'TEMP_INTERNAL' : laser_field('SOUR:TEMP:INT?'),
+    'INTERLOCK'     : lambda: monitor.status(),
+    'MODULATION'    : modulation_field,
+}
+
+def device_fields(name, fields):
+    '''Returns telemetry fields that always sample a device'''
+
+    return {field: devices.bound(name, sample) for field, sample in fields.items()}
+
+def telemetry_prefix(name):
+    '''Returns start of telemetry lines of a device, addressed unless default'''
+
+    return '!TELEMETRY' if name == config.DEFAULT_DEVICE else '!TELEMETRY @' + name
+
+def new_publisher(name):
+    '''Creates and starts telemetry publisher of a device'''
+
+    created = TelemetryPublisher(device_fields(name, telemetry_fields), telemetry_prefix(name))
+    created.start()
+    return created
+
+publisher = devices.PerDevice(new_publisher)
+
+def unsubscribe(client, device=None):
+    '''Stops subscriptions of client to device (None: every device), returns whether it had any'''
+
+    return any([created.unsubscribe(client) for name, created in publisher.created()
+                if device in (None, name)])
+
+def state():
+    '''Returns every telemetry field of every device, as strings'''
+
+    return {name: publisher.of(name).sample(telemetry_fields) for name in devices.names()}
+
+def state_QUERY():
+    '''Gets every telemetry field of a device at once, as FIELD=value words'''
+
+    values = publisher.sample(telemetry_fields)
+    return ' '.join(field + '=' + values[field] for field in telemetry_fields) + '\r\n'
+
+##### RULEBOOK FUNCTIONS - HISTORY ############################################
+
+## numeric telemetry fields, recorded every config.HISTORY_PERIOD
+history_fields = {field: telemetry_fields[field] for field in
+                  ['POWER', 'FAULT', 'TEMP_DIODE', 'TEMP_INTERNAL', 'INTERLOCK']}
+
+history = devices.PerDevice(lambda name: History(
+    history_fields, path=devices.filename(config.HISTORY_FILE, name)))
+
+## started by startup()
+recorder = devices.PerDevice(lambda name: HistoryRecorder(
+    history.of(name), device_fields(name, history_fields)))
+
+def record_interlock(status):
+    '''Records interlock changes as they happen, not only when sampled'''
+
+    for name, kept in history.created(): kept.record('INTERLOCK', status)
+
+monitor.listeners.append(record_interlock)
+
+def history_QUERY(values):
+    '''
+    Gets history of a field as one line of points
+
+        - arguments: field, start and end of range (UNIX time, or seconds
+          relative to now if zero or negative), seconds per point
+        - one word per point, oldest first: time,min,max,mean
+        - NONE if nothing was recorded in the range
+    '''
+
+    field, start, end, resolution = values
+    now = time.time()
+    if start <= 0: start += now
+    if end <= 0: end += now
+    if end < start: return return_code('25')
+    if (end - start) / resolution > config.HISTORY_MAX_POINTS: return return_code('25')
+
+    points = history.series(field, start, end, resolution)
+    if len(points) == 0: return 'NONE\r\n'
+    return ' '.join('%d,%g,%g,%g' % point for point in points) + '\r\n'
+
+subscribe_CMD = CommandSpec(        ## Streams telemetry fields at rate (Hz)
+    args      = [ChoiceList(*telemetry_fields), Number(0.01, config.TELEMETRY_MAX_RATE)],
+    action    = lambda v, client: publisher.subscribe(client, v[0], v[1]),
+    interlock = False,
+    client    = True)
+
+unsubscribe_CMD = CommandSpec(      ## Stops telemetry (of all devices unless addressed)
+    args      = [],
+    action    = lambda v, client: '00' if unsubscribe(client, devices.chosen()) else '01',
+    interlock = False,
+    client    = True)
+
+##### SERIAL I/O STATS ########################################################
+
+def io_stats_QUERY():
+    '''
+    Gets queue statistics of the laser and Arduino I/O schedulers
+
+        - one word per scheduler that has been used, named after its device,
+          e.g. LASER1.LASER:requests=..,executed=..,coalesced=..,expired=..,
+          cancelled=..,rejected=..,late=..,superseded=.. followed by LANE=depth/max_depth/mean wait (ms)/max
+          wait (ms) for the SAFETY, WRITE and READ lanes
+    '''
+
+    schedulers = [scheduler for name, scheduler in BioRay.scheduler.created()]
+    schedulers += [link.scheduler for name, link in arduino.link.created()]
+    words = []
+    for scheduler in sorted(schedulers, key=lambda scheduler: scheduler.device):
+        name = scheduler.device.upper()
+        stats = scheduler.stats()
+        fields = ['%s=%d' % (count, stats[count]) for count in
+                  ['requests', 'executed', 'coalesced', 'expired', 'cancelled', 'rejected', 'late',
+                   'superseded']]
+        fields += ['%s=%d/%d/%.3f/%.3f' % (lane, stats[lane]['depth'], stats[lane]['max_depth'],
+                                           stats[lane]['wait_mean_ms'], stats[lane]['wait_max_ms'])
+                   for lane in lane_names]
+        words.append(name + ':' + ','.join(fields))
+    return ' '.join(words) + '\r\n'
+
+##### METRICS #################################################################
+
+def metrics_QUERY():
+    '''
+    Gets all counters and latency histograms (see metrics.py)
+
+        - counters as name{labels}=count, for return codes, interlock
+          transitions and devices unplugged or replugged
+        - histograms as name{labels}=count/p50/p99/max (ms), for commands,
+          serial round trips (open, write and read phases) and how long
+          replugged devices took to be restored
+    '''
+
+    return metrics.registry.summary() + '\r\n'
+
+##### TRACING #################################################################
+
+def set_tracing(values):
+    tracing.enabled = values[0] == 'ON'
+
+tracing_CMD = CommandSpec(          ## Switches recording of request traces
+    args      = [Choice('ON', 'OFF')],
+    checks    = [lambda v: '01' if (v[0] == 'ON') == tracing.enabled else '00'],
+    action    = lambda v: '00',
+    update    = set_tracing,
+    interlock = False)
+
+def tracing_QUERY():
+    return 'ON\r\n' if tracing.enabled else 'OFF\r\n'
+
+def traces_QUERY():
+    '''
+    Gets the most recent traces slower than config.TRACE_SLOW
+
+        - one word per trace, most recent first: connection,COMMAND,total
+          followed by span@start+length for every span (ms since the
+          request was framed), nested spans are prefixed with one dot per
+          level, e.g. 127.0.0.1:5000,LASER_POWER,2.1,parse@0.01+2.0,...
+        - NONE if no recent trace was that slow
+    '''
+
+    found = tracing.slow()
+    if len(found) == 0: return 'NONE\r\n'
+    return ' '.join(trace.describe() for trace in found) + '\r\n'
+
+##### TIMED PROGRAMS ##########################################################
+
+def program_command(words):
+    '''Checks that a program step is a valid command, returns error codes'''
+
+    spec = rulebook.get(words[0])
+    if not isinstance(spec, CommandSpec) or spec.client or words[0].startswith('PROGRAM'):
+        return '20'                     ## queries, subscriptions and programs
+    code, values = argument_check(words[1:], spec.args)
+    return '00' if values is not None else code
+
+def add_program_step(values):
+    '''Appends a command to a program, to be run offset ms after its start'''
+
+    name, offset, words = values
+    words = [words[0].upper()] + words[1:]
+    code = program_command(words)
+    if code != '00': return code
+    run = devices.bound(devices.current(),      ## programs run in their own thread
+                        lambda cancel: parse(words)[:2].decode(encoding='ascii'))
+    return programs.add(name, Step(offset / 1e3, ' '.join(words), run))
+
+def ramp_power(start, end, duration, cancel):
+    '''Ramps laser power linearly from start to end (%) over duration (ms)'''
+
+    status = interlock_check()
+    if status[0] != '0': return status
+    count = int(duration / 1e3 * config.PROGRAM_RAMP_RATE) + 1
+    if count < 2:
+        result = arduino.setLaserPower(end)
+    else:
+        result = arduino.streamPower(
+            [int(4095 * (start + (end - start) * i / (count - 1)) / 100 + 0.5)
+             for i in range(count)], config.PROGRAM_RAMP_RATE, cancel)
+    if result == '00' and not cancel.is_set(): registers.set('power', end)
+    return result
+
+def add_program_ramp(values):
+    '''Appends a power ramp to a program, to be run offset ms after its start'''
+
+    name, offset, start, end, duration = values
+    run = devices.bound(devices.current(),
+                        lambda cancel: ramp_power(start, end, duration, cancel))
+    return programs.add(name, Step(offset / 1e3, 'RAMP %g %g %g' % (start, end, duration), run))
+
+program_step_CMD = CommandSpec(     ## Adds a command to a program
+    args      = [Word(), Number(0, 86400000), Rest()],
+    action    = add_program_step,
+    interlock = False)
+
+program_ramp_CMD = CommandSpec(     ## Adds a power ramp to a program
+    args      = [Word(), Number(0, 86400000), Number(0, 100), Number(0, 100),
+                 Number(0, 3600000)],
+    action    = add_program_ramp,
+    interlock = False)
+
+program_clear_CMD = CommandSpec(    ## Removes a program
+    args      = [Word()],
+    action    = lambda v: programs.clear(v[0]),
+    interlock = False)
+
+program_run_CMD = CommandSpec(      ## Starts running a program
+    args      = [Word()],
+    action    = lambda v: programs.run(v[0]))
+
+program_abort_CMD = CommandSpec(    ## Stops the running program
+    args      = [],
+    action    = lambda v: programs.abort(),
+    interlock = False)
+
+def program_status_QUERY():
+    '''Gets state, progress and step timing of running (or last) program'''
+
+    return programs.status() + '\r\n'
 
 ##### RULEBOOK ################################################################
 
 rulebook = {
     'LASER_MAINS'              : laser_mains_CMD,
-    '?LASER_MAINS'             : laser_mains_QUERY,
+    '?LASER_MAINS'             : QuerySpec(laser_mains_QUERY, fresh=True),
     'LASER_POWER'              : laser_power_CMD,
-    '?LASER_POWER'             : laser_power_QUERY,
-    '?LASER_STATUS'            : laser_status_QUERY,
-    '?LASER_FAULT'             : laser_fault_QUERY,
+    '?LASER_POWER'             : QuerySpec(laser_power_QUERY),
+    '?LASER_STATUS'            : QuerySpec(laser_status_QUERY, fresh=True),
+    '?LASER_FAULT'             : QuerySpec(laser_fault_QUERY, fresh=True),
     'LASER_MODE'               : laser_mode_CMD,
-    '?LASER_MODE'              : laser_mode_QUERY,
+    '?LASER_MODE'              : QuerySpec(laser_mode_QUERY),
     'LASER_MOD_POLARITY'       : laser_mod_polarity_CMD,
-    '?LASER_MOD_POLARITY'      : laser_mod_polarity_QUERY,
+    '?LASER_MOD_POLARITY'      : QuerySpec(laser_mod_polarity_QUERY, fresh=True),
     'LASER_MODULATION'         : laser_modulation_CMD,
-    '?LASER_MODULATION'        : laser_modulation_QUERY,
+    '?LASER_MODULATION'        : QuerySpec(laser_modulation_QUERY),
+    'LASER_WAVEFORM'           : laser_waveform_CMD,
+    '?LASER_WAVEFORM'          : QuerySpec(laser_waveform_QUERY),
     #######################
     'LASER_TRIGGER_THRESHOLD'  : laser_trigger_threshold_CMD,
-    '?LASER_TRIGGER_THRESHOLD' : laser_trigger_threshold_QUERY,
+    '?LASER_TRIGGER_THRESHOLD' : QuerySpec(laser_trigger_threshold_QUERY),
     #######################
-    '?POWER_NOW'               : power_now_QUERY,
-    '?POWER_MAX'               : power_max_QUERY,
-    '?POWER_NOM'               : power_nom_QUERY,
-    '?AMPS_NOW'                : amps_now_QUERY,
-    '?TEMP_INTERNAL_NOW'       : temp_internal_now_QUERY,
-    '?TEMP_DIODE_NOW'          : temp_diode_now_QUERY,
-    '?TEMP_DIODE_MAX'          : temp_diode_max_QUERY,
-    '?TEMP_DIODE_MIN'          : temp_diode_min_QUERY,
+    'APPLY'                    : apply_CMD,
     #######################
-    '?INFO_LASER'              : info_laser_QUERY,
-    '?INFO_SERVER'             : info_server_QUERY,
+    '?POWER_NOW'               : QuerySpec(power_now_QUERY),
+    '?POWER_MAX'               : QuerySpec(power_max_QUERY),
+    '?POWER_NOM'               : QuerySpec(power_nom_QUERY),
+    '?AMPS_NOW'                : QuerySpec(amps_now_QUERY),
+    '?TEMP_INTERNAL_NOW'       : QuerySpec(temp_internal_now_QUERY, fresh=True),
+    '?TEMP_DIODE_NOW'          : QuerySpec(temp_diode_now_QUERY, fresh=True),
+    '?TEMP_DIODE_MAX'          : QuerySpec(temp_diode_max_QUERY),
+    '?TEMP_DIODE_MIN'          : QuerySpec(temp_diode_min_QUERY),
     #######################
-    '?INTERLOCK_STATUS'        : interlock_status_QUERY,
-    '?INTERLOCK_OVERRIDE'      : interlock_override_QUERY,
+    '?INFO_LASER'              : QuerySpec(info_laser_QUERY),
+    '?INFO_SERVER'             : QuerySpec(info_server_QUERY),
+    #######################
+    '?INTERLOCK_STATUS'        : QuerySpec(interlock_status_QUERY),
+    '?INTERLOCK_OVERRIDE'      : QuerySpec(interlock_override_QUERY),
     #######################
     'STRICT_MODE'              : strict_mode_CMD,
-    '?STRICT_MODE'             : strict_mode_QUERY
+    '?STRICT_MODE'             : QuerySpec(strict_mode_QUERY),
+    #######################
+    'SUBSCRIBE'                : subscribe_CMD,
+    'UNSUBSCRIBE'              : unsubscribe_CMD,
+    '?STATE'                   : QuerySpec(state_QUERY),
+    #######################
+    'PROGRAM_STEP'             : program_step_CMD,
+    'PROGRAM_RAMP'             : program_ramp_CMD,
+    'PROGRAM_CLEAR'            : program_clear_CMD,
+    'PROGRAM_RUN'              : program_run_CMD,
+    'PROGRAM_ABORT'            : program_abort_CMD,
+    '?PROGRAM_STATUS'          : QuerySpec(program_status_QUERY),
+    #######################
+    '?IO_STATS'                : QuerySpec(io_stats_QUERY),
+    '?METRICS'                 : QuerySpec(metrics_QUERY),
+    #######################
+    'TRACING'                  : tracing_CMD,
+    '?TRACING'                 : QuerySpec(tracing_QUERY),
+    '?TRACES'                  : QuerySpec(traces_QUERY),
+    #######################
+    '?HISTORY'                 : QuerySpec(history_QUERY, args=[
+                                     Choice(*history_fields), Number(-1e10, 1e10),
+                                     Number(-1e10, 1e10), Number(1, 1e7)])
 }
 
+##### DEADLINES ###############################################################
+
+deadline_arg = Number(1, 3600000)       ## milliseconds, as in !DEADLINE=250
+
+def split_deadline(args):
+    '''
+    Removes a deadline the client gave as last word, e.g. "?LASER_STATUS
+    !fresh !DEADLINE=250", from a message
+
+    Returns:
+        Error code, remaining words, and seconds of deadline (None if not given)
+    '''
+    if len(args) < 2 or not args[-1].upper().startswith('!DEADLINE='): return '00', args, None
+    code, value = deadline_arg.check(args[-1][len('!DEADLINE='):], True)
+    return code, args[:-1], None if value is None else value / 1e3
+
 ##### MAIN ####################################################################
 
-def parse(args):
-    if args[0] not in rulebook.keys(): return return_code('20')
-    if args[0][0] == '?':
-        return rulebook[args[0]]()
+def parse(args, client=None):
+    if not started.is_set(): startup()
+    if args[0].startswith('@'):         ## e.g. @laser2 LASER_POWER 40
+        if args[0][1:] not in config.DEVICES: return return_code('16')
+        if len(args) == 1: return return_code('13')
+        with devices.using(args[0][1:]): return parse(args[1:], client)
+    code, args, deadline = split_deadline(args)
+    if code != '00': return return_code(code)
+    start = time.perf_counter()
+    spec = rulebook.get(args[0])
+    if spec is None:
+        result = return_code('20')
+        command = 'UNKNOWN'             ## keep unknown words out of labels
     else:
-        return rulebook[args[0]](args[1:])
+        if deadline is None: deadline = config.BUDGETS[spec.budget]
+        with tracing.span('command'), budget.within(deadline):
+            result = spec(args[1:], client)
+        command = args[0]
+    metrics.observe('command', (('command', command),), time.perf_counter() - start)
+    return result
@@ -0,0 +1,233 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Network front-end: parses commands of its clients in a process of its own,
+## forwards them to the hardware daemon (see daemon.py) and answers telemetry
+## from the shared snapshot
+
+##### IMPORTS #################################################################
+
+import os                               ## for noticing that the daemon died
+import time                             ## for age of the snapshot
+import socket                           ## Unix socket of the daemon
+import itertools                        ## for numbering forwarded commands
+from threading import Thread, Lock, Event  ## replies are read in the background
+from concurrent.futures import Future, TimeoutError  ## waiting for replies
+import config                           ## socket, timeout and devices
+import devices                          ## device addressed by a command
+import tracing                          ## spans of each request, if enabled
+from errors import return_code          ## EXTERNAL RETURN CODE DICTIONARY
+from daemon import frame, readFrame     ## messages between the processes
+from externalParser import CommandSpec, QuerySpec, subscribe_CMD, split_deadline, \
+                           telemetry_fields, telemetry_prefix   ## shared rules
+from externalParser import rulebook as forwarded    ## budgets of daemon commands
+from telemetry import TelemetryPublisher    ## telemetry from the snapshot
+from snapshot import Snapshot           ## state written by the daemon
+
+##### DAEMON LINK #############################################################
+
+class daemonLink:
+    '''
+    Connection of a front-end to the hardware daemon, shared by its clients
+
+        - commands are numbered and sent as soon as they arrive, replies are
+          matched to them by number, so clients do not wait for each other
+        - unsolicited messages of the daemon (e.g. interlock changes) are
+          passed to listeners
+        - keep() connects as soon as the front-end starts and again once the
+          connection was lost, so unsolicited messages also reach clients
+          that never forward a command (e.g. SUBSCRIBE only); commands give
+          error 17 while the daemon cannot be reached
+    '''
+
+    def __init__(self, path=config.DAEMON_SOCKET, timeout=config.DAEMON_TIMEOUT):
+        '''
+        Init function for daemon link (does not connect yet)
+
+        Arguments:
+            path <str> - path of the Unix socket of the daemon
+            timeout <float> - seconds to wait for the reply to a command
+
+        Returns:
+            none
+        '''
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.pending = {}           ## number -> Future of reply
+        self.numbers = itertools.count()
+        self.listeners = []         ## called with every unsolicited message
+        self.lost = Event()         ## set when the connection was lost
+        self.lock = Lock()
+
+    def connect(self):
+        '''Connects to the daemon unless connected already (lock held)'''
+
+        if self.sock is not None: return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try: sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.lost.clear()
+        Thread(target=self.receive, args=(sock,), daemon=True).start()
+
+    def keep(self, period=config.DAEMON_RECONNECT):
+        '''Stays connected to the daemon, trying again every period, forever'''
+
+        while True:
+            with self.lock:
+                try: self.connect()
+                except OSError: pass
+                connected = self.sock is not None
+            if connected: self.lost.wait()
+            else: time.sleep(period)
+
+    def receive(self, sock):
+        '''Hands replies to waiting commands until the connection is lost'''
+
+        file = sock.makefile('rb')
+        try:
+            while True:
+                number, data = readFrame(file)
+                if number == '*':
+                    for listener in self.listeners: listener(data)
+                    continue
+                with self.lock: future = self.pending.pop(number, None)
+                if future is not None: future.set_result(data)
+        except (EOFError, OSError, ValueError):
+            pass
+        finally:
+            with self.lock:
+                if self.sock is sock:
+                    self.sock = None
+                    self.lost.set()
+                pending, self.pending = self.pending, {}
+            sock.close()
+            for future in pending.values(): future.set_result(return_code('17'))
+
+    def request(self, peer, words, timeout=None):
+        '''
+        Runs a command in the daemon
+
+        Arguments:
+            peer <str> - address of client, for traces
+            words <list> - words of command, as received from client
+            timeout <float> - seconds to wait for the reply (None: self.timeout)
+
+        Returns:
+            Reply of daemon
+            Error codes (see local file errors.txt)
+        '''
+        future = Future()
+        with self.lock:
+            try:
+                self.connect()
+                number = str(next(self.numbers))
+                self.pending[number] = future
+                self.sock.sendall(frame(number, (peer + ' ' + ' '.join(words))
+                                                .encode(encoding='ascii')))
+            except OSError as e:
+                return return_code(['17', str(e)])
+        try:
+            return future.result(self.timeout if timeout is None else timeout)
+        except TimeoutError:
+            with self.lock: self.pending.pop(number, None)
+            return return_code('17')
+
+link = daemonLink()
+
+def timeout(words):
+    '''
+    Returns seconds to wait for the daemon to answer a command: its budget,
+    or the deadline the client gave, and a margin, so that the daemon gives
+    up first and the client gets the real result (e.g. 32) rather than 17
+    '''
+    code, words, deadline = split_deadline(words)
+    if deadline is None:
+        spec = forwarded.get(words[0])
+        deadline = config.BUDGETS['command' if spec is None else spec.budget]
+    return deadline + config.DAEMON_MARGIN
+
+def watchDaemon(period=1.0):
+    '''Ends this front-end once the daemon (its parent process) has died'''
+
+    parent = os.getppid()
+    while os.getppid() == parent: time.sleep(period)
+    os._exit(1)
+
+##### TELEMETRY FROM SNAPSHOT #################################################
+
+snapshot = Snapshot()
+
+def snapshot_field(name, field):
+    '''Returns function giving a telemetry field of a device from the snapshot'''
+
+    def sample():
+        state = snapshot.read()
+        if time.time() - state.get('time', 0) > config.DAEMON_TIMEOUT:
+            return None                 ## daemon stopped writing, do not guess
+        return state['devices'].get(name, {}).get(field)
+    return sample
+
+def new_publisher(name):
+    '''Creates and starts telemetry publisher of a device, fed by the snapshot'''
+
+    created = TelemetryPublisher({field: snapshot_field(name, field)
+                                  for field in telemetry_fields}, telemetry_prefix(name))
+    created.start()
+    return created
+
+publisher = devices.PerDevice(new_publisher)
+
+def unsubscribe(client, device=None):
+    '''Stops subscriptions of client to device (None: every device), returns whether it had any'''
+
+    return any([created.unsubscribe(client) for name, created in publisher.created()
+                if device in (None, name)])
+
+def state_QUERY():
+    '''Gets every telemetry field of a device at once, as FIELD=value words'''
+
+    values = publisher.sample(telemetry_fields)
+    return ' '.join(field + '=' + values[field] for field in telemetry_fields) + '\r\n'
+
+##### RULEBOOK ################################################################
+
+## commands answered by the front-end itself, everything else is forwarded
+rulebook = {
+    'SUBSCRIBE'                : CommandSpec(
+        args      = subscribe_CMD.args,
+        action    = lambda v, client: publisher.subscribe(client, v[0], v[1]),
+        interlock = False,
+        client    = True),
+    'UNSUBSCRIBE'              : CommandSpec(
+        args      = [],
+        action    = lambda v, client: '00' if unsubscribe(client, devices.chosen()) else '01',
+        interlock = False,
+        client    = True),
+    '?STATE'                   : QuerySpec(state_QUERY),
+}
+
+##### MAIN ####################################################################
+
+def parse(args, client=None):
+    name, command = None, args          ## None: the default device
+    if args[0].startswith('@'):         ## e.g. @laser2 SUBSCRIBE POWER 1
+        if args[0][1:] not in config.DEVICES: return return_code('16')
+        if len(args) == 1: return return_code('13')
+        name, command = args[0][1:], args[1:]
+    code, local, deadline = split_deadline(command)     ## as the daemon does
+    spec = rulebook.get(local[0])
+    if spec is not None:
+        if code != '00': return return_code(code)
+        with devices.using(name): return spec(local[1:], client)
+    with tracing.span('daemon'):
+        return link.request(getattr(client, 'peer', 'local'), args, timeout(command))
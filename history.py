@@ -0,0 +1,230 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Memory-bounded history of telemetry fields, kept between restarts
+
+##### IMPORTS #################################################################
+
+import os                               ## for replacing segment file atomically
+import json                             ## header of segment file
+import time                             ## wall clock, history survives restarts
+from array import array                 ## compact fixed-size storage
+from threading import Thread, Lock      ## recorder runs in the background
+import config                           ## tiers, period and segment file
+
+##### TIERS ###################################################################
+
+class Tier:
+    '''
+    Ring of fixed-width time buckets of one field
+
+        - a bucket holds min, max, sum and count of the values recorded in
+          it, and the number of the bucket (time // resolution) so that a
+          slot overwritten by a later bucket is recognised as such
+        - slot of a bucket is its number modulo the number of slots, so the
+          ring keeps the most recent resolution * slots seconds
+    '''
+
+    def __init__(self, resolution, slots):
+        self.resolution = resolution
+        self.slots = slots
+        self.ids = array('q', [-1]) * slots     ## bucket number held by slot
+        self.min = array('f', [0.0]) * slots
+        self.max = array('f', [0.0]) * slots
+        self.sum = array('d', [0.0]) * slots
+        self.count = array('I', [0]) * slots
+
+    def arrays(self):
+        return [self.ids, self.min, self.max, self.sum, self.count]
+
+    def record(self, timestamp, value):
+        '''Adds a value to the bucket it falls in, replacing an older bucket'''
+
+        bucket = int(timestamp // self.resolution)
+        slot = bucket % self.slots
+        if self.ids[slot] != bucket:
+            self.ids[slot] = bucket
+            self.min[slot] = self.max[slot] = self.sum[slot] = value
+            self.count[slot] = 1
+        else:
+            if value < self.min[slot]: self.min[slot] = value
+            if value > self.max[slot]: self.max[slot] = value
+            self.sum[slot] += value
+            self.count[slot] += 1
+
+    def buckets(self, start, end):
+        '''Yields (time, min, max, sum, count) of stored buckets in a range'''
+
+        first = max(int(start // self.resolution), int(end // self.resolution) - self.slots + 1)
+        for bucket in range(first, int(end // self.resolution) + 1):
+            slot = bucket % self.slots
+            if self.ids[slot] == bucket:
+                yield (bucket * self.resolution, self.min[slot], self.max[slot],
+                       self.sum[slot], self.count[slot])
+
+##### HISTORY #################################################################
+
+class History:
+    '''
+    History of numeric telemetry fields in a fixed memory budget
+
+        - every value is recorded in every tier, from raw samples over a
+          short window to coarse min/max/mean buckets over a long one, so
+          no separate downsampling pass is needed
+        - memory (and the segment file) is 28 bytes per slot of every tier
+          of every field, allocated up front and never grown
+        - queries are answered from the finest tier that still covers the
+          start of the range, re-aggregated to the requested resolution
+    '''
+
+    def __init__(self, fields, tiers=config.HISTORY_TIERS, path=config.HISTORY_FILE):
+        '''
+        Init function for history, loads segment file if its layout matches
+
+        Arguments:
+            fields <list> - names of recorded fields
+            tiers <list> - (resolution in seconds, number of slots) per tier,
+                           finest first
+            path <str> - segment file history is saved to (None: not saved)
+
+        Returns:
+            none
+        '''
+        self.fields = list(fields)
+        self.layout = [list(tier) for tier in tiers]
+        self.tiers = {field: [Tier(*tier) for tier in tiers] for field in self.fields}
+        self.path = path
+        self.lock = Lock()
+        if path is not None: self.load()
+
+    def record(self, field, value, timestamp=None):
+        '''Records a value of a field (non-numeric values are ignored)'''
+
+        try: value = float(value)
+        except (TypeError, ValueError): return
+        if value != value: return       ## NaN
+        if timestamp is None: timestamp = time.time()
+        with self.lock:
+            for tier in self.tiers[field]: tier.record(timestamp, value)
+
+    def series(self, field, start, end, resolution):
+        '''
+        Returns history of a field between two times
+
+        Arguments:
+            field <str> - name of field
+            start, end <float> - UNIX times of range
+            resolution <float> - seconds per returned point
+
+        Returns:
+            List of (time, min, max, mean), oldest first
+        '''
+        tiers = self.tiers[field]
+        now = time.time()
+        tier = tiers[-1]                ## coarsest, unless a finer one covers it
+        for candidate in tiers:
+            if candidate.resolution <= resolution and \
+               start >= now - candidate.resolution * candidate.slots:
+                tier = candidate
+                break
+        resolution = max(resolution, tier.resolution)
+
+        points = {}
+        with self.lock:
+            for stamp, low, high, total, count in tier.buckets(start, end):
+                key = int(stamp // resolution)
+                point = points.get(key)
+                if point is None: points[key] = [low, high, total, count]
+                else:
+                    point[0] = min(point[0], low)
+                    point[1] = max(point[1], high)
+                    point[2] += total
+                    point[3] += count
+        return [(key * resolution, low, high, total / count)
+                for key, (low, high, total, count) in sorted(points.items())]
+
+    def save(self):
+        '''Writes every tier to the segment file (replaced atomically)'''
+
+        if self.path is None: return
+        header = json.dumps({'version': 1, 'fields': self.fields, 'tiers': self.layout})
+        try:
+            with open(self.path + '.tmp', 'wb') as file:
+                file.write(header.encode(encoding='ascii') + b'\n')
+                with self.lock:
+                    for field in self.fields:
+                        for tier in self.tiers[field]:
+                            for values in tier.arrays(): values.tofile(file)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError:
+            pass                        ## history still works, only in memory
+
+    def load(self):
+        '''Reads tiers from the segment file, if it was saved with this layout'''
+
+        try:
+            with open(self.path, 'rb') as file:
+                header = json.loads(file.readline().decode(encoding='ascii'))
+                if header != {'version': 1, 'fields': self.fields, 'tiers': self.layout}:
+                    return              ## saved with other settings, start empty
+                for field in self.fields:
+                    for tier in self.tiers[field]:
+                        for values in tier.arrays():
+                            stored = array(values.typecode)
+                            stored.fromfile(file, len(values))
+                            values[:] = stored
+        except (OSError, ValueError, EOFError):
+            self.tiers = {field: [Tier(*tier) for tier in self.layout] for field in self.fields}
+
+##### RECORDER ################################################################
+
+class HistoryRecorder(Thread):
+    '''
+    Samples telemetry fields into a history at a fixed period
+
+        - fields are sampled with the same functions the telemetry publisher
+          uses, so sampling reads the snapshot rather than the laser
+        - the history is saved to its segment file every save_period
+    '''
+
+    def __init__(self, history, fields, period=config.HISTORY_PERIOD,
+                       save_period=config.HISTORY_SAVE_PERIOD):
+        '''
+        Init function for history recorder (call start() to begin)
+
+        Arguments:
+            history <History> - history values are recorded in
+            fields <dict> - field name to function returning its current value
+            period <float> - seconds between samples
+            save_period <float> - seconds between saves of segment file
+
+        Returns:
+            none
+        '''
+        Thread.__init__(self, daemon=True)
+        self.history = history
+        self.fields = fields
+        self.period = period
+        self.save_period = save_period
+
+    def run(self):
+        '''Samples all fields once every period, forever'''
+
+        deadline = saved = time.monotonic()
+        while True:
+            for field, sample in self.fields.items():
+                try: self.history.record(field, sample())
+                except Exception: pass  ## field unavailable, leave a gap
+            if time.monotonic() - saved >= self.save_period:
+                self.history.save()
+                saved = time.monotonic()
+            deadline += self.period
+            delay = deadline - time.monotonic()
+            if delay > 0: time.sleep(delay)
+            else: deadline = time.monotonic()   ## fell behind, do not catch up
@@ -0,0 +1,110 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Detection of serial devices that drop off the USB bus and come back
+
+##### IMPORTS #################################################################
+
+import os                               ## for looking at device nodes
+import time                             ## for the polling period
+from threading import Thread, Lock      ## watcher runs in the background
+import config                           ## polling period
+from errors import log_exception        ## failed listeners are logged
+
+##### DEVICE NODES ############################################################
+
+def identity(path):
+    '''
+    Returns what tells one device node at path from the next, or None
+
+        - symbolic links (such as /dev/serial/by-id/...) are followed, so a
+          stable path whose target changes counts as a different node
+        - a node that is removed and created again gets a new inode, even
+          if it keeps its name (e.g. /dev/ttyUSB0)
+    '''
+    try:
+        status = os.stat(path)
+    except OSError:
+        return None
+    return (status.st_dev, status.st_ino, status.st_rdev)
+
+##### PORT WATCHER ############################################################
+
+class PortWatcher(Thread):
+    '''
+    Watches the device nodes of serial ports, to notice a USB reset at once
+
+        - every watched path is looked at once every period (a stat of each,
+          so a short period costs next to nothing)
+        - listeners are called with (key, False) when the node of a port
+          disappears, and with (key, True) when it is back; a node that was
+          replaced between two looks is reported as gone, then back
+        - listeners run on the watcher thread, so they must not block for
+          long (anything slow belongs in a thread of its own); a listener
+          that raises is logged, and watching goes on
+    '''
+
+    def __init__(self, period=config.HOTPLUG_PERIOD):
+        '''
+        Init function for port watcher (call start() to begin)
+
+        Arguments:
+            period <float> - seconds between looks at the device nodes
+
+        Returns:
+            none
+        '''
+        Thread.__init__(self, daemon=True)
+        self.period = period
+        self.paths = {}                 ## key: path of device node
+        self.nodes = {}                 ## key: identity of node last seen
+        self.listeners = []             ## called with (key, present) on changes
+        self.lock = Lock()
+
+    def watch(self, key, path):
+        '''Starts watching path, reporting changes under key, e.g. (name, 'laser')'''
+
+        with self.lock:
+            self.paths[key] = path
+            self.nodes[key] = identity(path)
+
+    def present(self, key):
+        '''Returns whether the node of a watched port was there at the last look'''
+
+        with self.lock: return self.nodes.get(key) is not None
+
+    def look(self):
+        '''Looks at every watched node once, notifies listeners of changes'''
+
+        with self.lock: watched = list(self.paths.items())
+        for key, path in watched:
+            node = identity(path)
+            with self.lock:
+                before = self.nodes[key]
+                self.nodes[key] = node
+            if node == before: continue
+            if before is not None: self.notify(key, False)
+            if node is not None: self.notify(key, True)
+
+    def notify(self, key, present):
+        '''Calls every listener, logging any that fails so the others still run'''
+
+        for listener in self.listeners:
+            try: listener(key, present)
+            except Exception:
+                log_exception('HOTPLUG LISTENER OF ' + str(key))
+
+    def run(self):
+        '''Looks at the watched nodes once every period, forever'''
+
+        while True:
+            try: self.look()
+            except Exception:           ## keep watching, e.g. after a failed stat
+                log_exception('HOTPLUG WATCH')
+            time.sleep(self.period)
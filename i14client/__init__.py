@@ -0,0 +1,22 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Client library of the I14 laser controller
+##
+##     from i14client import Client
+##     with Client('laser-pi') as laser:
+##         laser.laser_power(40)
+##         print(laser.get_temp_diode_now())
+##         laser.batch(['LASER_POWER 10', 'LASER_POWER 20', '?LASER_POWER'])
+
+from .errors import LaserError, MessageError, CommandError, DeviceError, \
+                    DeviceTimeout, InterlockError, ConnectionLost
+from .commands import Commands, Device
+from .sync import Client, ClientPool
+from .aio import AsyncClient, AsyncClientPool
@@ -0,0 +1,220 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## asyncio client, for use from a single event loop
+
+##### IMPORTS #################################################################
+
+import asyncio                          ## streams, futures and sleeping
+from . import wire                      ## request IDs and line framing
+from .errors import check, ConnectionLost   ## return codes as exceptions
+from .commands import Commands, Device  ## typed wrappers
+
+##### CLIENT ##################################################################
+
+class AsyncClient(Commands):
+    '''
+    Connection to the laser controller for asyncio programs
+
+        - behaves as Client (see sync.py), but requests and typed wrappers
+          return coroutines, e.g. await client.laser_power(40)
+        - any number of requests can be awaited at once, e.g. with
+          asyncio.gather, and share the connection
+    '''
+
+    def __init__(self, host, port=14000, timeout=5.0, retries=5, backoff=0.1, max_backoff=5.0,
+                       deadline=None):
+        '''Init function for client (does not connect yet), see Client'''
+
+        self.address = (host, port)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.writer = None
+        self.receiver = None        ## task reading replies
+        self.tags = wire.Tags()
+        self.pending = {}           ## request ID -> Future of reply
+        self.subscriptions = {}     ## device -> SUBSCRIBE message, renewed
+        self.listeners = []         ## called with every unsolicited message
+        self.lock = asyncio.Lock()  ## connecting
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+        return False
+
+    def device(self, name):
+        '''Returns commands addressed to a device of a multi-device server'''
+
+        return Device(self, name)
+
+    ##### CONNECTION ##########################################################
+
+    async def connect(self):
+        '''Connects unless connected already, retrying with backoff'''
+
+        async with self.lock:
+            if self.writer is not None: return
+            delay = self.backoff
+            for attempt in range(self.retries + 1):
+                try:
+                    reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(*self.address), self.timeout)
+                    break
+                except (OSError, asyncio.TimeoutError):
+                    if attempt == self.retries: raise
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.max_backoff)
+            self.writer = writer
+            self.receiver = asyncio.ensure_future(self.receive(reader, writer))
+            for message in self.subscriptions.values():
+                tag = self.tags.next()
+                self.pending[tag] = None    ## reply is not waited for
+                writer.write(wire.encode(tag, message))
+
+    async def receive(self, reader, writer):
+        '''Hands replies to waiting requests until the connection is lost'''
+
+        lines = wire.Lines()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data: break
+                for line in lines.feed(data):
+                    if line.startswith('!'):
+                        for listener in self.listeners: listener(line)
+                        continue
+                    tag, reply = wire.split(line)
+                    if tag is not None: futures = [self.pending.pop(tag, None)]
+                    else: futures = wire.unmatched(self.pending)
+                    for future in futures:
+                        if future is not None and not future.done(): future.set_result(reply)
+        except OSError:
+            pass
+        finally:
+            pending = {}
+            if self.writer is writer:
+                self.writer = None
+                pending, self.pending = self.pending, {}
+            writer.close()
+            for future in pending.values():
+                if future is not None and not future.done():
+                    future.set_exception(ConnectionLost('Connection to server was lost'))
+
+    def close(self):
+        '''Closes the connection (it is made again by the next request)'''
+
+        self.subscriptions.clear()
+        if self.writer is not None: self.writer.close()
+        if self.receiver is not None: self.receiver.cancel()
+
+    ##### REQUESTS ############################################################
+
+    async def send(self, messages, deadline=None):
+        '''Sends messages in one write, returns Futures of their replies'''
+
+        if deadline is None: deadline = self.deadline
+        messages = [wire.with_deadline(message, deadline) for message in messages]
+        await self.connect()
+        tags = [self.tags.next() for _ in messages]
+        data = b''.join(wire.encode(tag, message) for tag, message in zip(tags, messages))
+        futures = []
+        for tag, message in zip(tags, messages):
+            future = self.pending[tag] = asyncio.Future()
+            future.tag = tag
+            futures.append(future)
+            self.remember(message, future)
+        self.writer.write(data)
+        return futures
+
+    def remember(self, message, future):
+        '''Keeps telemetry subscriptions the server accepted, to renew them after reconnecting'''
+
+        command = wire.command(message)
+        if command not in ('SUBSCRIBE', 'UNSUBSCRIBE'): return
+        words = message.split()
+        device = words[0] if words[0].startswith('@') else ''
+        success = '00' if command == 'SUBSCRIBE' else '0'   ## 01: had none
+
+        def replied(future):
+            if future.cancelled() or future.exception() is not None: return
+            if not future.result().startswith(success): return
+            if command == 'SUBSCRIBE': self.subscriptions[device] = message
+            elif device: self.subscriptions.pop(device, None)
+            else: self.subscriptions.clear()        ## unaddressed: every device
+
+        future.add_done_callback(replied)
+
+    async def wait(self, future):
+        '''Returns reply of a request, raising TimeoutError if it is late'''
+
+        try: return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop(future.tag, None)
+            raise TimeoutError('No reply from server')
+
+    async def request(self, message, deadline=None):
+        '''Sends a message and waits for its reply, see Client.request'''
+
+        futures = await self.send([message], deadline)
+        return check(await self.wait(futures[0]))
+
+    async def batch(self, messages, errors=True, deadline=None):
+        '''Sends messages in one write and waits for all replies, see Client.batch'''
+
+        results = []
+        for future in await self.send(messages, deadline):
+            try: results.append(check(await self.wait(future)))
+            except Exception as e:
+                if errors: raise
+                results.append(e)
+        return results
+
+    async def call(self, message, convert=None):
+        reply = await self.request(message)
+        return reply if convert is None else convert(reply)
+
+##### POOL ####################################################################
+
+class AsyncClientPool(Commands):
+    '''Several asyncio connections to the same server, see ClientPool'''
+
+    def __init__(self, host, port=14000, size=4, **options):
+        self.clients = [AsyncClient(host, port, **options) for _ in range(size)]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+        return False
+
+    def client(self):
+        '''Returns connection with fewest requests waiting'''
+
+        return min(self.clients, key=lambda client: len(client.pending))
+
+    def device(self, name):
+        return Device(self, name)
+
+    def request(self, message, deadline=None):
+        return self.client().request(message, deadline)
+
+    def batch(self, messages, errors=True, deadline=None):
+        return self.client().batch(messages, errors, deadline)
+
+    def call(self, message, convert=None):
+        return self.client().call(message, convert)
+
+    def close(self):
+        for client in self.clients: client.close()
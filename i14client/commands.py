@@ -0,0 +1,252 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Typed wrappers of every command in the rulebook of the server, except the
+## queries the server does not implement yet (they always return error 20)
+
+##### CONVERSIONS #############################################################
+
+def number(value):
+    '''Returns number as an argument'''
+
+    return '%.10g' % value
+
+def switch(on):
+    '''Returns ON or OFF as an argument'''
+
+    return 'ON' if on else 'OFF'
+
+def to_number(reply):
+    '''Returns numeric reply as float, None if the server does not know it'''
+
+    try: return float(reply)
+    except ValueError: return None
+
+def to_text(reply):
+    '''Returns reply as lower case text, None if the server does not know it'''
+
+    return None if reply in ('UNKNOWN', 'NONE', '') else reply.lower()
+
+def to_switch(reply):
+    '''Returns ON/OFF reply as bool'''
+
+    return reply.upper() in ('ON', '1')
+
+def to_modulation(reply):
+    '''Returns (mode, period, delay) of modulation'''
+
+    mode, period, delay = reply.split(' ')
+    return to_text(mode), to_number(period), to_number(delay)
+
+def to_fields(reply):
+    '''Returns FIELD=value words as dict'''
+
+    return dict(word.split('=', 1) for word in reply.split(' ') if '=' in word)
+
+def to_history(reply):
+    '''Returns history points as list of (time, min, max, mean)'''
+
+    if reply == 'NONE': return []
+    return [tuple(float(value) for value in point.split(',')) for point in reply.split(' ')]
+
+def to_words(reply):
+    '''Returns reply as list of words, empty if NONE'''
+
+    return [] if reply == 'NONE' else reply.split(' ')
+
+##### COMMANDS ################################################################
+
+class Commands:
+    '''
+    One method per rulebook entry, for clients that provide call()
+
+        - call(message, convert) sends a message and returns its reply, or
+          an awaitable of it for asyncio clients, converted by convert
+        - commands return their return code ('00', or a warning such as
+          '01' if the command had no effect) and raise LaserError on errors
+        - query X is get_x(), fresh=True asks the device instead of the
+          telemetry snapshot where the server allows it
+    '''
+
+    def call(self, message, convert=None):
+        raise NotImplementedError
+
+    def query(self, message, convert, fresh=False):
+        return self.call(message + (' !fresh' if fresh else ''), convert)
+
+    ##### LASER ###############################################################
+
+    def laser_mains(self, on):
+        return self.call('LASER_MAINS ' + switch(on))
+
+    def get_laser_mains(self, fresh=False):
+        return self.query('?LASER_MAINS', to_switch, fresh)
+
+    def laser_power(self, percent):
+        return self.call('LASER_POWER ' + number(percent))
+
+    def get_laser_power(self):
+        return self.call('?LASER_POWER', to_number)
+
+    def get_laser_status(self, fresh=False):
+        return self.query('?LASER_STATUS', to_number, fresh)
+
+    def get_laser_fault(self, fresh=False):
+        return self.query('?LASER_FAULT', to_number, fresh)
+
+    def laser_mode(self, mode):
+        '''mode: gated, master or indep'''
+        return self.call('LASER_MODE ' + mode.upper())
+
+    def get_laser_mode(self):
+        return self.call('?LASER_MODE', to_text)
+
+    def laser_mod_polarity(self, polarity):
+        '''polarity: pass or invert'''
+        return self.call('LASER_MOD_POLARITY ' + polarity.upper())
+
+    def get_laser_mod_polarity(self, fresh=False):
+        return self.query('?LASER_MOD_POLARITY', to_text, fresh)
+
+    def laser_modulation(self, mode, period=0, delay=0):
+        '''mode: none, sine, square, triangle, sawtooth or pulse; times in ms'''
+        return self.call('LASER_MODULATION ' + mode.upper() + ' ' +
+                         number(period) + ' ' + number(delay))
+
+    def get_laser_modulation(self):
+        return self.call('?LASER_MODULATION', to_modulation)
+
+    def laser_waveform(self, shape, period, delay=0):
+        '''shape: name of arbitrary waveform; times in ms'''
+        return self.call('LASER_WAVEFORM ' + shape.upper() + ' ' +
+                         number(period) + ' ' + number(delay))
+
+    def get_laser_waveform(self):
+        return self.call('?LASER_WAVEFORM', to_text)
+
+    def laser_trigger_threshold(self, percent):
+        return self.call('LASER_TRIGGER_THRESHOLD ' + number(percent))
+
+    def get_laser_trigger_threshold(self):
+        return self.call('?LASER_TRIGGER_THRESHOLD', to_number)
+
+    def apply(self, mains=None, power=None, mode=None, polarity=None,
+              modulation=None, threshold=None):
+        '''
+        Applies several settings in one request, all or nothing
+
+            - modulation: (mode, period, delay) as for laser_modulation
+            - settings left as None are not changed
+        '''
+        commands = []
+        if mains is not None: commands.append('LASER_MAINS ' + switch(mains))
+        if power is not None: commands.append('LASER_POWER ' + number(power))
+        if mode is not None: commands.append('LASER_MODE ' + mode.upper())
+        if polarity is not None: commands.append('LASER_MOD_POLARITY ' + polarity.upper())
+        if modulation is not None:
+            commands.append('LASER_MODULATION ' + modulation[0].upper() + ' ' +
+                            ' '.join(number(value) for value in modulation[1:]))
+        if threshold is not None: commands.append('LASER_TRIGGER_THRESHOLD ' + number(threshold))
+        return self.call('APPLY ' + '; '.join(commands))
+
+    ##### TEMPERATURES ########################################################
+
+    def get_temp_internal_now(self, fresh=False):
+        return self.query('?TEMP_INTERNAL_NOW', to_number, fresh)
+
+    def get_temp_diode_now(self, fresh=False):
+        return self.query('?TEMP_DIODE_NOW', to_number, fresh)
+
+    ##### INFO AND INTERLOCK ##################################################
+
+    def get_info_server(self):
+        return self.call('?INFO_SERVER')
+
+    def get_interlock_status(self):
+        '''True if the interlock is closed (laser allowed)'''
+        return self.call('?INTERLOCK_STATUS', lambda reply: reply == 'CLOSED')
+
+    def get_interlock_override(self):
+        return self.call('?INTERLOCK_OVERRIDE', to_switch)
+
+    def strict_mode(self, on):
+        return self.call('STRICT_MODE ' + switch(on))
+
+    def get_strict_mode(self):
+        return self.call('?STRICT_MODE', to_switch)
+
+    ##### TELEMETRY AND HISTORY ###############################################
+
+    def subscribe(self, fields, rate):
+        '''fields: list of telemetry fields (or ['ALL']); rate in Hz'''
+        return self.call('SUBSCRIBE ' + ','.join(fields).upper() + ' ' + number(rate))
+
+    def unsubscribe(self):
+        return self.call('UNSUBSCRIBE')
+
+    def get_state(self):
+        '''Every telemetry field, as dict of field name to value'''
+        return self.call('?STATE', to_fields)
+
+    def get_history(self, field, start, end=0, resolution=1):
+        '''start, end: UNIX times or seconds relative to now if <= 0'''
+        return self.call('?HISTORY ' + field.upper() + ' ' + number(start) + ' ' +
+                         number(end) + ' ' + number(resolution), to_history)
+
+    ##### TIMED PROGRAMS ######################################################
+
+    def program_step(self, name, offset, command):
+        '''offset: ms after start of program; command: message to run'''
+        return self.call('PROGRAM_STEP ' + name + ' ' + number(offset) + ' ' + command)
+
+    def program_ramp(self, name, offset, start, end, duration):
+        '''ramps power from start to end (%) over duration (ms)'''
+        return self.call('PROGRAM_RAMP ' + name + ' ' + ' '.join(
+            number(value) for value in [offset, start, end, duration]))
+
+    def program_clear(self, name):
+        return self.call('PROGRAM_CLEAR ' + name)
+
+    def program_run(self, name):
+        return self.call('PROGRAM_RUN ' + name)
+
+    def program_abort(self):
+        return self.call('PROGRAM_ABORT')
+
+    def get_program_status(self):
+        return self.call('?PROGRAM_STATUS')
+
+    ##### DIAGNOSTICS #########################################################
+
+    def get_io_stats(self):
+        return self.call('?IO_STATS', to_words)
+
+    def get_metrics(self):
+        return self.call('?METRICS', to_words)
+
+    def tracing(self, on):
+        return self.call('TRACING ' + switch(on))
+
+    def get_tracing(self):
+        return self.call('?TRACING', to_switch)
+
+    def get_traces(self):
+        return self.call('?TRACES', to_words)
+
+##### ADDRESSED DEVICES #######################################################
+
+class Device(Commands):
+    '''Commands of one device of a multi-device server, e.g. client.device('laser2')'''
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def call(self, message, convert=None):
+        return self.client.call('@' + self.name + ' ' + message, convert)
@@ -0,0 +1,78 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Return codes of the server (see resources/txt/errors.txt) as exceptions
+
+##### IMPORTS #################################################################
+
+import re                               ## for recognising return codes
+
+##### EXCEPTIONS ##############################################################
+
+class LaserError(Exception):
+    '''
+    Error code returned by the server
+
+        - code: the two digit return code, e.g. '25'
+        - reply: the whole reply, which may explain the error further
+    '''
+
+    def __init__(self, code, reply):
+        Exception.__init__(self, reply)
+        self.code = code
+        self.reply = reply
+
+class MessageError(LaserError):
+    '''1X: message could not be read (length, termination, device, ...)'''
+
+class CommandError(LaserError):
+    '''2X: command or its arguments were not accepted'''
+
+class DeviceError(LaserError):
+    '''3X and 4X: laser, Arduino or I2C device did not do as asked'''
+
+class DeviceTimeout(DeviceError):
+    '''32: device did not answer in time'''
+
+class InterlockError(LaserError):
+    '''9X: safety interlock does not allow the command'''
+
+class ConnectionLost(ConnectionError):
+    '''Connection to the server was lost before the reply arrived'''
+
+## exception raised for each return code, by code or by its first digit
+exceptions = {
+    '1'  : MessageError,
+    '2'  : CommandError,
+    '3'  : DeviceError,
+    '32' : DeviceTimeout,
+    '4'  : DeviceError,
+    '9'  : InterlockError,
+}
+
+##### REPLIES #################################################################
+
+RETURN_CODE = re.compile(r'^(\d\d) : ')
+
+def check(reply):
+    '''
+    Returns reply to a command or query, raising if it is an error
+
+    Arguments:
+        reply <str> - reply line, without request ID
+
+    Returns:
+        Return code if command succeeded, e.g. '00' or '01' (no effect)
+        Reply of query, e.g. '40.0'
+    '''
+    match = RETURN_CODE.match(reply)
+    if match is None: return reply
+    code = match.group(1)
+    if code[0] == '0': return code      ## success, possibly with warnings
+    raise exceptions.get(code, exceptions.get(code[0], LaserError))(code, reply)
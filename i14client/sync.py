@@ -0,0 +1,294 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Blocking client, safe to share between threads
+
+##### IMPORTS #################################################################
+
+import socket                           ## connection to server
+import time                             ## for backoff between reconnects
+from threading import Thread, Lock      ## replies are read in the background
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from . import wire                      ## request IDs and line framing
+from .errors import check, ConnectionLost   ## return codes as exceptions
+from .commands import Commands, Device  ## typed wrappers
+
+##### CLIENT ##################################################################
+
+class Client(Commands):
+    '''
+    Connection to the laser controller, with pipelined requests
+
+        - every request carries a request ID, so any number of requests can
+          be on the way at once (from any number of threads) and replies are
+          matched to them, however the server splits them into packets
+        - batch() sends many requests in one write and waits for all replies
+        - unsolicited messages (!INTERLOCK, !TELEMETRY) are passed to the
+          functions in listeners
+        - the connection is made on first use and made again, with
+          exponential backoff, after it was lost; requests that were waiting
+          raise ConnectionLost, as they may or may not have been carried out,
+          and telemetry subscriptions are renewed
+    '''
+
+    def __init__(self, host, port=14000, timeout=5.0, retries=5, backoff=0.1, max_backoff=5.0,
+                       deadline=None):
+        '''
+        Init function for client (does not connect yet)
+
+        Arguments:
+            host <str> - IP or hostname of server
+            port <int> - TCP port of server
+            timeout <float> - seconds to wait for a reply
+            retries <int> - reconnect attempts before giving up
+            backoff <float> - seconds before first reconnect attempt, doubled
+                              after every failed attempt up to max_backoff
+            max_backoff <float> - longest wait between attempts
+            deadline <float> - seconds the server may take to carry out each
+                               request (None: its default for the command),
+                               it answers 32 once they have passed
+
+        Returns:
+            none
+        '''
+        self.address = (host, port)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.sock = None
+        self.tags = wire.Tags()
+        self.pending = {}           ## request ID -> Future of reply
+        self.subscriptions = {}     ## device -> SUBSCRIBE message, renewed
+        self.listeners = []         ## called with every unsolicited message
+        self.lock = Lock()          ## connection, IDs and sending
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def device(self, name):
+        '''Returns commands addressed to a device of a multi-device server'''
+
+        return Device(self, name)
+
+    ##### CONNECTION ##########################################################
+
+    def connect(self):
+        '''Connects unless connected already (lock held), retrying with backoff'''
+
+        if self.sock is not None: return
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                sock = socket.create_connection(self.address, self.timeout)
+                break
+            except OSError:
+                if attempt == self.retries: raise
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        Thread(target=self.receive, args=(sock,), daemon=True).start()
+        renewed = []
+        for message in self.subscriptions.values():
+            tag = self.tags.next()
+            self.pending[tag] = None    ## reply is not waited for
+            renewed.append(wire.encode(tag, message))
+        if renewed: sock.sendall(b''.join(renewed))
+
+    def receive(self, sock):
+        '''Hands replies to waiting requests until the connection is lost'''
+
+        lines = wire.Lines()
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data: break
+                for line in lines.feed(data):
+                    if line.startswith('!'):
+                        for listener in self.listeners: listener(line)
+                        continue
+                    tag, reply = wire.split(line)
+                    with self.lock:
+                        if tag is not None: futures = [self.pending.pop(tag, None)]
+                        else: futures = wire.unmatched(self.pending)
+                    for future in futures:
+                        if future is not None: future.set_result(reply)
+        except OSError:
+            pass
+        finally:
+            pending = {}
+            with self.lock:
+                if self.sock is sock:
+                    self.sock = None
+                    pending, self.pending = self.pending, {}
+            sock.close()
+            for future in pending.values():
+                if future is not None:
+                    future.set_exception(ConnectionLost('Connection to server was lost'))
+
+    def close(self):
+        '''Closes the connection (it is made again by the next request)'''
+
+        with self.lock:
+            self.subscriptions.clear()
+            if self.sock is not None:
+                try: self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError: pass
+
+    ##### REQUESTS ############################################################
+
+    def send(self, messages, deadline=None):
+        '''
+        Sends messages in one write, without waiting for their replies
+
+        Arguments:
+            messages <list> - messages without \r\n, e.g. 'LASER_POWER 40'
+            deadline <float> - seconds the server may take for each message
+                               (None: self.deadline)
+
+        Returns:
+            List of Futures that receive the reply lines
+        '''
+        if deadline is None: deadline = self.deadline
+        messages = [wire.with_deadline(message, deadline) for message in messages]
+        futures = [Future() for _ in messages]
+        with self.lock:
+            self.connect()
+            tags = [self.tags.next() for _ in messages]
+            data = b''.join(wire.encode(tag, message) for tag, message in zip(tags, messages))
+            for tag, future in zip(tags, futures):
+                future.tag = tag
+                self.pending[tag] = future
+            for message, future in zip(messages, futures): self.remember(message, future)
+            try: self.sock.sendall(data)
+            except OSError as e:
+                for tag in tags: self.pending.pop(tag, None)
+                raise ConnectionLost(str(e))
+        return futures
+
+    def remember(self, message, future):
+        '''Keeps telemetry subscriptions the server accepted, to renew them after reconnecting'''
+
+        command = wire.command(message)
+        if command not in ('SUBSCRIBE', 'UNSUBSCRIBE'): return
+        words = message.split()
+        device = words[0] if words[0].startswith('@') else ''
+        success = '00' if command == 'SUBSCRIBE' else '0'   ## 01: had none
+
+        def replied(future):
+            if future.cancelled() or future.exception() is not None: return
+            if not future.result().startswith(success): return
+            with self.lock:
+                if command == 'SUBSCRIBE': self.subscriptions[device] = message
+                elif device: self.subscriptions.pop(device, None)
+                else: self.subscriptions.clear()        ## unaddressed: every device
+
+        future.add_done_callback(replied)
+
+    def wait(self, future):
+        '''Returns reply of a request, raising TimeoutError if it is late'''
+
+        try: return future.result(self.timeout)
+        except FutureTimeout:
+            with self.lock: self.pending.pop(future.tag, None)
+            raise TimeoutError('No reply from server')
+
+    def request(self, message, deadline=None):
+        '''
+        Sends a message and waits for its reply
+
+        Returns:
+            Return code of a command (e.g. '00') or reply of a query
+            Raises LaserError (or a subclass) if the server returned an error,
+            DeviceTimeout if it could not be done within the deadline
+        '''
+        return check(self.wait(self.send([message], deadline)[0]))
+
+    def batch(self, messages, errors=True, deadline=None):
+        '''
+        Sends messages in one write and waits for all of their replies
+
+        Arguments:
+            messages <list> - messages without \r\n
+            errors <bool> - raise the first error, or return it in its place
+            deadline <float> - seconds the server may take for each message
+
+        Returns:
+            List of return codes or query replies, in the order of messages
+        '''
+        results = []
+        for future in self.send(messages, deadline):
+            try: results.append(check(self.wait(future)))
+            except Exception as e:
+                if errors: raise
+                results.append(e)
+        return results
+
+    def call(self, message, convert=None):
+        reply = self.request(message)
+        return reply if convert is None else convert(reply)
+
+##### POOL ####################################################################
+
+class ClientPool(Commands):
+    '''
+    Several connections to the same server, used as one client
+
+        - each request goes to the connection with fewest requests waiting,
+          so independent requests are carried out by the server in parallel
+        - connections are made as they are first needed
+    '''
+
+    def __init__(self, host, port=14000, size=4, **options):
+        '''
+        Init function for pool
+
+        Arguments:
+            host, port - address of server
+            size <int> - number of connections
+            options - passed on to every Client
+
+        Returns:
+            none
+        '''
+        self.clients = [Client(host, port, **options) for _ in range(size)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def client(self):
+        '''Returns connection with fewest requests waiting'''
+
+        return min(self.clients, key=lambda client: len(client.pending))
+
+    def device(self, name):
+        return Device(self, name)
+
+    def request(self, message, deadline=None):
+        return self.client().request(message, deadline)
+
+    def batch(self, messages, errors=True, deadline=None):
+        return self.client().batch(messages, errors, deadline)
+
+    def call(self, message, convert=None):
+        return self.client().call(message, convert)
+
+    def close(self):
+        for client in self.clients: client.close()
@@ -0,0 +1,108 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Lines exchanged with the server, shared by the sync and asyncio clients
+
+##### IMPORTS #################################################################
+
+import itertools                        ## for numbering requests
+
+##### MESSAGES ################################################################
+
+MAX_LENGTH = 128        ## server rejects lines this long (request ID included)
+APPLY_MAX_LENGTH = 512  ## allowance of APPLY, which carries a whole configuration
+
+class Tags:
+    '''
+    Request IDs of one connection
+
+        - the server echoes an ID sent as "#id message" as the first word of
+          the reply, so replies to pipelined requests can be matched
+        - IDs wrap around long before they could make a line too long
+    '''
+
+    def __init__(self):
+        self.numbers = itertools.count()
+
+    def next(self):
+        return '#' + str(next(self.numbers) % 1000000)
+
+def encode(tag, message):
+    '''
+    Returns one request as bytes, ready to be sent
+
+    Arguments:
+        tag <str> - request ID, including the #
+        message <str> - command with its arguments, without \r\n
+
+    Returns:
+        Line to send, raises ValueError if the server could not take it
+    '''
+    line = (tag + ' ' + message + '\r\n').encode(encoding='ascii')
+    limit = APPLY_MAX_LENGTH if command(message) == 'APPLY' else MAX_LENGTH
+    words = message.split()
+    if len(words) > 1 and words[-1].upper().startswith('!DEADLINE='):
+        limit += len(words[-1]) + 1     ## not counted by the server
+    if len(line) >= limit: raise ValueError('Message is too long: ' + repr(message))
+    return line
+
+def with_deadline(message, seconds):
+    '''Returns message asking the server to answer within seconds (None: its default)'''
+
+    if seconds is None: return message
+    return message + ' !DEADLINE=%d' % max(1, round(seconds * 1e3))
+
+def command(message):
+    '''Returns command word of a message, without the device it addresses'''
+
+    words = message.split()
+    if len(words) > 1 and words[0].startswith('@'): return words[1].upper()
+    return words[0].upper() if words else ''
+
+##### REPLIES #################################################################
+
+class Lines:
+    '''Splits received bytes into lines, however the stream was segmented'''
+
+    def __init__(self):
+        self.data = b''
+
+    def feed(self, data):
+        '''Adds received bytes, returns list of complete lines (without \r\n)'''
+
+        self.data += data
+        lines = self.data.split(b'\r\n')
+        self.data = lines.pop()
+        return [line.decode(encoding='ascii', errors='replace') for line in lines]
+
+def split(line):
+    '''Returns (request ID or None, rest) of a reply line'''
+
+    if not line.startswith('#'): return None, line
+    tag, _, rest = line.partition(' ')
+    return tag, rest
+
+def unmatched(pending):
+    '''
+    Removes and returns the waiting requests an untagged reply belongs to
+
+        - the server replies without a request ID to a line whose ID it
+          could not read (24), or when it has no room for the connection
+          (15); as there is no telling which request that was, the error
+          goes to every request still waiting (the only one, if just one)
+        - requests nobody waits for (renewed subscriptions) are left alone
+
+    Arguments:
+        pending <dict> - request ID: Future of reply, or None if not waited for
+
+    Returns:
+        List of Futures
+    '''
+    tags = [tag for tag, future in pending.items() if future is not None]
+    return [pending.pop(tag) for tag in tags]
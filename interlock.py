@@ -0,0 +1,107 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Edge-triggered monitoring of the safety interlock and its override
+
+##### IMPORTS #################################################################
+
+from backend import GPIO                ## real or simulated GPIO
+from threading import Lock, Timer, Thread   ## state is shared between threads
+from queue import Queue                 ## changes, in order, for the listeners
+import config                           ## interlock pins and debounce time
+from errors import log_exception        ## failed listeners are logged
+
+##### INTERLOCK MONITOR #######################################################
+
+class InterlockMonitor:
+    '''
+    Keeps an always-current copy of the safety interlock state
+
+        - interlock and override pins are read once at start, and again on
+          every edge reported by GPIO interrupts
+        - each edge is also re-read once the contacts have settled, so that
+          bounces can not leave a stale state behind
+        - status() answers from the cached state without touching the GPIO
+        - listeners are called with the new status code on every change,
+          in order, by a thread of their own: the GPIO callback never waits
+          for them (e.g. for power to be cut), and a listener that raises
+          is logged without stopping the others or the monitor
+    '''
+
+    def __init__(self, interlock_pin=config.INTERLOCK_PIN,
+                       override_pin=config.OVERRIDE_PIN,
+                       debounce=config.INTERLOCK_DEBOUNCE):
+        '''
+        Init function for interlock monitor (call start() to begin)
+
+        Arguments:
+            interlock_pin <int> - GPIO pin that is high when interlock is closed
+            override_pin <int> - GPIO pin that is high when override is on
+            debounce <float> - seconds for the contacts to settle after an edge
+
+        Returns:
+            none
+        '''
+        self.interlock_pin = interlock_pin
+        self.override_pin = override_pin
+        self.debounce = debounce
+        self.closed = False         ## fail safe until pins have been read
+        self.override = False
+        self.listeners = []         ## called with status code on every change
+        self.lock = Lock()
+        self.changes = Queue()      ## status codes not yet passed to listeners
+
+    def start(self):
+        '''Reads the current state and enables edge interrupts'''
+
+        GPIO.setup([self.interlock_pin, self.override_pin], GPIO.IN)
+        Thread(target=self.dispatch, daemon=True).start()
+        self.refresh()
+        for pin in [self.interlock_pin, self.override_pin]:
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=self.edge,
+                                  bouncetime=max(1, int(self.debounce * 1000)))
+
+    def edge(self, channel):
+        '''GPIO interrupt callback, reads pins now and after they settle'''
+
+        self.refresh()
+        Timer(self.debounce, self.refresh).start()
+
+    def refresh(self):
+        '''Reads both pins, notifies listeners if the status has changed'''
+
+        with self.lock:
+            before = self.status()
+            self.closed = GPIO.input(self.interlock_pin) == 1
+            self.override = GPIO.input(self.override_pin) == 1
+            after = self.status()
+            if after != before: self.changes.put(after)    ## in order of changes
+
+    def dispatch(self):
+        '''Passes every change of status to the listeners, forever'''
+
+        while True:
+            status = self.changes.get()
+            for listener in list(self.listeners):
+                try: listener(status)
+                except Exception:
+                    log_exception('INTERLOCK LISTENER')
+
+    def status(self):
+        '''
+        Returns cached interlock and override status
+
+        Returns:
+            '00' if interlock is closed
+            '04' if interlock is open, but override is on
+            '90' if interlock is open and override is off
+        '''
+        if self.closed: return '00'
+        if self.override: return '04'
+        return '90'
@@ -0,0 +1,187 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Counters and latency histograms, exposed by ?METRICS and over HTTP
+
+##### IMPORTS #################################################################
+
+from threading import Lock, Thread      ## metrics are recorded by many threads
+
+##### HISTOGRAMS ##############################################################
+
+SUB_BUCKETS = 8                         ## buckets per power of two (~12% wide)
+BUCKETS = 256                           ## enough for values up to ~2^32 us
+
+def bucket(us):
+    '''Returns index of bucket that a value (integer microseconds) falls in'''
+
+    if us < 2 * SUB_BUCKETS: return us
+    shift = us.bit_length() - 4         ## keep top four bits (8 to 15)
+    return min(BUCKETS - 1, 2 * SUB_BUCKETS + (shift - 1) * SUB_BUCKETS + (us >> shift) - SUB_BUCKETS)
+
+def upper(index):
+    '''Returns largest value (integer microseconds) that falls in a bucket'''
+
+    if index < 2 * SUB_BUCKETS: return index
+    shift = (index - 2 * SUB_BUCKETS) // SUB_BUCKETS + 1
+    mantissa = (index - 2 * SUB_BUCKETS) % SUB_BUCKETS + SUB_BUCKETS
+    return ((mantissa + 1) << shift) - 1
+
+class Histogram:
+    '''
+    Log-linear (HDR style) histogram of latencies
+
+        - values are counted in buckets that are ~12% wide at any scale, so
+          recording is a few integer operations and needs no allocation
+        - percentiles are accurate to the width of one bucket
+    '''
+
+    __slots__ = ['counts', 'count', 'total', 'max']
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        '''Counts one value (caller holds the registry lock)'''
+
+        self.counts[bucket(int(seconds * 1e6))] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max: self.max = seconds
+
+    def percentile(self, fraction):
+        '''Returns upper bound (seconds) of bucket holding given fraction of values'''
+
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target: return min(upper(index) / 1e6, self.max)
+        return self.max
+
+##### REGISTRY ################################################################
+
+class Registry:
+    '''
+    All counters and histograms of the controller
+
+        - a metric is identified by its name and a tuple of (label, value)
+          pairs, and is created the first time it is recorded
+        - one lock guards everything, it is only held for a few operations
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, labels=(), amount=1):
+        '''Adds to a counter'''
+
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, seconds):
+        '''Records a latency in a histogram'''
+
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None: histogram = self.histograms[key] = Histogram()
+            histogram.record(seconds)
+
+    def summary(self):
+        '''
+        Returns all metrics as one line of text
+
+            - counters as name{labels}=count
+            - histograms as name{labels}=count/p50/p99/max, in milliseconds
+        '''
+
+        words = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                words.append('%s%s=%d' % (name, braces(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                words.append('%s%s=%d/%.3f/%.3f/%.3f' % (
+                    name, braces(labels), histogram.count,
+                    histogram.percentile(0.5) * 1e3, histogram.percentile(0.99) * 1e3,
+                    histogram.max * 1e3))
+        return ' '.join(words)
+
+    def exposition(self):
+        '''Returns all metrics in the Prometheus text exposition format'''
+
+        lines = []
+        with self.lock:
+            for name in sorted(set(name for name, _ in self.counters)):
+                lines.append('# TYPE i14_%s_total counter' % name)
+                for (other, labels), value in sorted(self.counters.items()):
+                    if other == name:
+                        lines.append('i14_%s_total%s %d' % (name, braces(labels), value))
+            for name in sorted(set(name for name, _ in self.histograms)):
+                lines.append('# TYPE i14_%s_seconds histogram' % name)
+                for (other, labels), histogram in sorted(self.histograms.items()):
+                    if other != name: continue
+                    cumulative = 0
+                    for index, count in enumerate(histogram.counts):
+                        if count == 0: continue
+                        cumulative += count
+                        lines.append('i14_%s_seconds_bucket%s %d' % (
+                            name, braces(labels + (('le', '%g' % ((upper(index) + 1) / 1e6)),)),
+                            cumulative))
+                    lines.append('i14_%s_seconds_bucket%s %d' % (
+                        name, braces(labels + (('le', '+Inf'),)), histogram.count))
+                    lines.append('i14_%s_seconds_sum%s %.9f' % (name, braces(labels), histogram.total))
+                    lines.append('i14_%s_seconds_count%s %d' % (name, braces(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+def braces(labels):
+    '''Formats labels as {label="value",...}, or nothing if there are none'''
+
+    if len(labels) == 0: return ''
+    return '{' + ','.join('%s="%s"' % label for label in labels) + '}'
+
+registry = Registry()       ## shared by every module
+count = registry.count
+observe = registry.observe
+
+##### HTTP ENDPOINT ###########################################################
+
+def serveHTTP(port, host='127.0.0.1'):
+    '''Starts the metrics endpoint in a background thread, returns the server'''
+
+    ## only imported when enabled, http.server is slow to import on the Pi
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+    class metricsHandler(BaseHTTPRequestHandler):
+        '''Answers every GET with the Prometheus exposition of the registry'''
+
+        def do_GET(self):
+            body = registry.exposition().encode(encoding='utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass                        ## scrapes would flood the server log
+
+    class metricsServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    httpd = metricsServer((host, port), metricsHandler)
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,163 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Timed programs (sequences of commands and power ramps) run by the server
+
+##### IMPORTS #################################################################
+
+import time                             ## monotonic clock for scheduling
+from threading import Thread, Lock, Event, current_thread  ## programs run in their own thread
+import config                           ## program limits
+
+##### PROGRAM STEPS ###########################################################
+
+class Step:
+    '''
+    One step of a program
+
+        - offset: seconds after the start of the program the step is due
+        - label: text describing the step, for status replies
+        - run: callable receiving an Event that is set when the program is
+          aborted (long steps should stop early), returns error codes
+    '''
+
+    def __init__(self, offset, label, run):
+        self.offset = offset
+        self.label = label
+        self.run = run
+
+##### PROGRAM EXECUTOR ########################################################
+
+class ProgramExecutor:
+    '''
+    Stores named programs and runs one of them at a time
+
+        - steps are started on a monotonic schedule relative to the start of
+          the program, never earlier than their offset
+        - a step that is not done by the time the next one is due delays it,
+          how late every step started is measured and reported
+        - a step that returns an error stops the program (FAILED), abort()
+          stops it at once (ABORTED), waking the scheduler if it is waiting
+    '''
+
+    def __init__(self, max_steps=config.PROGRAM_MAX_STEPS):
+        '''
+        Init function for program executor
+
+        Arguments:
+            max_steps <int> - most steps a single program may have
+
+        Returns:
+            none
+        '''
+        self.max_steps = max_steps
+        self.programs = {}              ## name: list of steps, sorted by offset
+        self.lock = Lock()
+        self.cancel = Event()
+        self.thread = None
+        self.name = None                ## program that runs or ran last
+        self.state = 'IDLE'
+        self.reason = ''                ## why program ended, if not DONE
+        self.done = 0                   ## steps started so far
+        self.total = 0
+        self.lateness = []              ## seconds each step started late
+
+    def add(self, name, step):
+        '''Appends a step to a program (created if new), returns error codes'''
+
+        with self.lock:
+            steps = self.programs.setdefault(name, [])
+            if len(steps) >= self.max_steps: return '29'
+            if self.running() and self.name == name: return '28'
+            steps.append(step)
+            steps.sort(key=lambda step: step.offset)
+        return '00'
+
+    def clear(self, name):
+        '''Removes a program, returns error codes'''
+
+        with self.lock:
+            if name not in self.programs: return '27'
+            if self.running() and self.name == name: return '28'
+            del self.programs[name]
+        return '00'
+
+    def running(self):
+        '''Returns True while a program is running'''
+
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self, name):
+        '''Starts running a program in the background, returns error codes'''
+
+        with self.lock:
+            if name not in self.programs: return '27'
+            if self.running(): return '28'
+            steps = list(self.programs[name])
+            self.cancel = Event()
+            self.name, self.state, self.reason = name, 'RUNNING', ''
+            self.done, self.total, self.lateness = 0, len(steps), []
+            self.thread = Thread(target=self.execute, args=(steps, self.cancel), daemon=True)
+            self.thread.start()
+        return '00'
+
+    def abort(self, reason='CLIENT', wait=1.0):
+        '''
+        Stops the running program at once
+
+        Arguments:
+            reason <str> - why program was aborted, for status replies
+            wait <float> - seconds to wait for the step in progress to stop
+
+        Returns:
+            Error codes (see local file errors.txt)
+        '''
+        with self.lock:
+            if not self.running(): return '01'
+            self.state, self.reason = 'ABORTED', reason
+            self.cancel.set()
+            thread = self.thread
+        if thread is not current_thread(): thread.join(wait)
+        return '00'
+
+    def join(self, wait=1.0):
+        '''Waits up to wait seconds for the last program started to end'''
+
+        thread = self.thread
+        if thread is not None and thread is not current_thread(): thread.join(wait)
+
+    def execute(self, steps, cancel):
+        '''Runs steps of a program on schedule (in its own thread)'''
+
+        start = time.monotonic()
+        for step in steps:
+            if cancel.wait(max(0.0, start + step.offset - time.monotonic())): return
+            self.lateness.append(time.monotonic() - start - step.offset)
+            self.done += 1
+            result = step.run(cancel)
+            code = result[0] if type(result) is list else result
+            if code is not None and code[0] != '0':
+                with self.lock:
+                    if not cancel.is_set():
+                        self.state, self.reason = 'FAILED', code + ' ' + step.label
+                return
+        with self.lock:
+            if not cancel.is_set(): self.state = 'DONE'
+
+    def status(self):
+        '''Returns status of running (or last) program as one line of text'''
+
+        with self.lock:
+            if self.name is None: return 'IDLE'
+            late = [seconds * 1e3 for seconds in self.lateness]
+            words = [self.state, self.name, '%d/%d' % (self.done, self.total),
+                     'LATE_MEAN=%.3f' % (sum(late) / len(late) if late else 0.0),
+                     'LATE_MAX=%.3f' % (max(late) if late else 0.0)]
+            if self.reason: words.append(self.reason)
+        return ' '.join(words)
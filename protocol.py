@@ -0,0 +1,93 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Encoding of frames sent to the Arduino, as ASCII lines or compact binary
+
+##### IMPORTS #################################################################
+
+import struct                           ## fixed size binary fields
+
+##### BINARY PROTOCOL #########################################################
+
+## frame: sync, version, sequence, command, length, payload, CRC-8 (of every
+## byte after sync); acknowledgement: ACK_SYNC, sequence, status
+## (must match the BINARY PROTOCOL defines in MCP4725.ino.ino)
+SYNC = 0xA5
+VERSION = 1
+ACK_SYNC = 0x5A
+ACK_SIZE = 3
+MAX_PAYLOAD = 58                        ## FRAME_SIZE of sketch, minus header and CRC
+
+CMD_SETPOINTS = 0x01                    ## (setpoint letter, float32) pairs
+CMD_WAVE = 0x02                         ## uint16 samples for wave table (V)
+CMD_STREAM = 0x03                       ## uint16 power values for stream (Q)
+
+## what each status of an acknowledgement means
+statuses = {
+    0x00 : 'OK',
+    0x01 : 'checksum mismatch',
+    0x02 : 'unsupported protocol version',
+    0x03 : 'unknown command or malformed payload',
+    0x04 : 'no room for samples',
+}
+
+def crc8(data):
+    '''Returns CRC-8 (polynomial 0x07, as _crc8_ccitt_update on the AVR)'''
+
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+def samples(digits):
+    '''Converts three hex digits per sample (as in V/Q setpoints) to integers'''
+
+    return [int(digits[i:i+3], 16) for i in range(0, len(digits) - 2, 3)]
+
+##### ENCODERS ################################################################
+
+def encodeASCII(frame, sequence):
+    '''Encodes a frame as a line of text (sequence numbers are not sent)'''
+
+    return (frame + ' \r\n').encode(encoding='ascii')
+
+def encodeBinary(frame, sequence):
+    '''
+    Encodes a frame of ASCII setpoints as a single binary frame
+
+    Arguments:
+        frame <str> - space separated setpoints, e.g. "A50.0 P100 D0", or one
+                      V or Q setpoint of hex samples
+        sequence <int> [0 - 255] - sequence number, echoed in acknowledgement
+
+    Returns:
+        Encoded frame <bytes>, raises ValueError if it cannot be encoded
+    '''
+
+    tokens = frame.split()
+    if len(tokens) == 1 and tokens[0][0] in 'VQ':
+        command = CMD_WAVE if tokens[0][0] == 'V' else CMD_STREAM
+        values = samples(tokens[0][1:])
+        payload = struct.pack('<%dH' % len(values), *values)
+    else:
+        command = CMD_SETPOINTS
+        payload = b''.join(struct.pack('<cf', token[0].encode(encoding='ascii'),
+                                       float(token[1:])) for token in tokens)
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError('frame does not fit in binary payload: ' + frame)
+
+    body = struct.pack('<BBBB', VERSION, sequence & 0xFF, command, len(payload)) + payload
+    return bytes([SYNC]) + body + bytes([crc8(body)])
+
+encoders = {
+    'ascii'  : encodeASCII,
+    'binary' : encodeBinary,
+}
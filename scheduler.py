@@ -0,0 +1,309 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Single-owner I/O scheduling of a serial device, with priority lanes
+
+##### IMPORTS #################################################################
+
+import time                             ## monotonic clock for deadlines
+from collections import deque           ## one FIFO per lane
+from threading import Thread, Condition ## owner thread and its wakeups
+from concurrent.futures import Future, CancelledError, TimeoutError
+import config                           ## default deadline
+import budget                           ## deadline of the calling request
+import tracing                          ## spans of traced requests
+import metrics                          ## serial round trip histograms
+from errors import log                  ## late safety requests
+
+##### LANES ###################################################################
+
+## requests are served lane by lane, first come first served within a lane
+SAFETY, WRITE, READ = 0, 1, 2
+lane_names = ['SAFETY', 'WRITE', 'READ']
+
+##### SERIAL PHASES ###########################################################
+
+def phase(device, name, start, end=None):
+    '''
+    Records how long one phase of a serial round trip took
+
+    Arguments:
+        device <str> - name of device, e.g. 'laser'
+        name <str> - 'open', 'write' or 'read'
+        start <float> - perf_counter when the phase started
+        end <float> - perf_counter when it ended (default: now)
+
+    Returns:
+        end
+    '''
+    if end is None: end = time.perf_counter()
+    metrics.observe('serial', (('device', device), ('phase', name)), end - start)
+    tracing.record(device + '.' + name, start, end)
+    return end
+
+##### REQUESTS ################################################################
+
+class Request:
+    '''One queued request: payload for the device, and where its result goes'''
+
+    def __init__(self, payload, lane, key, deadline):
+        self.payload = payload
+        self.lane = lane
+        self.key = key                  ## identical reads share this key
+        self.deadline = deadline        ## monotonic time it must be done by
+        self.queued = time.monotonic()
+        self.future = Future()
+        self.callers = 0                ## of a shared read, still waiting for it
+        self.trace = tracing.current()  ## (traces, depth) if caller is traced
+        if self.trace is not None: self.traced = time.perf_counter()
+
+##### DEVICE SCHEDULER ########################################################
+
+class DeviceScheduler(Thread):
+    '''
+    Sole owner of a device: every request to it runs on this thread
+
+        - requests are queued in priority lanes (safety, then writes, then
+          reads) and served in batches taken in that order
+        - a read submitted while an identical read is still queued shares
+          its result, so it is only sent to the device once; every caller
+          gets a future of its own, the read waits for the latest deadline
+          among them and is only cancelled once all of them have given up
+        - a request that could not start before its deadline is answered
+          with 32 (time out) without being sent, as is a caller that gives
+          up waiting; requests cancelled before they start are skipped;
+          SAFETY requests (switching off) are never dropped: one that starts
+          late, or whose caller gave up, is still sent (with the default
+          timeout for its serial reads and writes, not its expired deadline),
+          and lateness is counted and logged
+        - the deadline is the caller's remaining budget (see budget.py) if
+          it has one, and is passed on to the serial reads and writes of
+          execute; a request that the requests ahead of it would keep
+          waiting past its deadline is answered with 32 at once (except in
+          the SAFETY lane, which is always tried)
+        - a SAFETY request fails the queued writes it supersedes (see
+          supersedes), e.g. a power setpoint queued before the laser was
+          switched off, which would otherwise be sent after it and switch
+          the laser back on; they are answered with 90 without being sent
+        - queue depth, wait times and outcomes are counted for stats()
+        - for traced requests, time spent queued and executing (and any
+          spans recorded by execute) is added to the trace of the caller
+    '''
+
+    def __init__(self, name, execute, batch=1, idle=None, idle_period=1.0,
+                       timeout=config.IO_DEADLINE, supersedes=None):
+        '''
+        Init function for device scheduler (the thread starts on first use)
+
+        Arguments:
+            name <str> - name of device, for stats
+            execute <callable> - receives a list of payloads, talks to the
+                                 device and returns one result per payload
+            batch <int> - most requests per call to execute (None: all queued)
+            idle <callable> - called every idle_period while nothing is queued
+            idle_period <float> - seconds between calls to idle
+            timeout <float> - default seconds a request may take, queued or not
+            supersedes <callable> - receives the payloads of a SAFETY request
+                                    and of a queued WRITE request, returns
+                                    whether the write must not be sent
+
+        Returns:
+            none
+        '''
+        Thread.__init__(self, daemon=True)
+        self.device = name
+        self.execute = execute
+        self.batch = batch
+        self.idle = idle
+        self.idle_period = idle_period
+        self.timeout = timeout
+        self.supersedes = supersedes
+        self.condition = Condition()
+        self.lanes = [deque() for _ in lane_names]
+        self.pending = {}               ## key: queued read that others can share
+        self.counts = {'requests': 0, 'executed': 0, 'coalesced': 0,
+                       'expired': 0, 'cancelled': 0, 'rejected': 0, 'late': 0,
+                       'superseded': 0}
+        self.service = 0.0              ## average seconds per executed request
+        self.busy = False               ## whether a batch is being executed
+        self.max_depth = [0 for _ in lane_names]
+        self.waits = [[0, 0.0, 0.0] for _ in lane_names]   ## count, total, max
+
+    def submit(self, payload, lane=WRITE, key=None, timeout=None):
+        '''
+        Queues a request for the device
+
+        Arguments:
+            payload - passed on to execute
+            lane <int> - SAFETY, WRITE or READ
+            key - requests in READ lane with the same key are coalesced
+            timeout <float> - seconds the request may take (default: the
+                              remaining budget, at most self.timeout)
+
+        Returns:
+            Future that receives the result
+        '''
+        if timeout is None: timeout = budget.remaining(self.timeout)
+        with self.condition:
+            if not self.is_alive(): self.start()
+            self.counts['requests'] += 1
+            if lane == READ and key is not None and key in self.pending:
+                self.counts['coalesced'] += 1
+                shared = self.pending[key]
+                shared.deadline = max(shared.deadline, time.monotonic() + timeout)
+                trace = tracing.current()
+                if trace is not None:   ## spans of the shared read go to both
+                    if shared.trace is None: shared.trace = trace
+                    else: shared.trace = (shared.trace[0] + trace[0], shared.trace[1])
+                return self.follow(shared)
+            if lane != SAFETY and self.expected(lane) > timeout:
+                self.counts['rejected'] += 1
+                rejected = Future()
+                rejected.set_result(['32', 'Queue of ' + self.device + ' cannot meet deadline'])
+                return rejected
+            if lane == SAFETY and self.supersedes is not None: self.supersede(payload)
+            request = Request(payload, lane, key, time.monotonic() + timeout)
+            self.lanes[lane].append(request)
+            self.max_depth[lane] = max(self.max_depth[lane], len(self.lanes[lane]))
+            self.condition.notify()
+            if lane == READ and key is not None:
+                self.pending[key] = request
+                return self.follow(request)
+        return request.future
+
+    def follow(self, request):
+        '''Returns a future of its own for one caller of a shared read (condition held)'''
+
+        future = Future()
+        request.callers += 1
+
+        def settled(shared):            ## hands the result on to this caller
+            if shared.cancelled(): future.cancel()
+            elif future.set_running_or_notify_cancel(): future.set_result(shared.result())
+
+        def given_up(mine):             ## cancels the read once nobody waits
+            if not mine.cancelled(): return
+            with self.condition:
+                request.callers -= 1
+                if request.callers == 0: request.future.cancel()
+
+        future.add_done_callback(given_up)
+        request.future.add_done_callback(settled)
+        return future
+
+    def supersede(self, payload):
+        '''Fails the queued writes that a SAFETY payload supersedes (condition held)'''
+
+        kept = deque()
+        for request in self.lanes[WRITE]:
+            if not self.supersedes(payload, request.payload):
+                kept.append(request)
+            elif request.future.set_running_or_notify_cancel():
+                self.counts['superseded'] += 1
+                request.future.set_result(['90', 'Laser was switched off before it was sent'])
+            else:
+                self.counts['cancelled'] += 1
+        self.lanes[WRITE] = kept
+
+    def expected(self, lane):
+        '''Returns estimated seconds a new request in lane waits to start (condition held)'''
+
+        ahead = sum(len(queued) for queued in self.lanes[:lane+1]) + self.busy
+        return ahead * self.service
+
+    def call(self, payload, lane=WRITE, key=None, timeout=None):
+        '''Submits a request and waits for its result, returns error codes'''
+
+        if timeout is None: timeout = budget.remaining(self.timeout)
+        future = self.submit(payload, lane, key, timeout)
+        try:
+            return future.result(timeout)
+        except (TimeoutError, CancelledError):
+            future.cancel()             ## no effect once it has started
+            return '32'
+
+    def take(self):
+        '''Removes the next batch of requests from the lanes (condition held)'''
+
+        batch = []
+        now = time.monotonic()
+        for lane, queued in enumerate(self.lanes):
+            while queued and (self.batch is None or len(batch) < self.batch):
+                request = queued.popleft()
+                if self.pending.get(request.key) is request: del self.pending[request.key]
+                if not request.future.set_running_or_notify_cancel() and lane != SAFETY:
+                    self.counts['cancelled'] += 1
+                    continue
+                if now > request.deadline:
+                    if lane != SAFETY:
+                        self.counts['expired'] += 1
+                        request.future.set_result('32')
+                        continue
+                    self.counts['late'] += 1    ## switching off is always sent
+                    log('%s: SAFETY REQUEST SENT %.1f ms AFTER ITS DEADLINE'
+                        % (self.device.upper(), (now - request.deadline) * 1e3))
+                wait = now - request.queued
+                if request.trace is not None:
+                    traces, depth = request.trace
+                    for trace in traces:
+                        trace.spans.append((self.device + '.queue', request.traced,
+                                            time.perf_counter(), depth))
+                self.waits[lane][0] += 1
+                self.waits[lane][1] += wait
+                self.waits[lane][2] = max(self.waits[lane][2], wait)
+                batch.append(request)
+        return batch
+
+    def run(self):
+        '''Serves queued requests forever, highest priority first'''
+
+        while True:
+            with self.condition:
+                if not any(self.lanes): self.condition.wait(self.idle_period)
+                batch = self.take()
+                self.busy = len(batch) != 0
+            if len(batch) == 0:
+                if self.idle is not None: self.idle()
+                continue
+            start = time.monotonic()
+            try:
+                traced = [request.trace for request in batch if request.trace is not None]
+                deadline = max(request.deadline for request in batch)
+                if any(request.lane == SAFETY for request in batch):    ## even if late,
+                    deadline = max(deadline, start + self.timeout)      ## wait for the ACK
+                with budget.until(deadline):
+                    if len(traced) == 0:
+                        results = self.execute([request.payload for request in batch])
+                    else:
+                        with tracing.adopt(sum((trace[0] for trace in traced), []), traced[0][1]):
+                            with tracing.span(self.device + '.execute'):
+                                results = self.execute([request.payload for request in batch])
+            except Exception as e:
+                results = [['30', str(e)]] * len(batch)
+            with self.condition:
+                self.busy = False
+                taken = (time.monotonic() - start) / len(batch)
+                self.service = taken if self.service == 0.0 else 0.8 * self.service + 0.2 * taken
+            self.counts['executed'] += len(batch)
+            for request, result in zip(batch, results):
+                if not request.future.cancelled():  ## a SAFETY caller may have given up
+                    request.future.set_result(result)
+
+    def stats(self):
+        '''Returns queue depths, wait times (ms) and request counts'''
+
+        with self.condition:
+            result = dict(self.counts)
+            for lane, name in enumerate(lane_names):
+                count, total, longest = self.waits[lane]
+                result[name] = {'depth'       : len(self.lanes[lane]),
+                                'max_depth'   : self.max_depth[lane],
+                                'wait_mean_ms': total / count * 1e3 if count else 0.0,
+                                'wait_max_ms' : longest * 1e3}
+        return result
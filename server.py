@@ -10,63 +10,218 @@
 ##### IMPORTS #################################################################
 
 import socket                           ## access to BSD socket interface
+from socket import IPPROTO_TCP, TCP_NODELAY   ## replies are not held back
+import time                             ## for timing hardware startup
 #import os      # depreciated
+import sys                              ## command line server mode override
 import atexit                           ## gracefully close at exit
+import asyncio                          ## for asynchronous server
+import multiprocessing                  ## for front-end processes
 from datetime import datetime           ## UTC time for logging purposes
-from threading import Thread            ## for threaded server
-from externalParser import parse        ## EXTERNAL RULEBOOK
+from threading import Thread, Lock, Condition   ## for threaded server
+from concurrent.futures import ThreadPoolExecutor   ## hardware calls (async)
+from externalParser import parse, monitor, unsubscribe, history, startup   ## EXTERNAL RULEBOOK
 from errors import return_code          ## EXTERNAL RETURN CODE DICTIONARY
+import config                           ## server settings
+import metrics                          ## optional Prometheus endpoint
+import tracing                          ## spans of each request, if enabled
 
 ##### LOGGING AND RECOVERY DETECTION ##########################################
 
 ## depreciated: allowed for logging and crash detection
 ## to enable, remove all single (#) hashes before commented lines
 
-#log = open('errlog.txt', mode='a', buffering=1)
+#logfile = open('errlog.txt', mode='a', buffering=1)
 #if os.path.isfile('LOCK'):
-#   log.write(str(datetime.utcnow())+" RECOVERED FROM UNEXPECTED SHUTDOWN"+'\n')
+#   logfile.write(str(datetime.utcnow())+" RECOVERED FROM UNEXPECTED SHUTDOWN"+'\n')
 #else:
 #   open('LOCK', 'w').close()
 
+def log(message):
+    '''Prints message prefixed with current UTC time'''
+
+    print(str(datetime.utcnow())+" "+message)
+    #logfile.write(str(datetime.utcnow())+" "+message+'\n')
+
 ##### HOST AND PORT SETUP #####################################################
 
 host = socket.gethostname()
-port = 14000
+port = config.SERVER_PORT
 
 ##### RESERVE SOCKET FOR PROCESS ##############################################
 
-## reserve a socket and bind to it, close if this is not possible
+def reserveSocket():
+    '''Reserves a socket and binds to it, raises if this is not possible'''
+
+    try:
+        serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        serversocket.bind((host, port))
+    except socket.error as error:
+        log("SOCKET ERROR: "+str(error))
+        raise
+    return serversocket
 
-try:
-    serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    serversocket.bind((host, port))
-except socket.error as error:
-    print(str(datetime.utcnow())+" SOCKET ERROR: "+str(error))
-    #log.write(str(datetime.utcnow())+" SOCKET ERROR: "+str(error)+'\n')
-    raise
+##### HARDWARE STARTUP ########################################################
+
+def startHardware():
+    '''Sets up hardware in the background, once the socket is listening'''
+
+    def starting():
+        start = time.monotonic()
+        startup()
+        log("HARDWARE READY ({0:.3f} s)".format(time.monotonic() - start))
+    Thread(target=starting, daemon=True).start()
 
 ##### RESPONSE HANDLER ########################################################
 
-def handleResponse(data):
+def handleResponse(data, client=None):
     '''
     Simple function that tests the valid of received data before parsing
 
     Arguments:
         data <str> - data received from socket to be tested
+        client <object> - connection that sent the data (for subscriptions)
 
     Returns:
         Resulting string from parsed and executed arguments
         Error codes (see local file errors.txt)
     '''
-    if len(data) <= 2: return return_code('10')
-    if len(data) >= 128: return return_code('11')
-    if data[-2:] != '\r\n': return return_code('12')
+    trace = tracing.begin(getattr(client, 'peer', 'local'))
+    try:
+        with tracing.span('frame'):
+            if len(data) <= 2: return return_code('10')
+            if len(data) >= config.APPLY_MAX_LENGTH: return return_code('11')
+            if data[-2:] != '\r\n': return return_code('12')
+
+            words = [word for word in data[:-2].split(' ') if len(word) != 0]
+            if len(words) == 0: return return_code('13')
+            counted, length = words, len(data)
+            if len(words) > 1 and words[-1].upper().startswith('!DEADLINE='):
+                counted = words[:-1]            ## a client deadline is not counted
+                length -= len(words[-1]) + 1
+            command = words[1:2] if words[0].startswith('@') else words[:1]
+            if command == ['APPLY']:            ## also @laser2 APPLY ...
+                if len(counted) >= config.APPLY_MAX_WORDS: return return_code('14')
+            else:
+                if length >= 128: return return_code('11')
+                if len(counted) >= 8: return return_code('14')
+
+        if trace is not None: trace.command = words[0]
+        with tracing.span('parse'):
+            return parse(words, client)
+    finally:
+        tracing.finish(trace)
+
+## characters of a request ID after the #
+tag_characters = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+
+def validTag(tag):
+    '''Returns whether a request ID is # followed by 1 to 16 ASCII letters or digits'''
+
+    return 2 <= len(tag) <= 17 and all(character in tag_characters for character in tag[1:])
+
+def handleRequest(data, client=None):
+    '''
+    Handles one framed message, which may start with a request ID
+
+        - a request ID is a first word starting with #, e.g. "#17 ?LASER_POWER"
+        - the ID is removed before the message is handled, and echoed back
+          as the first word of the reply so pipelined replies can be matched
+        - an ID that is not # followed by ASCII letters or digits is answered
+          with error 24, without a request ID
+
+    Arguments:
+        data <str> - one message from the client, including terminating \r\n
+        client <object> - connection that sent the message
+
+    Returns:
+        Reply to the message, prefixed with request ID if one was given,
+        always ending with \r\n so that every request gets a line of its own
+    '''
+    if data[:1] != '#': reply = handleResponse(data, client)
+    else:
+        tag, _, rest = data.partition(' ')
+        tag = tag.rstrip('\r\n')
+        if not validTag(tag): reply = return_code(['24', 'Request ID must be # followed by letters or digits'])
+        else: reply = (tag+' ').encode(encoding='ascii') + handleResponse(rest or '\r\n', client)
+    if not reply.endswith(b'\r\n'): reply += b'\r\n'
+    return reply
+
+def handleRequests(messages, client=None):
+    '''Handles messages received together, returns their replies as one write'''
+
+    return b''.join(handleRequest(message, client) for message in messages)
+
+##### STREAM FRAMING ##########################################################
+
+class lineBuffer:
+    '''
+    Per-connection receive buffer that splits the byte stream into messages
+
+        - messages end with \r\n, independent of how TCP segments the stream
+        - several messages received at once are returned in order
+        - an unterminated message longer than the limit is handed on as it
+          is (so handleResponse rejects it as too long) and the rest of it,
+          up to the next \r\n, is discarded
+    '''
+
+    def __init__(self, limit=config.APPLY_MAX_LENGTH):
+        '''
+        Init function for receive buffer
+
+        Arguments:
+            limit <int> - bytes after which an unterminated message is dropped
+
+        Returns:
+            none
+        '''
+        self.data = b''
+        self.limit = limit
+        self.discarding = False
+
+    def feed(self, data):
+        '''
+        Adds received bytes to the buffer
+
+        Arguments:
+            data <bytes> - bytes received from socket
+
+        Returns:
+            List of complete messages <str>, each ending with \r\n
+        '''
+        self.data += data
+        messages = []
+        while True:
+            index = self.data.find(b'\r\n')
+            if index == -1: break
+            message, self.data = self.data[:index+2], self.data[index+2:]
+            if self.discarding: self.discarding = False
+            else: messages.append(message.decode('ascii', errors='replace'))
+
+        if len(self.data) >= self.limit:
+            if not self.discarding:
+                messages.append(self.data.decode('ascii', errors='replace'))
+            self.data = self.data[-1:]      ## keep a possible trailing \r
+            self.discarding = True
+        return messages
+
+##### CLIENT NOTIFICATIONS ####################################################
 
-    words = [word for word in data[:-2].split(' ') if len(word) != 0]
-    if len(words) == 0: return return_code('13')
-    if len(words) >= 8: return return_code('14')
-    
-    return parse(words)
+## unsolicited messages start with ! so that clients can tell them apart from
+## replies, e.g. "!INTERLOCK 90 : Safety interlock is open"
+## push(message) always delivers the message, while offer(message, topic) is
+## used for telemetry and only keeps the latest message of each topic (device)
+## that has not been sent
+
+clients = set()     ## connected clients, with push and offer methods
+
+def notifyClients(status):
+    '''Tells every connected client that the interlock status has changed'''
+
+    message = b'!INTERLOCK ' + return_code(status)
+    for client in list(clients): client.push(message)
+
+monitor.listeners.append(notifyClients)
 
 ##### THREADED SERVER #########################################################
 
@@ -86,46 +241,277 @@ class connection(Thread):
         '''
         Thread.__init__(self)
         self.sock = socket
+        self.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)   ## pipelined replies
+        self.sock.settimeout(config.SERVER_IDLE_TIMEOUT)    ## receiving and sending
         self.addr = address
+        self.peer = address[0]+':'+str(address[1])  ## for traces
+        self.send_lock = Lock()
+        self.latest = {}                ## telemetry waiting to be sent, by topic
+        self.offered = Condition()
+        self.offerer = None             ## thread sending telemetry
+        self.closed = False
         self.start()
 
+    def send(self, message):
+        '''Sends message to client, never interleaved with another message'''
+
+        with self.send_lock: self.sock.sendall(message)
+
+    def push(self, message):
+        '''Sends unsolicited message to client without blocking the caller'''
+
+        def pushing():
+            try: self.send(message)
+            except OSError: pass        ## client is disconnecting anyway
+        Thread(target=pushing, daemon=True).start()
+
+    def offer(self, message, topic=None):
+        '''Queues telemetry for client, replacing any of the topic not yet sent'''
+
+        with self.offered:
+            if self.offerer is None:        ## started on first telemetry
+                self.offerer = Thread(target=self.offering, daemon=True)
+                self.offerer.start()
+            self.latest[topic] = message
+            self.offered.notify()
+
+    def offering(self):
+        '''Sends latest offered telemetry until client disconnects'''
+
+        while True:
+            with self.offered:
+                while not self.latest and not self.closed: self.offered.wait()
+                if self.closed: return
+                message = b''.join(self.latest.values())
+                self.latest = {}
+            try: self.send(message)
+            except OSError: return
+
     def run(self):
         '''
         Starts the thread that will handle communication with connected client:
             - in an infinite loop (terminated only by a connection reset error)
                 - receives a maximum of 1024 bytes from client
-                - send message to handleResponse --> Parser --> Some action
-                - this will return a response which will be sent to client
+                - splits received bytes into messages on \r\n
+                - send each message to handleRequest --> Parser --> Some action
+                - this will return responses which will be sent to client
+                  in the order the messages were received, in one write for
+                  all messages of the same packet (pipelined requests)
                 - if there is not data, the connection is closed and loop exits
             - on ConnectionResetError
                 - closed connection is logged
                 - control is returned to listener for a new connection
+            - on socket.timeout (client idle for config.SERVER_IDLE_TIMEOUT)
+                - connection is closed and logged
         '''
+        buffer = lineBuffer()
+        clients.add(self)
         try:
             while True:
                 data = self.sock.recv(1024)
                 if not data: raise ConnectionResetError
-                self.sock.send(handleResponse(data.decode('ascii')))
-        except ConnectionResetError:
-            print(str(datetime.utcnow())+" CONNECTION CLOSED: "+self.addr[0]+':'+str(self.addr[1]))
-            #log.write(str(datetime.utcnow())+" CONNECTION CLOSED: "+address[0]+':'+str(address[1])+'\n')
+                messages = buffer.feed(data)
+                if messages: self.send(handleRequests(messages, self))
+        except (ConnectionResetError, BrokenPipeError):
+            log("CONNECTION CLOSED: "+self.addr[0]+':'+str(self.addr[1]))
+        except socket.timeout:
+            self.sock.close()
+            log("CONNECTION TIMED OUT: "+self.addr[0]+':'+str(self.addr[1]))
+        finally:
+            clients.discard(self)
+            unsubscribe(self)
+            with self.offered:
+                self.closed = True
+                self.offered.notify()
 
-##### CONNECTION LISTENER #####################################################
+def serveThreaded(serversocket, hardware=True):
+    '''Accepts connections forever, starting one thread per client'''
+
+    serversocket.listen(1)                      ## only allows for one connection
+    log("SERVER STARTED")
+    if hardware: startHardware()
+    while True:                         ## infinite loop which should never exit
+        clientsocket, address = serversocket.accept()   ## accept connection
+        log("CONNECTION ESTABLISHED: "+address[0]+':'+str(address[1]))
+        connection(clientsocket, address)   ## start server with details of client
+
+##### ASYNCHRONOUS SERVER #####################################################
+
+class asyncClient:
+    '''Lets other threads push unsolicited messages to an asyncio client'''
+
+    def __init__(self, loop, writer, write_buffer, peer):
+        self.peer = peer                ## address of client, for traces
+        self.loop = loop
+        self.writer = writer
+        self.write_buffer = write_buffer
+        self.latest = {}                ## telemetry waiting to be sent, by topic
+        self.offered = asyncio.Event()
+
+    def push(self, message):
+        '''Queues message for client on the event loop (thread safe)'''
+
+        self.loop.call_soon_threadsafe(self.writer.write, message)
+
+    def offer(self, message, topic=None):
+        '''Queues telemetry for client, replacing any of the topic not yet sent (thread safe)'''
+
+        self.loop.call_soon_threadsafe(self.store, message, topic)
+
+    def store(self, message, topic):
+        '''Keeps telemetry until it is written (on the event loop, as offering)'''
+
+        self.latest[topic] = message
+        self.offered.set()
+
+    async def offering(self):
+        '''Writes latest offered telemetry whenever the client can take it'''
+
+        while True:
+            await self.offered.wait()
+            self.offered.clear()
+            while self.writer.transport.get_write_buffer_size() > self.write_buffer:
+                await asyncio.sleep(0.05)   ## client is slow, keep latest only
+            latest, self.latest = self.latest, {}
+            for message in latest.values(): self.writer.write(message)
+
+class asyncServer:
+    '''
+    Single-threaded asyncio server speaking the same protocol as connection
+
+        - every client is a coroutine instead of an OS thread, so idle
+          monitoring connections cost next to nothing
+        - clients above the connection cap receive error 15 and are closed
+        - handleRequest (and with it all hardware calls) runs on a bounded
+          pool of worker threads so the event loop never blocks
+        - replies wait for the client to drain its write buffer before the
+          next message is read (per-connection backpressure)
+    '''
+
+    def __init__(self, max_connections=config.SERVER_MAX_CONNECTIONS,
+                       workers=config.SERVER_WORKERS,
+                       write_buffer=config.SERVER_WRITE_BUFFER):
+        '''
+        Init function for asynchronous server
+
+        Arguments:
+            max_connections <int> - number of clients served at once
+            workers <int> - number of threads running hardware calls
+            write_buffer <int> - bytes buffered per client before pausing
+
+        Returns:
+            none
+        '''
+        self.max_connections = max_connections
+        self.write_buffer = write_buffer
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.connections = 0
+
+    async def serveClient(self, reader, writer):
+        '''Handles communication with one connected client'''
+
+        address = writer.get_extra_info('peername')
+        if self.connections >= self.max_connections:
+            log("CONNECTION REFUSED: "+address[0]+':'+str(address[1]))
+            writer.write(return_code('15'))
+            writer.close()
+            return
+
+        self.connections += 1
+        log("CONNECTION ESTABLISHED: "+address[0]+':'+str(address[1]))
+        writer.transport.set_write_buffer_limits(high=self.write_buffer)
+        loop = asyncio.get_event_loop()
+        buffer = lineBuffer()
+        client = asyncClient(loop, writer, self.write_buffer,
+                             address[0]+':'+str(address[1]))
+        clients.add(client)
+        offering = asyncio.ensure_future(client.offering())
+        try:
+            while True:
+                data = await asyncio.wait_for(reader.read(1024), config.SERVER_IDLE_TIMEOUT)
+                if not data: break
+                messages = buffer.feed(data)
+                if not messages: continue
+                replies = await loop.run_in_executor(     ## one hop per packet
+                    self.executor, handleRequests, messages, client)
+                writer.write(replies)
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError, asyncio.TimeoutError):
+            pass                        ## timed out: idle for SERVER_IDLE_TIMEOUT
+        finally:
+            clients.discard(client)
+            unsubscribe(client)
+            offering.cancel()
+            self.connections -= 1
+            writer.close()
+            log("CONNECTION CLOSED: "+address[0]+':'+str(address[1]))
 
-serversocket.listen(1)                      ## only allows for one connection
-print(str(datetime.utcnow())+" SERVER STARTED")
-#log.write(str(datetime.utcnow())+" SERVER STARTED"+'\n')
-while True:                         ## infinite loop which should never exit
-    clientsocket, address = serversocket.accept()   ## accept connection
-    print(str(datetime.utcnow())+" CONNECTION ESTABLISHED: "+address[0]+':'+str(address[1]))
-    #log.write(str(datetime.utcnow())+" CONNECTION ESTABLISHED: "+address[0]+':'+str(address[1])+'\n')
-    connection(clientsocket, address)   ## start server with details of client
+    def serve(self, serversocket, hardware=True):
+        '''Runs the event loop forever on an already bound socket'''
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.start_server(
+            self.serveClient, sock=serversocket, backlog=128))
+        log("SERVER STARTED (ASYNC)")
+        if hardware: startHardware()
+        loop.run_forever()
+
+##### FRONT-END PROCESSES #####################################################
+
+## with config.FRONTENDS set, this process becomes the hardware daemon (see
+## daemon.py) and clients are served by front-end processes (see frontend.py)
+## accepting connections on the same socket, so parsing, logging and client
+## sockets use the other cores and do not hold up serial and GPIO timing
+
+def serve(serversocket, mode, hardware=True):
+    '''Serves clients forever in the given mode (threaded or async)'''
+
+    if mode == 'async':
+        asyncServer().serve(serversocket, hardware)
+    else:
+        serveThreaded(serversocket, hardware)
+
+def serveFrontend(serversocket, mode):
+    '''Serves clients in a front-end process, forwarding to the daemon'''
+
+    global parse, unsubscribe
+    import frontend
+    parse, unsubscribe = frontend.parse, frontend.unsubscribe
+    frontend.link.listeners.append(
+        lambda message: [client.push(message) for client in list(clients)])
+    Thread(target=frontend.watchDaemon, daemon=True).start()
+    Thread(target=frontend.link.keep, daemon=True).start()     ## for pushes
+    serve(serversocket, mode, hardware=False)
+
+def serveProcesses(serversocket, mode):
+    '''Starts front-end processes, then runs the hardware daemon forever'''
+
+    import daemon
+    hardware = daemon.hardwareDaemon()  ## no threads yet, safe to fork
+    for number in range(config.FRONTENDS):
+        multiprocessing.Process(target=serveFrontend, args=(serversocket, mode),
+                                daemon=True).start()
+    log("HARDWARE DAEMON STARTED ("+str(config.FRONTENDS)+" FRONT-ENDS)")
+    if config.METRICS_PORT is not None: metrics.serveHTTP(config.METRICS_PORT)
+    startHardware()
+    hardware.serve()
 
 ##### EXIT HANDLER ############################################################
 
-@atexit.register
 def cleanup():
-    print(str(datetime.utcnow())+" SERVER CLOSED SAFELY")
-    #log.write(str(datetime.utcnow())+" SERVER CLOSED SAFELY"+'\n')
-    #log.close()
+    for name, kept in history.created():    ## keep history up to the last sample
+        kept.save()
+    log("SERVER CLOSED SAFELY")
+    #logfile.close()
     #os.remove('LOCK')
+
+##### CONNECTION LISTENER #####################################################
+
+if __name__ == '__main__':
+    atexit.register(cleanup)
+    mode = sys.argv[1] if len(sys.argv) > 1 else config.SERVER_MODE
+    if config.FRONTENDS > 0:
+        serveProcesses(reserveSocket(), mode)
+    else:
+        if config.METRICS_PORT is not None: metrics.serveHTTP(config.METRICS_PORT)
+        serve(reserveSocket(), mode)
@@ -0,0 +1,97 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## In-memory copy of the settable registers of the laser and the Arduino
+
+##### IMPORTS #################################################################
+
+from threading import Lock              ## registers are shared between threads
+import devices                          ## one set of registers per device
+
+##### REGISTER GROUPS #########################################################
+
+## registers that live on each device, invalidated together
+groups = {
+    'laser'   : ['mains', 'polarity'],
+    'arduino' : ['power', 'modulation', 'period', 'delay', 'threshold', 'waveform'],
+    'gpio'    : ['operation'],      ## driven by the Pi itself, never unknown
+}
+
+## values of registers when the server starts
+start_defaults = {
+    'operation'  : 'indep',
+}
+
+## values the Arduino is known to hold right after a reset
+arduino_defaults = {
+    'power'      : 0.0,
+    'modulation' : 'none',
+    'period'     : 0.0,
+    'delay'      : 0.0,
+    'threshold'  : None,    ## sketch default is not a valid setpoint
+    'waveform'   : None,    ## no table uploaded yet
+}
+
+##### SHADOW REGISTERS ########################################################
+
+class ShadowRegisters:
+    '''
+    Write-through shadow of device registers
+
+        - successful writes store the value that was written
+        - a value of None means the register is unknown and must be read
+          from (or written to) the device
+        - faults, reconnects and interlock events invalidate the registers
+          whose value can no longer be trusted
+        - the last value known for each register survives invalidation, so
+          a device that comes back (e.g. after a USB reset) can be given its
+          settings again
+    '''
+
+    def __init__(self):
+        '''Init function for shadow registers, registers start unknown (or default)'''
+
+        self.lock = Lock()
+        self.values = {name: None for group in groups.values() for name in group}
+        self.values.update(start_defaults)
+        self.known = dict(self.values)  ## last value that was not None
+
+    def get(self, name):
+        '''Returns shadowed value of register, or None if it is unknown'''
+
+        return self.values[name]
+
+    def set(self, name, value):
+        '''Records value that was successfully written to register'''
+
+        with self.lock:
+            self.values[name] = value
+            if value is not None: self.known[name] = value
+
+    def reset(self, defaults):
+        '''Records several known values at once, e.g. after a device reset'''
+
+        with self.lock:
+            self.values.update(defaults)
+            self.known.update((name, value) for name, value in defaults.items()
+                              if value is not None)
+
+    def invalidate(self, group):
+        '''Marks every register of a device group as unknown'''
+
+        with self.lock:
+            for name in groups[group]: self.values[name] = None
+
+    def last_known(self):
+        '''Returns last known value of every register (None if never known)'''
+
+        with self.lock: return dict(self.known)
+
+## registers of the device selected by the calling thread (see devices.py)
+registers = devices.PerDevice(lambda name: ShadowRegisters())
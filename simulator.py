@@ -0,0 +1,304 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Simulated hardware for running the controller without a laser attached
+
+##### IMPORTS #################################################################
+
+import os                               ## for pseudo-terminal file handles
+import pty                              ## pseudo-terminal pairs
+import tty                              ## raw mode for pseudo-terminals
+import time                             ## for simulated response delays
+import select                           ## waiting for input, or being unplugged
+import struct                           ## for decoding binary frames
+import protocol                         ## binary framing of Arduino frames
+from threading import Thread, Lock, Event   ## devices run in background threads
+
+##### FAKE SERIAL DEVICE ######################################################
+
+class FakeSerialDevice(Thread):
+    '''
+    Pseudo-terminal of a fake serial device, which can be unplugged
+
+        - self.port is a TTY path that can be opened like /dev/ttyUSB0, or a
+          symbolic link to it (like /dev/serial/by-id/...) if link is given
+        - unplug() closes the pseudo-terminal and removes the link, so that
+          an open port fails and the path disappears, as on a USB reset;
+          replug() creates a new pseudo-terminal (under a new TTY path) and
+          points the link at it
+        - subclasses answer what was read in serve(), which returns the
+          bytes it could not use yet
+    '''
+
+    def __init__(self, delay, link=None):
+        '''
+        Init function for fake device, plugged in (subclasses start serving)
+
+        Arguments:
+            delay <float> - seconds the device takes to process a message
+            link <str> - path of a symbolic link to the TTY (None: no link)
+
+        Returns:
+            none
+        '''
+        Thread.__init__(self, daemon=True)
+        self.delay = delay
+        self.link = link
+        self.transactions = 0
+        self.plugged = Event()
+        self.replug()
+
+    def replug(self):
+        '''Plugs the device in, on a new pseudo-terminal'''
+
+        master, self.slave = pty.openpty()
+        tty.setraw(self.slave)              ## no echo or newline translation
+        self.port = os.ttyname(self.slave)
+        if self.link is not None:           ## switched over in one step
+            os.symlink(self.port, self.link + '.new')
+            os.replace(self.link + '.new', self.link)
+            self.port = self.link
+        self.master = master
+        self.plugged.set()
+
+    def unplug(self):
+        '''Unplugs the device: open ports fail and the link disappears'''
+
+        self.plugged.clear()
+        if self.link is not None and os.path.lexists(self.link): os.remove(self.link)
+        master, self.master = self.master, None
+        os.close(master)
+        os.close(self.slave)
+
+    def run(self):
+        '''Reads messages from the pseudo-terminal and answers them'''
+
+        buffer = b''
+        while True:
+            self.plugged.wait()
+            master = self.master
+            try:
+                if not select.select([master], [], [], 0.1)[0]: continue
+                buffer = self.serve(master, buffer + os.read(master, 1024))
+            except (OSError, ValueError, TypeError):    ## unplugged meanwhile
+                buffer = b''
+
+##### FAKE BIORAY LASER #######################################################
+
+class FakeBioRay(FakeSerialDevice):
+    '''
+    Pseudo-terminal backed imitation of a Coherent BioRay laser
+
+        - queries (ending with ?) are answered with a value line and OK
+        - settings are stored and answered with OK
+        - unknown registers are answered with an ERR handshake
+        - see FakeSerialDevice for its port, and unplugging it
+    '''
+
+    def __init__(self, delay=0.0005, link=None):
+        '''
+        Init function for fake laser, starts serving immediately
+
+        Arguments:
+            delay <float> - seconds the laser takes to process a message
+            link <str> - path of a symbolic link to the TTY (None: no link)
+
+        Returns:
+            none
+        '''
+        FakeSerialDevice.__init__(self, delay, link)
+        self.registers = {
+            'SOUR:AM:STAT' : 'OFF',
+            'SOUR:AM:MPOL' : 'PASS',
+            'SYST:STAT'    : '0',
+            'SYST:FAUL'    : '0',
+            'SOUR:TEMP:DIOD' : '25.0',
+            'SOUR:TEMP:INT'  : '30.0',
+        }
+        self.start()
+
+    def respond(self, msg):
+        '''Returns the reply of the laser to a single message'''
+
+        self.transactions += 1
+        if msg.endswith('?'):
+            if msg[:-1] not in self.registers: return 'ERR-100\r\n'
+            return self.registers[msg[:-1]] + '\r\nOK\r\n'
+        words = msg.split(' ')
+        if len(words) != 2 or words[0] not in self.registers:
+            return 'ERR-100\r\n'
+        self.registers[words[0]] = words[1]
+        return 'OK\r\n'
+
+    def serve(self, master, buffer):
+        '''Answers every complete message in buffer, returns the rest'''
+
+        while b'\r\n' in buffer:
+            line, buffer = buffer.split(b'\r\n', 1)
+            if self.delay: time.sleep(self.delay)
+            reply = self.respond(line.decode(encoding='ascii'))
+            os.write(master, reply.encode(encoding='ascii'))
+        return buffer
+
+##### FAKE ARDUINO ############################################################
+
+class FakeArduino(FakeSerialDevice):
+    '''
+    Pseudo-terminal backed imitation of the Arduino running MCP4725.ino
+
+        - frames are lines of A/T/P/D setpoints, ended by a newline, or
+          binary frames (see protocol.py), acknowledged as the sketch would
+        - setpoints are stored in self.setpoints, uploaded wave tables in
+          self.wave and streamed power values in self.stream
+        - see FakeSerialDevice for its port, and unplugging it (which loses
+          the setpoints, as a real board that re-enumerates starts afresh)
+    '''
+
+    def __init__(self, delay=0.0005, link=None):
+        '''
+        Init function for fake Arduino, starts serving immediately
+
+        Arguments:
+            delay <float> - seconds the sketch takes to process a frame
+            link <str> - path of a symbolic link to the TTY (None: no link)
+
+        Returns:
+            none
+        '''
+        FakeSerialDevice.__init__(self, delay, link)
+        self.start()
+
+    def replug(self):
+        '''Plugs the board in, with the setpoints the sketch starts with'''
+
+        self.setpoints = {'A': 0.0, 'T': 50.0, 'P': 0.0, 'D': 0.0, 'C': 1.0,
+                          'W': 0.0, 'N': 0.0}
+        self.wave = []
+        self.stream = []
+        self.resync = False             ## dropping bytes up to the next frame
+        FakeSerialDevice.replug(self)
+
+    def apply(self, key, value):
+        '''Stores a single setpoint'''
+
+        if key == 'W': self.wave = []
+        if key == 'S': self.stream = []
+        self.setpoints[key] = value
+
+    def respond(self, frame):
+        '''Applies setpoints of a single ASCII frame, returns acknowledgement'''
+
+        self.transactions += 1
+        for token in frame.split():
+            if token[0] == 'V': self.wave += protocol.samples(token[1:])
+            elif token[0] == 'Q': self.stream += protocol.samples(token[1:])
+            else:
+                try: self.apply(token[0], float(token[1:]))
+                except ValueError: pass
+        return b'OK\r\n'
+
+    def respondBinary(self, frame):
+        '''Applies payload of a single binary frame, returns acknowledgement'''
+
+        self.transactions += 1
+        version, sequence, command, length = frame[1:5]
+        payload = frame[5:5+length]
+        status = 0x00
+        if protocol.crc8(frame[1:-1]) != frame[-1]: status = 0x01
+        elif version != protocol.VERSION: status = 0x02
+        elif command == protocol.CMD_SETPOINTS and length % 5 == 0:
+            for i in range(0, length, 5):
+                key, value = struct.unpack('<cf', payload[i:i+5])
+                self.apply(key.decode(encoding='ascii'), value)
+        elif command in (protocol.CMD_WAVE, protocol.CMD_STREAM) and length % 2 == 0:
+            values = list(struct.unpack('<%dH' % (length // 2), payload))
+            if command == protocol.CMD_WAVE: self.wave += values
+            else: self.stream += values
+        else: status = 0x03
+        return bytes([protocol.ACK_SYNC, sequence, status])
+
+    def serve(self, master, buffer):
+        '''Acknowledges every complete frame in buffer, returns the rest'''
+
+        while len(buffer) > 0:
+            if self.resync:                 ## rest of a rejected binary frame
+                following = buffer.find(bytes([protocol.SYNC]))
+                if following == -1: return b''
+                buffer, self.resync = buffer[following:], False
+            if buffer[0] == protocol.SYNC:
+                if len(buffer) < 5: break
+                if buffer[4] > protocol.MAX_PAYLOAD:    ## can never fit, as in the sketch
+                    os.write(master, bytes([protocol.ACK_SYNC, buffer[2], 0x03]))
+                    buffer, self.resync = buffer[5:], True
+                    continue
+                if len(buffer) < 6 + buffer[4]: break
+                frame, buffer = buffer[:6+buffer[4]], buffer[6+buffer[4]:]
+                reply = self.respondBinary(frame)
+            else:
+                if b'\n' not in buffer: break
+                frame, buffer = buffer.split(b'\n', 1)
+                reply = self.respond(frame.decode(encoding='ascii'))
+            if self.delay: time.sleep(self.delay)
+            os.write(master, reply)
+        return buffer
+
+##### FAKE GPIO ###############################################################
+
+class FakeGPIO:
+    '''
+    Stand-in for the RPi.GPIO module
+
+        - provides the constants and functions used by the controller
+        - outputs are recorded in self.levels
+        - inputs are driven with set_input(), which also calls any edge
+          callbacks registered with add_event_detect()
+        - interlock starts closed and override off, so the laser can run
+    '''
+
+    BCM = 11
+    IN, OUT = 1, 0
+    HIGH, LOW = 1, 0
+    RISING, FALLING, BOTH = 31, 32, 33
+
+    def __init__(self):
+        self.levels = {23: 1, 24: 0}    ## interlock closed, override off
+        self.callbacks = {}
+        self.lock = Lock()
+
+    def setmode(self, mode): pass
+    def setwarnings(self, flag): pass
+    def cleanup(self, *args): pass
+
+    def setup(self, pins, direction, **kwargs):
+        for pin in (pins if isinstance(pins, list) else [pins]):
+            self.levels.setdefault(pin, 0)
+
+    def output(self, pins, values):
+        if not isinstance(pins, list): pins, values = [pins], [values]
+        elif not isinstance(values, (list, tuple)): values = [values] * len(pins)
+        with self.lock:
+            for pin, value in zip(pins, values): self.levels[pin] = int(value)
+
+    def input(self, pin):
+        return self.levels.get(pin, 0)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def set_input(self, pin, value):
+        '''Drives an input pin, calling its edge callback if it changed'''
+
+        with self.lock:
+            changed = self.levels.get(pin) != value
+            self.levels[pin] = value
+        if changed and self.callbacks.get(pin) is not None:
+            self.callbacks[pin](pin)
@@ -0,0 +1,163 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## State of every device, shared by the hardware daemon with the front-end
+## processes through a memory-mapped file
+
+##### IMPORTS #################################################################
+
+import json                             ## encoding of the state
+import mmap                             ## memory shared between processes
+import struct                           ## header of the shared file
+import time                             ## wall clock of snapshots, periods
+from threading import Thread, Event, Lock   ## writer runs in the background
+import config                           ## shared file, size and period
+from errors import log, log_exception   ## failed snapshots are logged
+
+##### SHARED SNAPSHOT #########################################################
+
+HEADER = struct.Struct('<QI')           ## sequence number, length of state
+
+class Snapshot:
+    '''
+    Latest state of every device in shared memory, one writer and any readers
+
+        - the state is a JSON object after a header holding a sequence number
+          and the length of the JSON
+        - the writer makes the sequence number odd before changing the state
+          and even again afterwards (a seqlock), so readers never block the
+          writer and retry if the state changed while they were reading it
+        - readers keep the state they parsed last, and only parse again
+          once the sequence number has moved on
+    '''
+
+    def __init__(self, path=config.SNAPSHOT_FILE, size=config.SNAPSHOT_SIZE, create=False):
+        '''
+        Init function for snapshot, maps the shared file
+
+        Arguments:
+            path <str> - shared file, preferably on a RAM disk (/dev/shm)
+            size <int> - bytes of the shared file, header included
+            create <bool> - whether this is the writer, which (re)creates the file
+
+        Returns:
+            none
+        '''
+        self.path = path
+        self.size = size
+        self.map = None
+        self.sequence = 0
+        self.state = {}
+        if create:
+            with open(path, 'wb') as file: file.truncate(size)
+            self.attach()
+
+    def attach(self):
+        '''Maps the shared file, returns whether it exists'''
+
+        if self.map is not None: return True
+        try:
+            with open(self.path, 'r+b') as file:
+                self.map = mmap.mmap(file.fileno(), self.size)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def write(self, state):
+        '''Replaces the shared state (writer only), raises if it does not fit'''
+
+        data = json.dumps(state, separators=(',', ':')).encode(encoding='ascii')
+        if HEADER.size + len(data) > self.size:
+            raise ValueError('Snapshot of ' + str(len(data)) + ' bytes does not fit')
+        sequence = HEADER.unpack_from(self.map)[0]
+        HEADER.pack_into(self.map, 0, sequence + 1, 0)      ## odd: being written
+        self.map[HEADER.size:HEADER.size + len(data)] = data
+        HEADER.pack_into(self.map, 0, sequence + 2, len(data))
+
+    def read(self):
+        '''
+        Returns the shared state
+
+        Returns:
+            Dict written last by the writer (empty if nothing was written yet)
+        '''
+        if not self.attach(): return {}
+        for attempt in range(1000):     ## a writer that died keeps it odd
+            sequence, length = HEADER.unpack_from(self.map)
+            if sequence == self.sequence: break
+            if sequence % 2 == 1: continue  ## being written, try again
+            data = self.map[HEADER.size:HEADER.size + length]
+            if HEADER.unpack_from(self.map)[0] != sequence: continue
+            self.state = json.loads(data.decode(encoding='ascii')) if length else {}
+            self.sequence = sequence
+            break
+        return self.state
+
+##### SNAPSHOT WRITER #########################################################
+
+class SnapshotWriter(Thread):
+    '''
+    Writes the state of every device into a snapshot at a fixed period
+
+        - sample() returns the state, e.g. every telemetry field of every
+          device, so sampling reads the telemetry snapshot rather than the
+          devices
+        - wake() makes the writer write a new snapshot straight away, e.g.
+          when the interlock changes, instead of at the next period, and
+          write() does so on the calling thread, e.g. before replying to a
+          command so that its effect is visible to the client at once
+    '''
+
+    def __init__(self, snapshot, sample, period=config.SNAPSHOT_PERIOD):
+        '''
+        Init function for snapshot writer (call start() to begin)
+
+        Arguments:
+            snapshot <Snapshot> - snapshot created by this process
+            sample <function> - returns the state as a JSON serialisable dict
+            period <float> - seconds between snapshots
+
+        Returns:
+            none
+        '''
+        Thread.__init__(self, daemon=True)
+        self.snapshot = snapshot
+        self.sample = sample
+        self.period = period
+        self.woken = Event()
+        self.lock = Lock()          ## a snapshot has only one writer at a time
+        self.failing = False        ## whether the last snapshot failed
+
+    def wake(self, *args):
+        '''Makes the writer write a snapshot now (arguments are ignored)'''
+
+        self.woken.set()
+
+    def write(self):
+        '''Samples the state and writes it into the snapshot, logging failures'''
+
+        with self.lock:
+            try:
+                state = self.sample()
+                state['time'] = time.time()
+                self.snapshot.write(state)
+            except Exception:           ## keep the last snapshot, try again
+                if not self.failing: log_exception('SNAPSHOT')  ## once, not every period
+                self.failing = True
+                return
+            if self.failing: log('SNAPSHOT WRITTEN AGAIN')
+            self.failing = False
+
+    def run(self):
+        '''Writes a snapshot once every period (or when woken), forever'''
+
+        while True:
+            self.woken.clear()
+            self.write()
+            self.woken.wait(self.period)
@@ -0,0 +1,212 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Background polling of laser registers into a shared snapshot
+
+##### IMPORTS #################################################################
+
+import time                             ## monotonic clock for timestamps
+from threading import Thread, Lock, Condition  ## run in background threads
+from concurrent.futures import Future   ## for sharing in-flight reads
+import config                           ## polled registers and rates
+from errors import log_exception        ## failed polls are logged
+
+##### TELEMETRY POLLER ########################################################
+
+class TelemetryPoller(Thread):
+    '''
+    Keeps an in-memory snapshot of laser registers up to date
+
+        - every period, each configured register is read from the laser
+        - successful reads are stored with a monotonic timestamp
+        - get() answers from the snapshot while the value is within its TTL
+          and falls back to a live read when it is stale or when asked to
+        - identical live reads that overlap are coalesced into a single
+          serial transaction, whose result is shared by all callers
+        - listeners are called with (register, result) after every
+          successful read, e.g. to keep shadow registers in step
+        - values written to the laser are stored with store(), and reads
+          that started before the write are not stored (nor passed to
+          listeners), so a poll on the line can not bring back the old value
+    '''
+
+    def __init__(self, read, registers=config.TELEMETRY_REGISTERS,
+                             period=config.TELEMETRY_PERIOD):
+        '''
+        Init function for telemetry poller (call start() to begin polling)
+
+        Arguments:
+            read <function> - reads one register, e.g. BioRay.laser
+            registers <dict> - register to TTL (seconds) of its cached value
+            period <float> - seconds between polls of all registers
+
+        Returns:
+            none
+        '''
+        Thread.__init__(self, daemon=True)
+        self.read = read
+        self.registers = registers
+        self.period = period
+        self.snapshot = {}      ## register -> (result, timestamp)
+        self.inflight = {}      ## register -> Future of running live read
+        self.writes = {}        ## register -> monotonic time of last store()
+        self.listeners = []     ## called with (register, result) on success
+        self.lock = Lock()
+
+    def get(self, register, fresh=False):
+        '''
+        Returns value of register from the snapshot or from the laser
+
+        Arguments:
+            register <str> - register query to read, e.g. 'SYST:STAT?'
+            fresh <bool> - always read the laser, ignoring the snapshot
+
+        Returns:
+            Response from laser
+            Error codes (see local file errors.txt)
+        '''
+        if not fresh:
+            cached = self.snapshot.get(register)
+            ttl = self.registers.get(register, 0)
+            if cached is not None and time.monotonic() - cached[1] <= ttl:
+                return cached[0]
+        return self.live(register)
+
+    def live(self, register):
+        '''Reads register from laser, sharing the result with overlapping reads'''
+
+        with self.lock:
+            future = self.inflight.get(register)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.inflight[register] = future
+        if not leader: return future.result()
+
+        try:
+            started = time.monotonic()
+            result = self.read(register)
+            with self.lock:
+                written = self.writes.get(register, started) > started
+                if written: result = self.snapshot[register][0]    ## read is older
+                elif result[0] == '00': self.snapshot[register] = (result, time.monotonic())
+            if result[0] == '00' and not written:
+                for listener in self.listeners: listener(register, result)
+            future.set_result(result)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock: del self.inflight[register]
+        return future.result()
+
+    def store(self, register, value):
+        '''
+        Records a value that was just written to the laser, as if read back
+
+        Arguments:
+            register <str> - register query of the value, e.g. 'SOUR:AM:STAT?'
+            value <str> - value written, e.g. 'ON'
+
+        Returns:
+            none
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.writes[register] = now
+            self.snapshot[register] = (['00', value], now)
+
+    def run(self):
+        '''Polls all registers once every period, forever'''
+
+        deadline = time.monotonic()
+        while True:
+            for register in self.registers:
+                try: self.live(register)
+                except Exception:       ## keep polling the other registers
+                    log_exception('TELEMETRY POLL OF ' + register)
+            deadline += self.period
+            delay = deadline - time.monotonic()
+            if delay > 0: time.sleep(delay)
+            else: deadline = time.monotonic()   ## fell behind, do not catch up
+
+##### TELEMETRY PUBLISHER #####################################################
+
+class TelemetryPublisher(Thread):
+    '''
+    Streams telemetry lines to subscribed clients at their requested rates
+
+        - each field is sampled once per tick, however many clients are
+          subscribed to it, and the result is fanned out to all of them
+        - a line is offered to a client with client.offer(line, prefix);
+          clients keep only the latest line of each prefix they have not
+          sent yet, so a slow client drops old values instead of buffering
+          them without limit
+    '''
+
+    def __init__(self, fields, prefix='!TELEMETRY'):
+        '''
+        Init function for telemetry publisher (call start() to begin)
+
+        Arguments:
+            fields <dict> - field name to function returning its current value
+            prefix <str> - start of every telemetry line
+
+        Returns:
+            none
+        '''
+        Thread.__init__(self, daemon=True)
+        self.fields = fields
+        self.prefix = prefix
+        self.subscriptions = {}     ## client -> [fields, period, next due time]
+        self.condition = Condition()
+
+    def subscribe(self, client, fields, rate):
+        '''Starts (or replaces) subscription of client to fields at rate Hz'''
+
+        with self.condition:
+            self.subscriptions[client] = [fields, 1.0 / rate, time.monotonic()]
+            self.condition.notify()
+
+    def unsubscribe(self, client):
+        '''Stops subscription of client, returns whether it was subscribed'''
+
+        with self.condition:
+            return self.subscriptions.pop(client, None) is not None
+
+    def sample(self, fields):
+        '''Returns dict of field name to current value as string'''
+
+        values = {}
+        for field in fields:
+            try: value = self.fields[field]()
+            except Exception: value = 'ERR'
+            values[field] = 'UNKNOWN' if value is None else str(value)
+        return values
+
+    def run(self):
+        '''Publishes to every subscription that is due, forever'''
+
+        while True:
+            with self.condition:
+                while len(self.subscriptions) == 0: self.condition.wait()
+                now = time.monotonic()
+                due = min(s[2] for s in self.subscriptions.values())
+                if due > now:
+                    self.condition.wait(due - now)
+                    continue
+                ready = [(client, s) for client, s in self.subscriptions.items()
+                         if s[2] <= now]
+                for client, s in ready:     ## if behind, skip missed ticks
+                    s[2] = s[2] + s[1] if s[2] + s[1] > now else now + s[1]
+
+            values = self.sample(set(f for _, s in ready for f in s[0]))
+            for client, s in ready:
+                client.offer((self.prefix + ' ' + ' '.join(
+                    field + '=' + values[field] for field in s[0]) + '\r\n')
+                    .encode(encoding='ascii'), self.prefix)
@@ -0,0 +1,76 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Checks of the client library against a scripted server (run from the
+## repository root with "python3 -m unittest discover tests")
+
+##### IMPORTS #################################################################
+
+import asyncio                          ## for the asyncio client
+import socket                           ## scripted server
+import unittest                         ## test runner
+from threading import Thread            ## server runs in the background
+from i14client import Client, AsyncClient, MessageError
+
+##### HELPERS #################################################################
+
+class ScriptedServer(Thread):
+    '''Accepts one client, reads count lines, then sends reply without a request ID'''
+
+    def __init__(self, count, reply):
+        Thread.__init__(self, daemon=True)
+        self.count = count
+        self.reply = reply
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.address = self.sock.getsockname()
+        self.start()
+
+    def run(self):
+        sock, _ = self.sock.accept()
+        data = b''
+        while data.count(b'\r\n') < self.count:
+            data += sock.recv(4096)
+        sock.sendall(self.reply)
+        sock.recv(4096)                 ## until the client closes
+        sock.close()
+
+REJECTED = b'15 : Server has reached its connection limit\r\n'
+
+##### UNTAGGED REPLIES ########################################################
+
+class TestUntaggedReplies(unittest.TestCase):
+    '''An error the server could not tag must not leave requests waiting'''
+
+    def test_only_request(self):
+        server = ScriptedServer(1, REJECTED)
+        with Client(*server.address, timeout=2.0) as client:
+            with self.assertRaises(MessageError):
+                client.request('?LASER_POWER')
+
+    def test_every_request(self):
+        server = ScriptedServer(2, REJECTED)
+        with Client(*server.address, timeout=2.0) as client:
+            replies = client.batch(['?LASER_POWER', '?LASER_MODE'], errors=False)
+        self.assertTrue(all(isinstance(reply, MessageError) for reply in replies))
+
+    def test_asyncio(self):
+        server = ScriptedServer(1, REJECTED)
+
+        async def requesting():
+            async with AsyncClient(*server.address, timeout=2.0) as client:
+                with self.assertRaises(MessageError):
+                    await client.request('?LASER_POWER')
+        loop = asyncio.new_event_loop()
+        try: loop.run_until_complete(requesting())
+        finally: loop.close()
+
+if __name__ == '__main__':
+    unittest.main()
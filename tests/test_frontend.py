@@ -0,0 +1,112 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Checks of the link between front-ends and the hardware daemon (run from
+## the repository root with "python3 -m unittest discover tests")
+
+##### IMPORTS #################################################################
+
+import os                               ## for the files of each test
+import queue                            ## messages received by a front-end
+import socket                           ## for dropping the link
+import tempfile                         ## socket and snapshot of the daemon
+import time                             ## for waiting on the link
+import unittest                         ## test runner
+from threading import Thread            ## daemon and link run in the background
+import config                           ## selects simulated backend
+
+config.BACKEND = 'simulated'            ## must happen before hardware imports
+folder = tempfile.mkdtemp(prefix='i14_frontend_')
+config.SNAPSHOT_FILE = os.path.join(folder, 'snapshot')   ## not the real one
+
+import daemon                           ## hardware daemon
+import frontend                         ## link under test
+from errors import return_code          ## messages the daemon pushes
+
+##### DAEMON LINK #############################################################
+
+class TestDaemonLink(unittest.TestCase):
+    '''A front-end whose clients only subscribe never forwards a command'''
+
+    def setUp(self):
+        self.path = os.path.join(folder, self.id().split('.')[-1] + '.sock')
+        self.daemon = daemon.hardwareDaemon(path=self.path)
+        Thread(target=self.daemon.serve, daemon=True).start()
+        self.link = frontend.daemonLink(path=self.path)
+        self.pushed = queue.Queue()
+        self.link.listeners.append(self.pushed.put)
+        Thread(target=self.link.keep, args=(0.01,), daemon=True).start()
+
+    def tearDown(self):
+        self.daemon.sock.close()
+        for connection in list(self.daemon.connections): connection.sock.close()
+
+    def wait(self, condition):
+        '''Waits up to a second for condition() to hold'''
+
+        for attempt in range(100):
+            if condition(): return
+            time.sleep(0.01)
+        self.fail('Timed out')
+
+    def push(self, status):
+        '''Changes the interlock once the front-end is connected, returns its push'''
+
+        self.wait(lambda: len(self.daemon.connections) > 0)
+        self.daemon.interlockChanged(status)
+        return self.pushed.get(timeout=1.0)
+
+    def test_push_without_commands(self):
+        self.assertEqual(self.push('90'), b'!INTERLOCK ' + return_code('90'))
+
+    def test_push_after_reconnect(self):
+        self.push('90')
+        dropped = set(self.daemon.connections)
+        for connection in dropped:
+            connection.sock.shutdown(socket.SHUT_RDWR)  ## as if the link dropped
+        self.wait(lambda: len(self.daemon.connections - dropped) > 0)
+        self.assertEqual(self.push('00'), b'!INTERLOCK ' + return_code('00'))
+
+##### TIMEOUTS ################################################################
+
+class TestTimeout(unittest.TestCase):
+    '''The daemon must give up on a command before its front-end does'''
+
+    def test_budget_of_command(self):
+        for words, budget in [(['?LASER_POWER'], 'query'), (['LASER_POWER', '40'], 'command'),
+                              (['LASER_WAVEFORM', 'SINE', '100', '0'], 'upload')]:
+            self.assertGreater(frontend.timeout(words), config.BUDGETS[budget])
+
+    def test_deadline_of_client(self):
+        self.assertGreater(frontend.timeout(['LASER_WAVEFORM', 'SINE', '100', '0',
+                                             '!DEADLINE=30000']), 30.0)
+
+##### LOCAL COMMANDS ##########################################################
+
+class Listener:
+    '''Client that takes telemetry and ignores it'''
+
+    def offer(self, message, topic=None):
+        pass
+
+class TestLocalCommands(unittest.TestCase):
+    '''Commands a front-end answers itself take a deadline as the daemon does'''
+
+    def test_deadline_is_stripped(self):
+        client = Listener()
+        self.assertEqual(frontend.parse(['SUBSCRIBE', 'POWER', '1', '!DEADLINE=500'], client),
+                         return_code('00'))
+        self.assertEqual(frontend.parse(['UNSUBSCRIBE', '!deadline=500'], client),
+                         return_code('00'))
+
+    def test_bad_deadline(self):
+        self.assertNotEqual(frontend.parse(['?STATE', '!DEADLINE=x'])[:2], b'00')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Host-side checks of the Arduino frame encodings (run from the repository
+## root with "python3 -m unittest discover tests" or "python3 -m pytest")
+
+##### IMPORTS #################################################################
+
+import os                               ## for reading the fake's replies
+import select                           ## waiting for the fake's replies
+import unittest                         ## test runner
+import config                           ## selects simulated backend
+
+config.BACKEND = 'simulated'            ## must happen before hardware imports
+
+import protocol                         ## encoders under test
+import simulator                        ## fake Arduino, decoding as the sketch
+
+##### CRC-8 ###################################################################
+
+class TestCRC8(unittest.TestCase):
+    '''CRC-8 with polynomial 0x07, as _crc8_ccitt_update on the AVR'''
+
+    def test_check_value(self):
+        ## catalogued check value of CRC-8/SMBUS (poly 0x07, init 0, no xorout)
+        self.assertEqual(protocol.crc8(b'123456789'), 0xF4)
+
+    def test_short_inputs(self):
+        self.assertEqual(protocol.crc8(b''), 0x00)
+        self.assertEqual(protocol.crc8(b'\x00'), 0x00)
+        self.assertEqual(protocol.crc8(b'\x01'), 0x07)
+        self.assertEqual(protocol.crc8(b'\x80'), 0x89)
+
+    def test_residue(self):
+        ## data followed by its own CRC always checks out as 0
+        for data in [b'123456789', b'\xA5\x5A', bytes(range(64))]:
+            self.assertEqual(protocol.crc8(data + bytes([protocol.crc8(data)])), 0)
+
+##### ENCODERS ################################################################
+
+class TestEncoders(unittest.TestCase):
+    '''Frames as the sketch expects them, byte for byte'''
+
+    def test_setpoint(self):
+        self.assertEqual(protocol.encodeBinary('A50.0', 7),
+                         bytes.fromhex('a5 01 07 01 05 41 00004842 c2'))
+
+    def test_setpoints_and_sequence_wrap(self):
+        self.assertEqual(protocol.encodeBinary('A50.0 P100 D0', 255),
+                         bytes.fromhex('a5 01 ff 01 0f 41 00004842 50 0000c842 44 00000000 e3'))
+
+    def test_wave_samples(self):
+        self.assertEqual(protocol.encodeBinary('V000FFF800', 3),
+                         bytes.fromhex('a5 01 03 02 06 0000 ff0f 0008 a7'))
+
+    def test_checksum_covers_all_but_sync(self):
+        frame = protocol.encodeBinary('A12.5 T40', 42)
+        self.assertEqual(frame[0], protocol.SYNC)
+        self.assertEqual(protocol.crc8(frame[1:]), 0)
+
+    def test_too_long(self):
+        with self.assertRaises(ValueError):
+            protocol.encodeBinary(' '.join('A1' for _ in range(12)), 0)
+
+    def test_ascii(self):
+        self.assertEqual(protocol.encodeASCII('A50.0 P100', 1), b'A50.0 P100 \r\n')
+
+##### FRAMING #################################################################
+
+class TestFraming(unittest.TestCase):
+    '''Frames sent to the fake Arduino, which decodes them as the sketch does'''
+
+    def setUp(self):
+        self.fake = simulator.FakeArduino(delay=0)
+        self.port = os.open(self.fake.port, os.O_RDWR | os.O_NOCTTY)
+
+    def tearDown(self):
+        os.close(self.port)
+        self.fake.unplug()
+
+    def reply(self, size):
+        data = b''
+        while len(data) < size and select.select([self.port], [], [], 1.0)[0]:
+            data += os.read(self.port, size - len(data))
+        return data
+
+    def test_acknowledged(self):
+        os.write(self.port, protocol.encodeBinary('A25.0', 9))
+        self.assertEqual(self.reply(3), bytes([protocol.ACK_SYNC, 9, 0x00]))
+        self.assertEqual(self.fake.setpoints['A'], 25.0)
+
+    def test_corrupted(self):
+        frame = bytearray(protocol.encodeBinary('A25.0', 9))
+        frame[6] ^= 0x01
+        os.write(self.port, bytes(frame))
+        self.assertEqual(self.reply(3), bytes([protocol.ACK_SYNC, 9, 0x01]))
+        self.assertEqual(self.fake.setpoints['A'], 0.0)
+
+    def test_oversized_payload_is_not_read_as_text(self):
+        ## length byte too large: the payload (which reads as an ASCII power
+        ## setpoint) must be skipped up to the next frame, not applied
+        os.write(self.port, bytes([protocol.SYNC, protocol.VERSION, 4, protocol.CMD_SETPOINTS,
+                                   protocol.MAX_PAYLOAD + 1]) + b'A99\n')
+        os.write(self.port, protocol.encodeBinary('T30.0', 5))
+        self.assertEqual(self.reply(6), bytes([protocol.ACK_SYNC, 4, 0x03,
+                                               protocol.ACK_SYNC, 5, 0x00]))
+        self.assertEqual(self.fake.setpoints['A'], 0.0)
+        self.assertEqual(self.fake.setpoints['T'], 30.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Checks of the priority lanes of the serial I/O scheduler (run from the
+## repository root with "python3 -m unittest discover tests")
+
+##### IMPORTS #################################################################
+
+import time                             ## for making a request late
+import unittest                         ## test runner
+from threading import Event             ## holds up the fake device
+import config                           ## selects simulated backend
+
+config.BACKEND = 'simulated'            ## must happen before hardware imports
+
+import arduino                          ## frames superseded by switching off
+import budget                           ## deadline seen by the device
+from scheduler import DeviceScheduler, SAFETY, WRITE, READ
+
+##### HELPERS #################################################################
+
+class FakeDevice:
+    '''Applies setpoint frames as the sketch does, the first one once released'''
+
+    def __init__(self):
+        self.setpoints = {'A': 0.0}
+        self.started = Event()          ## set once the first frame is on the line
+        self.release = Event()          ## lets the first frame finish
+        self.frames = []
+        self.budgets = []               ## seconds left of the budget of each batch
+
+    def execute(self, frames):
+        self.started.set()
+        self.release.wait(5.0)
+        self.budgets.append(budget.remaining())
+        for frame in frames:
+            self.frames.append(frame)
+            if frame.endswith('?'): continue
+            for word in frame.split(): self.setpoints[word[0]] = float(word[1:])
+        return ['00' if not frame.endswith('?') else str(self.setpoints['A'])
+                for frame in frames]
+
+##### SAFETY LANE #############################################################
+
+class TestSafetyLane(unittest.TestCase):
+    '''Switching off must not be undone by writes queued before it'''
+
+    def setUp(self):
+        self.device = FakeDevice()
+        self.scheduler = DeviceScheduler('test', self.device.execute, batch=None,
+                                         supersedes=arduino.supersedes)
+
+    def test_queued_power_is_not_sent_after_switching_off(self):
+        busy = self.scheduler.submit('T40.0', WRITE, timeout=5.0)
+        self.device.started.wait(5.0)   ## later frames now wait in the lanes
+        power = self.scheduler.submit('A50.0 C1.2', WRITE, timeout=5.0)
+        other = self.scheduler.submit('P100.0', WRITE, timeout=5.0)
+        off = self.scheduler.submit('A0.0', SAFETY, timeout=5.0)
+        self.device.release.set()
+        self.assertEqual(off.result(5.0), '00')
+        self.assertEqual(power.result(5.0)[0], '90')
+        self.assertEqual(other.result(5.0), '00')
+        self.assertEqual(busy.result(5.0), '00')
+        self.assertEqual(self.device.setpoints['A'], 0.0)
+        self.assertNotIn('A50.0 C1.2', self.device.frames)
+        self.assertEqual(self.scheduler.stats()['superseded'], 1)
+
+    def test_power_set_after_switching_off_is_sent(self):
+        self.device.release.set()
+        self.assertEqual(self.scheduler.call('A0.0', SAFETY, timeout=5.0), '00')
+        self.assertEqual(self.scheduler.call('A50.0', WRITE, timeout=5.0), '00')
+        self.assertEqual(self.device.setpoints['A'], 50.0)
+
+    def test_late_switch_off_gets_default_timeout(self):
+        ## a switch-off that starts after its deadline is still sent, and
+        ## must have time to read the acknowledgement
+        self.scheduler.submit('T40.0', WRITE, timeout=5.0)
+        self.device.started.wait(5.0)
+        off = self.scheduler.submit('A0.0', SAFETY, timeout=0.01)
+        time.sleep(0.05)
+        self.device.release.set()
+        self.assertEqual(off.result(5.0), '00')
+        self.assertEqual(self.scheduler.stats()['late'], 1)
+        self.assertGreater(self.device.budgets[-1], 0.5 * self.scheduler.timeout)
+
+##### SHARED READS ############################################################
+
+class TestSharedReads(unittest.TestCase):
+    '''Callers of one coalesced read must not spoil it for each other'''
+
+    def setUp(self):
+        self.device = FakeDevice()
+        self.scheduler = DeviceScheduler('test', self.device.execute, batch=None)
+        self.scheduler.submit('T40.0', WRITE, timeout=5.0)
+        self.device.started.wait(5.0)   ## reads now wait in the lanes
+
+    def test_caller_giving_up_leaves_the_others(self):
+        impatient = self.scheduler.submit('A?', READ, key='A?', timeout=5.0)
+        patient = self.scheduler.submit('A?', READ, key='A?', timeout=5.0)
+        self.assertEqual(self.scheduler.call('A?', READ, key='A?', timeout=0.01), '32')
+        impatient.cancel()
+        self.device.release.set()
+        self.assertEqual(patient.result(5.0), '0.0')
+        self.assertEqual(self.device.frames.count('A?'), 1)
+
+    def test_read_waits_for_latest_deadline(self):
+        first = self.scheduler.submit('A?', READ, key='A?', timeout=0.01)
+        second = self.scheduler.submit('A?', READ, key='A?', timeout=5.0)
+        time.sleep(0.05)                ## the first deadline has passed
+        self.device.release.set()
+        self.assertEqual(second.result(5.0), '0.0')
+        self.assertEqual(first.result(5.0), '0.0')
+
+    def test_cancelled_once_nobody_waits(self):
+        futures = [self.scheduler.submit('A?', READ, key='A?', timeout=5.0) for _ in range(2)]
+        for future in futures: future.cancel()
+        self.device.release.set()
+        self.assertEqual(self.scheduler.call('P1.0', WRITE, timeout=5.0), '00')
+        self.assertNotIn('A?', self.device.frames)
+
+if __name__ == '__main__':
+    unittest.main()
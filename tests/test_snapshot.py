@@ -0,0 +1,149 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Checks of the seqlock between the hardware daemon and its front-ends (run
+## from the repository root with "python3 -m unittest discover tests")
+
+##### IMPORTS #################################################################
+
+import mmap                             ## map that lets a write in mid-read
+import multiprocessing                  ## writer in a process of its own
+import os                               ## for removing the shared file
+import tempfile                         ## shared file of each test
+import unittest                         ## test runner
+from unittest import mock               ## for catching the log
+
+import snapshot                         ## seqlock under test
+
+##### HELPERS #################################################################
+
+SIZE = 1 << 16                          ## bytes of the shared file
+
+def state(number):
+    '''Returns a state whose length changes with number, and which says so'''
+
+    return {'n': number, 'pad': 'x' * (number % 997 * 31), 'check': number % 997}
+
+def writer(path, count):
+    '''Writes count states into the shared file as fast as it can'''
+
+    shared = snapshot.Snapshot(path=path, size=SIZE)
+    shared.attach()
+    for number in range(1, count + 1):
+        shared.write(state(number))
+
+class Interrupted(mmap.mmap):
+    '''Map whose next copy of the state waits for a write, as if preempted'''
+
+    def __getitem__(self, key):
+        write, self.write_next = getattr(self, 'write_next', None), None
+        if write is not None: write()
+        return mmap.mmap.__getitem__(self, key)
+
+##### SEQLOCK #################################################################
+
+class TestSnapshot(unittest.TestCase):
+    '''One writer and one reader, in different processes like daemon and front-end'''
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(prefix='i14_snapshot_')
+        os.close(handle)
+        self.shared = snapshot.Snapshot(path=self.path, size=SIZE, create=True)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_empty(self):
+        reader = snapshot.Snapshot(path=self.path, size=SIZE)
+        self.assertEqual(reader.read(), {})
+
+    def test_missing_file(self):
+        reader = snapshot.Snapshot(path=self.path + '.missing', size=SIZE)
+        self.assertEqual(reader.read(), {})
+
+    def test_round_trip(self):
+        self.shared.write(state(5))
+        reader = snapshot.Snapshot(path=self.path, size=SIZE)
+        self.assertEqual(reader.read(), state(5))
+        self.shared.write(state(6))
+        self.assertEqual(reader.read(), state(6))
+
+    def test_too_large(self):
+        with self.assertRaises(ValueError):
+            self.shared.write({'pad': 'x' * SIZE})
+
+    def test_mid_write(self):
+        ## a reader that finds the writer half way keeps the state before
+        self.shared.write(state(1))
+        reader = snapshot.Snapshot(path=self.path, size=SIZE)
+        self.assertEqual(reader.read(), state(1))
+        sequence = snapshot.HEADER.unpack_from(self.shared.map)[0]
+        snapshot.HEADER.pack_into(self.shared.map, 0, sequence + 1, 0)
+        self.shared.map[snapshot.HEADER.size:snapshot.HEADER.size + 4] = b'{"n"'
+        self.assertEqual(reader.read(), state(1))
+
+    def test_write_during_read(self):
+        ## the header is read, then a longer state is written before the old
+        ## length of it is copied: the reader must notice and read again
+        self.shared.write(state(1))
+        reader = snapshot.Snapshot(path=self.path, size=SIZE)
+        with open(self.path, 'r+b') as file:
+            reader.map = Interrupted(file.fileno(), SIZE)
+        reader.map.write_next = lambda: self.shared.write(state(2))
+        self.assertEqual(reader.read(), state(2))
+
+    def test_no_torn_reads(self):
+        ## a read overlapping a write must not return half of each state (on
+        ## a single core this only overlaps them now and then)
+        count = 20000
+        process = multiprocessing.Process(target=writer, args=(self.path, count))
+        reader = snapshot.Snapshot(path=self.path, size=SIZE)
+        last, reads = 0, 0
+        process.start()
+        while process.is_alive():
+            seen = reader.read()
+            if not seen: continue
+            reads += 1
+            self.assertEqual(seen, state(seen['n']))        ## not torn
+            self.assertGreaterEqual(seen['n'], last)        ## never goes back
+            last = seen['n']
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(reader.read(), state(count))
+        self.assertGreater(reads, 1)
+
+##### SNAPSHOT WRITER #########################################################
+
+class TestSnapshotWriter(unittest.TestCase):
+    '''A snapshot that cannot be written is logged, once until it can again'''
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(prefix='i14_snapshot_')
+        os.close(handle)
+        self.shared = snapshot.Snapshot(path=self.path, size=SIZE, create=True)
+        self.state = state(1)
+        self.writer = snapshot.SnapshotWriter(self.shared, lambda: dict(self.state))
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_failures_are_logged_once(self):
+        self.writer.write()
+        self.state = {'pad': 'x' * SIZE}            ## outgrows the shared file
+        with mock.patch('snapshot.log_exception') as failed, mock.patch('snapshot.log') as logged:
+            for attempt in range(3): self.writer.write()
+            self.assertEqual(failed.call_count, 1)
+            self.state = state(2)
+            self.writer.write()
+            self.assertEqual(logged.call_count, 1)
+        reader = snapshot.Snapshot(path=self.path, size=SIZE)
+        self.assertEqual(reader.read()['n'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Opt-in tracing of where the time of each request goes
+
+##### IMPORTS #################################################################
+
+import time                             ## monotonic clock for span timestamps
+import json                             ## JSON-lines export
+from collections import deque           ## ring of finished traces
+from threading import local, Lock       ## trace of the request a thread serves
+import config                           ## tracing settings
+
+##### STATE ###################################################################
+
+enabled = config.TRACE_ENABLED          ## checked first by everything below
+traces = deque(maxlen=config.TRACE_BUFFER)  ## finished traces, oldest dropped
+active = local()                        ## .traces and .depth of each thread
+export_lock = Lock()
+export_file = None                      ## opened on first export
+
+##### TRACES ##################################################################
+
+class Trace:
+    '''
+    Spans of one request, from the moment it was framed to its reply
+
+        - connection: address of client that sent the request
+        - command: first word of the request
+        - spans: (name, start, end, depth) with perf_counter timestamps,
+          depth counts the spans it is nested in (0: top level)
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.command = None
+        self.time = time.time()         ## wall clock, for matching with logs
+        self.start = time.perf_counter()
+        self.end = None
+        self.spans = []
+
+    def duration(self):
+        return self.end - self.start
+
+    def describe(self):
+        '''Returns trace as one word: conn,COMMAND,total,span@offset+length,...'''
+
+        words = [self.connection, str(self.command), '%.3f' % (self.duration() * 1e3)]
+        for name, start, end, depth in sorted(self.spans, key=lambda span: span[1]):
+            words.append('%s%s@%.3f+%.3f' % ('.' * depth, name,
+                         (start - self.start) * 1e3, (end - start) * 1e3))
+        return ','.join(words)
+
+    def json(self):
+        '''Returns trace as one line of JSON (times in ms since its start)'''
+
+        return json.dumps({
+            'time': self.time, 'connection': self.connection, 'command': self.command,
+            'duration_ms': self.duration() * 1e3,
+            'spans': [{'name': name, 'depth': depth,
+                       'start_ms': (start - self.start) * 1e3,
+                       'duration_ms': (end - start) * 1e3}
+                      for name, start, end, depth in sorted(self.spans, key=lambda span: span[1])]})
+
+def begin(connection):
+    '''Starts tracing the request served by this thread, returns its trace'''
+
+    if not enabled: return None
+    trace = Trace(connection)
+    active.traces, active.depth = [trace], 0
+    return trace
+
+def finish(trace):
+    '''Stops tracing the request served by this thread, keeps its trace'''
+
+    if trace is None: return
+    trace.end = time.perf_counter()
+    active.traces = None
+    traces.append(trace)
+    if config.TRACE_FILE is not None: export(trace)
+
+def export(trace):
+    '''Appends trace to the JSON-lines file'''
+
+    global export_file
+    with export_lock:
+        try:
+            if export_file is None: export_file = open(config.TRACE_FILE, 'a')
+            export_file.write(trace.json() + '\n')
+            export_file.flush()
+        except OSError:
+            pass                        ## tracing must never fail a request
+
+def current():
+    '''Returns traces spans of this thread go to (and their depth), or None'''
+
+    if not enabled: return None
+    found = getattr(active, 'traces', None)
+    if not found: return None
+    return found, active.depth
+
+##### SPANS ###################################################################
+
+class noSpan:
+    '''Stands in for a span while nothing is traced'''
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+
+NO_SPAN = noSpan()
+
+class Span:
+    '''Times the code in a with block as a span of the traces of this thread'''
+
+    __slots__ = ['name', 'traces', 'start']
+
+    def __init__(self, name, traces):
+        self.name = name
+        self.traces = traces
+
+    def __enter__(self):
+        active.depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        active.depth -= 1
+        for trace in self.traces:
+            trace.spans.append((self.name, self.start, end, active.depth))
+        return False
+
+def span(name):
+    '''Returns span for a with block (does nothing unless tracing)'''
+
+    if not enabled: return NO_SPAN
+    traces = getattr(active, 'traces', None)
+    if not traces: return NO_SPAN
+    return Span(name, traces)
+
+def record(name, start, end):
+    '''Adds a span that has already been timed (perf_counter timestamps)'''
+
+    if not enabled: return
+    traces = getattr(active, 'traces', None)
+    if not traces: return
+    for trace in traces: trace.spans.append((name, start, end, active.depth))
+
+class adopt:
+    '''
+    Lets another thread add spans to traces for the duration of a with block
+
+        - used by the device schedulers, whose thread does the serial I/O of
+          requests that were traced on the threads of their clients
+    '''
+
+    def __init__(self, traces, depth):
+        self.traces = traces
+        self.depth = depth
+
+    def __enter__(self):
+        active.traces, active.depth = self.traces, self.depth
+        return self
+
+    def __exit__(self, *exc):
+        active.traces = None
+        return False
+
+##### QUERIES #################################################################
+
+def slow(threshold=None, count=None):
+    '''
+    Returns most recent traces that took longer than a threshold
+
+    Arguments:
+        threshold <float> - seconds (default: config.TRACE_SLOW)
+        count <int> - most traces returned (default: config.TRACE_DUMP)
+
+    Returns:
+        List of traces, most recent first
+    '''
+    if threshold is None: threshold = config.TRACE_SLOW
+    if count is None: count = config.TRACE_DUMP
+    result = []
+    for trace in reversed(list(traces)):
+        if trace.duration() > threshold: result.append(trace)
+        if len(result) == count: break
+    return result
@@ -0,0 +1,101 @@
+###############################################################################
+###                                                                         ###
+###     Written by Alexander Liptak (GitHub: @ajulik1997)                   ###
+###     Date: Summer 2018                                                   ###
+###     E-Mail: Alexander.Liptak.2015@live.rhul.ac.uk                       ###
+###     Phone: +44 7901 595107                                              ###
+###                                                                         ###
+###############################################################################
+
+## Precomputed sample tables for the arbitrary waveform mode of the Arduino
+
+##### IMPORTS #################################################################
+
+import config                           ## table size and sample rate limits
+
+np = None                               ## numpy (vectorised wave generation),
+                                        ## imported on first use as it is slow
+                                        ## to import on the Pi
+
+def load():
+    '''Imports numpy, for the shapes below'''
+
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+
+##### WAVE SHAPES #############################################################
+
+## every shape maps phase (0 <= x < 1, one period) to amplitude (0.0 - 1.0),
+## the first five match the shapes the sketch computes itself
+shapes = {
+    'none'        : lambda x: np.ones_like(x),
+    'sine'        : lambda x: (1 - np.cos(2 * np.pi * x)) / 2,
+    'square'      : lambda x: (x < 0.5).astype(float),
+    'triangle'    : lambda x: 1 - np.abs(2 * x - 1),
+    'sawtooth'    : lambda x: x,
+    'pulse'       : lambda x: np.ones_like(x),
+    'trapezoid'   : lambda x: np.clip(3 - np.abs(6 * x - 3), 0, 1),
+    'gaussian'    : lambda x: np.exp(-((x - 0.5) / 0.15) ** 2 / 2),
+    'exponential' : lambda x: np.expm1(4 * x) / np.expm1(4),
+    'halfsine'    : lambda x: np.sin(np.pi * x),
+}
+
+##### SAMPLE TABLES ###########################################################
+
+def plan(period):
+    '''
+    Chooses how many samples describe one period, and how long each one lasts
+
+    Arguments:
+        period <float> - milliseconds of period of one cycle
+
+    Returns:
+        (samples <int>, sample_us <int>), or None if period is too short
+    '''
+
+    period_us = period * 1e3
+    samples = min(config.WAVEFORM_SAMPLES,
+                  int(period_us // config.WAVEFORM_MIN_SAMPLE_US))
+    if samples < 2: return None
+    return samples, int(round(period_us / samples))
+
+def table(shape, period):
+    '''
+    Computes a quantised 12-bit table of one period of a wave, at full scale
+
+    Arguments:
+        shape <str> - name of wave shape, see shapes
+        period <float> - milliseconds of period of one cycle
+
+    Returns:
+        (sample_us <int>, samples <numpy.ndarray of uint16>), or None if
+        period is too short to be played
+    '''
+
+    sizing = plan(period)
+    if sizing is None: return None
+    samples, sample_us = sizing
+    load()
+    phase = np.arange(samples) / samples
+    values = np.clip(shapes[shape](phase), 0.0, 1.0)
+    return sample_us, np.round(values * 4095).astype(np.uint16)
+
+def frames(sample_us, samples):
+    '''
+    Encodes a table as frames the sketch accepts, each fitting its frame buffer
+
+    Arguments:
+        sample_us <int> - microseconds between samples
+        samples <numpy.ndarray> - 12-bit samples of one period
+
+    Returns:
+        List of frames: a "W<sample_us> N<samples>" header followed by
+        "V<3 hex digits per sample>" frames
+    '''
+
+    digits = ''.join('%03X' % value for value in samples)
+    chunk = 3 * config.WAVEFORM_FRAME_SAMPLES
+    return (['W' + str(sample_us) + ' N' + str(len(samples))] +
+            ['V' + digits[i:i+chunk] for i in range(0, len(digits), chunk)])